@@ -0,0 +1,333 @@
+'''
+Modbus Simu Bench
+=================
+
+Load generator for a running simulator (or any Modbus slave). N client
+connections, each on its own thread, send a weighted mix of requests as fast
+as the server answers for a given duration (or request count) and the
+request rate and latency percentiles are reported::
+
+    $ modbus.simu bench --port 5020 --connections 16 --duration 30 \\
+        --op 3:0:10:70 --op 16:0:10:20 --op 1:0:64:10
+
+An operation is ``function code:address:count[:weight]``, the address is the
+protocol (0 based) address. Writes send the request counter as value.
+'''
+from __future__ import absolute_import, division
+
+import bisect
+import json
+import logging
+import math
+import random
+import threading
+import time
+from array import array
+
+import six
+from modbus_tk import defines
+from modbus_tk.exceptions import ModbusError
+
+from modbus_simulator.utils.modbus import MASTERS
+
+if six.PY3:
+    xrange = range
+
+log = logging.getLogger(__name__)
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+FUNCTION_CODES = {
+    defines.READ_COILS: 'read_coils',
+    defines.READ_DISCRETE_INPUTS: 'read_discrete_inputs',
+    defines.READ_HOLDING_REGISTERS: 'read_holding_registers',
+    defines.READ_INPUT_REGISTERS: 'read_input_registers',
+    defines.WRITE_SINGLE_COIL: 'write_single_coil',
+    defines.WRITE_SINGLE_REGISTER: 'write_single_register',
+    defines.WRITE_MULTIPLE_COILS: 'write_multiple_coils',
+    defines.WRITE_MULTIPLE_REGISTERS: 'write_multiple_registers',
+}
+# request size limits of the spec
+MAX_COUNT = {
+    defines.READ_COILS: 2000,
+    defines.READ_DISCRETE_INPUTS: 2000,
+    defines.READ_HOLDING_REGISTERS: 125,
+    defines.READ_INPUT_REGISTERS: 125,
+    defines.WRITE_SINGLE_COIL: 1,
+    defines.WRITE_SINGLE_REGISTER: 1,
+    defines.WRITE_MULTIPLE_COILS: 1968,
+    defines.WRITE_MULTIPLE_REGISTERS: 123,
+}
+PERCENTILES = (50, 99, 99.9)
+# a worker gives up after this many errors in a row (server gone)
+MAX_FAILURES = 50
+DEFAULT_OPS = ("3:0:10:1",)
+
+
+class Operation(object):
+    """
+    One entry of the request mix.
+    """
+    __slots__ = ('function_code', 'address', 'count', 'weight')
+
+    def __init__(self, function_code, address, count=1, weight=1.0):
+        if function_code not in FUNCTION_CODES:
+            raise ValueError("Unsupported function code %d, one of %s" % (
+                function_code, ", ".join(str(fc) for fc in
+                                         sorted(FUNCTION_CODES))))
+        if not 1 <= count <= MAX_COUNT[function_code]:
+            raise ValueError("%s takes 1 to %d values, got %d" % (
+                FUNCTION_CODES[function_code], MAX_COUNT[function_code],
+                count))
+        if not 0 <= address <= 0xffff or weight <= 0:
+            raise ValueError("Invalid address %d or weight %g" % (address,
+                                                                  weight))
+        self.function_code = function_code
+        self.address = address
+        self.count = count
+        self.weight = weight
+
+    @classmethod
+    def parse(cls, text):
+        """
+        :class:`Operation` of a ``function code:address:count[:weight]``
+        string.
+
+        :raises ValueError: Malformed operation
+        """
+        parts = text.split(':')
+        if len(parts) not in (2, 3, 4):
+            raise ValueError("Operation '%s' is not "
+                             "function_code:address[:count[:weight]]" % text)
+        try:
+            return cls(int(parts[0]), int(parts[1]),
+                       int(parts[2]) if len(parts) > 2 else 1,
+                       float(parts[3]) if len(parts) > 3 else 1.0)
+        except ValueError as e:
+            raise ValueError("Operation '%s': %s" % (text, e))
+
+    @property
+    def name(self):
+        return "%s@%d[%d]" % (FUNCTION_CODES[self.function_code],
+                              self.address, self.count)
+
+    def execute(self, master, slave_id, counter):
+        fc = self.function_code
+        if fc in (defines.WRITE_SINGLE_COIL, defines.WRITE_SINGLE_REGISTER):
+            value = counter & (1 if fc == defines.WRITE_SINGLE_COIL
+                               else 0xffff)
+            return master.execute(slave_id, fc, self.address,
+                                  output_value=value)
+        if fc == defines.WRITE_MULTIPLE_COILS:
+            return master.execute(slave_id, fc, self.address,
+                                  output_value=[counter & 1] * self.count)
+        if fc == defines.WRITE_MULTIPLE_REGISTERS:
+            return master.execute(slave_id, fc, self.address,
+                                  output_value=[counter & 0xffff] *
+                                  self.count)
+        return master.execute(slave_id, fc, self.address, self.count)
+
+
+def percentile(latencies, pct):
+    """
+    Nearest rank percentile of sorted ``latencies``.
+    """
+    if not latencies:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(latencies))) - 1
+    return latencies[min(max(rank, 0), len(latencies) - 1)]
+
+
+class Worker(threading.Thread):
+    """
+    One client connection, latencies in seconds are kept per operation.
+    """
+    def __init__(self, bench, index):
+        super(Worker, self).__init__(name="bench-%d" % index)
+        self.daemon = True
+        self.bench = bench
+        self.random = random.Random(bench.seed + index)
+        self.latencies = [array(str('d')) for _ in bench.ops]
+        self.exceptions = [0] * len(bench.ops)
+        self.errors = 0
+
+    def run(self):
+        bench = self.bench
+        try:
+            master = bench.connect()
+        except Exception as e:
+            log.error("%s: connection failed: %s", self.name, e)
+            self.errors += 1
+            return
+        ops = bench.ops
+        slaves = bench.slaves
+        cumulative = bench.cumulative
+        total = cumulative[-1]
+        choose = self.random.random
+        counter = 0
+        failures = 0
+        try:
+            bench.ready.wait()
+            while not bench.done.is_set():
+                if bench.requests and counter >= bench.requests:
+                    break
+                index = bisect.bisect_right(cumulative, choose() * total)
+                slave_id = slaves[counter % len(slaves)]
+                started = _timer()
+                try:
+                    ops[index].execute(master, slave_id, counter)
+                except ModbusError:
+                    self.exceptions[index] += 1
+                except Exception as e:
+                    log.debug("%s: %s failed: %s", self.name,
+                              ops[index].name, e)
+                    self.errors += 1
+                    # failed attempts count toward ``requests``
+                    counter += 1
+                    failures += 1
+                    if failures >= MAX_FAILURES:
+                        log.error("%s: stopped after %d consecutive errors",
+                                  self.name, failures)
+                        break
+                    if bench.done.wait(0.1):
+                        break
+                    continue
+                failures = 0
+                self.latencies[index].append(_timer() - started)
+                counter += 1
+        finally:
+            master.close()
+
+
+class Bench(object):
+    """
+    Runs ``connections`` :class:`Worker` against one server.
+
+    :param ops: :class:`Operation` list
+    :param duration: Seconds to run, 0 to run until ``requests``
+    :param requests: Requests per connection, 0 for no limit
+    """
+    def __init__(self, ops, server="tcp", host="127.0.0.1", port=5440,
+                 slaves=(1,), connections=1, duration=10.0, requests=0,
+                 timeout=5.0, baudrate=9600, seed=0):
+        if not ops:
+            raise ValueError("No operation to run")
+        if not duration and not requests:
+            raise ValueError("Set a duration or a request count")
+        if server != 'tcp' and connections > 1:
+            raise ValueError("A serial port takes a single connection")
+        self.ops = list(ops)
+        self.server = server
+        self.host = host
+        self.port = port
+        self.slaves = list(slaves)
+        self.connections = connections
+        self.duration = duration
+        self.requests = requests
+        self.timeout = timeout
+        self.baudrate = baudrate
+        self.seed = seed
+        self.cumulative = []
+        total = 0
+        for op in self.ops:
+            total += op.weight
+            self.cumulative.append(total)
+        self.ready = threading.Event()
+        self.done = threading.Event()
+
+    def connect(self):
+        if self.server == 'tcp':
+            master = MASTERS['tcp'](host=self.host, port=int(self.port),
+                                    timeout_in_sec=self.timeout)
+        else:
+            import serial
+            master = MASTERS['rtu'](serial.Serial(port=self.port,
+                                                  baudrate=self.baudrate))
+            master.set_timeout(self.timeout)
+        master.open()
+        return master
+
+    def run(self):
+        """
+        :return: Report dict, see :meth:`report`
+        """
+        workers = [Worker(self, index) for index in xrange(self.connections)]
+        for worker in workers:
+            worker.start()
+        started = _timer()
+        self.ready.set()
+        try:
+            if self.duration:
+                self.done.wait(self.duration)
+                self.done.set()
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(0.5)
+        except KeyboardInterrupt:
+            self.done.set()
+            for worker in workers:
+                worker.join()
+        return self.report(workers, _timer() - started)
+
+    def report(self, workers, elapsed):
+        """
+        Request rate and latency percentiles (milliseconds), overall and per
+        operation.
+        """
+        def summary(latencies, exceptions):
+            latencies = sorted(latencies)
+            stats = {
+                'requests': len(latencies),
+                'exceptions': exceptions,
+                'rate': len(latencies) / elapsed if elapsed else 0.0,
+                'max_ms': latencies[-1] * 1000 if latencies else 0.0
+            }
+            for pct in PERCENTILES:
+                stats['p%g_ms' % pct] = percentile(latencies, pct) * 1000
+            return stats
+
+        everything = []
+        per_op = []
+        for index, op in enumerate(self.ops):
+            latencies = []
+            for worker in workers:
+                latencies.extend(worker.latencies[index])
+            everything.extend(latencies)
+            stats = summary(latencies, sum(worker.exceptions[index]
+                                           for worker in workers))
+            stats['operation'] = op.name
+            per_op.append(stats)
+        total = summary(everything, sum(op['exceptions'] for op in per_op))
+        total.update(elapsed=elapsed, connections=self.connections,
+                     errors=sum(worker.errors for worker in workers),
+                     operations=per_op)
+        return total
+
+
+def format_report(report):
+    lines = [
+        "%(requests)d requests in %(elapsed).2f s over %(connections)d "
+        "connection(s), %(rate).1f req/s, %(exceptions)d exception "
+        "response(s), %(errors)d error(s)" % report,
+        "latency ms: p50 %(p50_ms).3f  p99 %(p99_ms).3f  p99.9 "
+        "%(p99.9_ms).3f  max %(max_ms).3f" % report
+    ]
+    for op in report['operations']:
+        lines.append("  %-40s %9d req %10.1f req/s  p50 %8.3f  p99 %8.3f  "
+                     "p99.9 %8.3f" % (op['operation'], op['requests'],
+                                      op['rate'], op['p50_ms'], op['p99_ms'],
+                                      op['p99.9_ms']))
+    return "\n".join(lines)
+
+
+def run(ops=DEFAULT_OPS, as_json=False, **kwargs):
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s"
+    )
+    bench = Bench([Operation.parse(op) for op in ops or DEFAULT_OPS],
+                  **kwargs)
+    report = bench.run()
+    if as_json:
+        return json.dumps(report, indent=2, sort_keys=True)
+    return format_report(report)
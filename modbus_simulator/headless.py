@@ -0,0 +1,464 @@
+'''
+Modbus Simu Headless
+====================
+
+Runs the modbus server without the Kivy GUI. Slaves, blocks and register
+values are restored from a state file written by the GUI (``slaves.json``)
+and protocol settings are read from the GUI config file, so a simulator set
+up interactively can be replayed on a machine without a display.
+'''
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import os
+import signal
+import threading
+import time
+
+import six
+from six.moves.configparser import ConfigParser
+from pkg_resources import resource_filename
+
+from modbus_simulator.utils.constants import BLOCK_TYPES
+from modbus_simulator.utils.snapshot import load_state
+from modbus_simulator.utils.journal import Journal
+from modbus_simulator.utils.metrics import Metrics, MetricsServer
+from modbus_simulator.utils.profiler import install_toggle
+from modbus_simulator.utils.register_map import (DEFAULT_INTERVAL,
+                                                 load_register_map)
+from modbus_simulator.utils.request_timing import (RequestTiming,
+                                                   SlowRequestLog)
+from modbus_simulator.utils.replay import TraceReplay
+from modbus_simulator.utils.scheduler import get_scheduler
+from modbus_simulator.utils.simulation import SimulationEngine
+
+if six.PY3:
+    xrange = range
+
+log = logging.getLogger(__name__)
+
+SLAVES_FILE = resource_filename("modbus_simulator.ui", "slaves.json")
+SNAPSHOT_FILE = resource_filename("modbus_simulator.ui", "slaves.snap")
+
+# Mirrors ModbusSimuApp.build_config
+DEFAULT_CONFIG = {
+    'Modbus Tcp': {
+        'ip': '127.0.0.1',
+        'asyncio': '0',
+    },
+    'Modbus Protocol': {
+        'block start': '0',
+        'block size': '100',
+        'byte order': 'big',
+        'word order': 'big',
+    },
+    'Modbus Serial': {
+        'baudrate': '9600',
+        'bytesize': '8',
+        'parity': 'N',
+        'stopbits': '1',
+        'xonxoff': '0',
+        'rtscts': '0',
+        'dsrdtr': '0',
+        'writetimeout': '2',
+        'timeout': '2',
+    },
+}
+
+
+def load_config(config_file=None):
+    """
+    Read the simulator settings from an ini file written by the GUI
+    (``modbussimu.ini``), falling back to the GUI defaults.
+
+    :param config_file: Path to the ini file or None
+    :return: ConfigParser instance
+    """
+    config = ConfigParser()
+    for section, values in DEFAULT_CONFIG.items():
+        config.add_section(section)
+        for key, value in values.items():
+            config.set(section, key, value)
+    if config_file:
+        if not os.path.isfile(config_file):
+            raise IOError("Config file '%s' not found" % config_file)
+        config.read(config_file)
+    return config
+
+
+def load_state_file(state_file):
+    """
+    Read and validate a state file written by :meth:`Gui.save_state`, a
+    binary snapshot or JSON.
+
+    :param state_file: Path to the state file
+    :return: dict with slaves_list, active_server, port and slaves_memory
+        (plus the register images of a snapshot)
+    """
+    return load_state(state_file)
+
+
+def parse_clone(text):
+    """
+    ``SLAVE:FIRST[-LAST]`` to (slave, [slave ids]).
+
+    :raises ValueError: Malformed or out of range
+    """
+    try:
+        source, _, ids = text.partition(':')
+        first, _, last = ids.partition('-')
+        source, first = int(source), int(first)
+        last = int(last) if last else first
+    except ValueError:
+        raise ValueError("Invalid clone '%s', expected SLAVE:FIRST[-LAST]"
+                         % text)
+    if not 1 <= first <= last <= 247:
+        raise ValueError("Invalid slave range in clone '%s'" % text)
+    return source, list(xrange(first, last + 1))
+
+
+def get_backend(use_pymodbus):
+    if use_pymodbus:
+        from modbus_simulator.utils.pymodbus_server import ModbusSimu
+    else:
+        from modbus_simulator.utils.modbus import ModbusSimu
+    return ModbusSimu
+
+
+class HeadlessSimu(object):
+    """
+    Drives a :class:`ModbusSimu` from a config and a state file without
+    building any widget.
+    """
+    def __init__(self, use_pymodbus=False, config_file=None, state_file=None,
+                 server=None, port=None, use_asyncio=None, workers=1,
+                 shared_image=None, journal=None, replay=None,
+                 replay_speed=1.0, replay_loop=False, metrics=None,
+                 slow_requests=None, profile_dir=None, sparse=False,
+                 clones=(), register_map=None):
+        self.use_pymodbus = use_pymodbus
+        self.clones = [parse_clone(clone) for clone in clones or ()]
+        self.sparse = sparse
+        self.journal_file = journal
+        self.journal = None
+        self.replay_file = replay
+        self.replay_speed = replay_speed
+        self.replay_loop = replay_loop
+        self.replay = None
+        self.metrics_address = metrics
+        self.metrics = None
+        self.metrics_server = None
+        self.request_timing = None
+        self.slow_requests = None
+        self.profile_dir = profile_dir
+        self.profiler = None
+        if slow_requests is not None:
+            self.request_timing = RequestTiming()
+            self.slow_requests = self.request_timing.add_hook(
+                SlowRequestLog(slow_requests))
+        self.workers = workers or 1
+        self.shared_image = shared_image
+        self.config = load_config(config_file)
+        if use_asyncio is None:
+            use_asyncio = self.config.getboolean('Modbus Tcp', 'asyncio')
+        self.use_asyncio = use_asyncio
+        self.state_file = state_file
+        self.state = {}
+        if state_file and os.path.isfile(state_file):
+            self.state = load_state_file(state_file)
+        elif state_file and state_file not in (SLAVES_FILE, SNAPSHOT_FILE):
+            raise IOError("State file '%s' not found" % state_file)
+        self.server_type = (server or self.state.get('active_server')
+                            or 'tcp')
+        self.port = port or self.state.get('port') or (
+            5440 if self.server_type == 'tcp' else '/dev/ptyp0')
+        self.block_start = int(self.config.get("Modbus Protocol",
+                                               "block start"))
+        self.block_size = int(self.config.get("Modbus Protocol",
+                                              "block size"))
+        self.register_map = None
+        self.simulation = None
+        if register_map:
+            self.load_register_map(register_map)
+        if self.workers > 1 and (not use_pymodbus or
+                                 self.server_type != 'tcp'):
+            raise ValueError("Multiple workers need the pymodbus backend "
+                             "and a tcp server")
+        if self.shared_image and not use_pymodbus:
+            raise ValueError("Shared register image needs the pymodbus "
+                             "backend")
+        if (sparse or self.clones) and (not use_pymodbus or
+                                        self.shared_image or
+                                        self.workers > 1):
+            raise ValueError("Sparse blocks and slave clones need the "
+                             "pymodbus backend without a shared register "
+                             "image")
+        if (metrics or self.request_timing is not None) and \
+                (not use_pymodbus or self.workers > 1):
+            raise ValueError("Metrics and request timing need the pymodbus "
+                             "backend and a single worker")
+        self.modbus_device = None
+        self._stop_event = threading.Event()
+
+    def _device_kwargs(self):
+        kwargs = {
+            'byte_order': self.config.get("Modbus Protocol", "byte order"),
+            'word_order': self.config.get("Modbus Protocol", "word order")
+        }
+        if self.server_type == 'rtu':
+            section = 'Modbus Serial'
+            kwargs["baudrate"] = self.config.getint(section, "baudrate")
+            kwargs["bytesize"] = self.config.getint(section, "bytesize")
+            kwargs["parity"] = self.config.get(section, "parity")
+            kwargs["stopbits"] = self.config.getint(section, "stopbits")
+            kwargs["xonxoff"] = self.config.getboolean(section, "xonxoff")
+            kwargs["rtscts"] = self.config.getboolean(section, "rtscts")
+            kwargs["dsrdtr"] = self.config.getboolean(section, "dsrdtr")
+            kwargs["writetimeout"] = self.config.getint(section,
+                                                        "writetimeout")
+            kwargs["timeout"] = self.config.getint(section, "timeout")
+        else:
+            kwargs['address'] = self.config.get('Modbus Tcp', 'ip')
+            if self.use_pymodbus:
+                kwargs['use_asyncio'] = self.use_asyncio
+            if self.workers > 1:
+                kwargs['workers'] = self.workers
+        if self.metrics is not None:
+            kwargs['metrics'] = self.metrics
+        if self.request_timing is not None:
+            kwargs['request_timing'] = self.request_timing
+        if self.sparse:
+            kwargs['sparse'] = True
+        if self.workers > 1 or self.shared_image:
+            kwargs['shared_image'] = self.shared_image
+            kwargs['block_size'] = self.block_start + self.block_size
+        return kwargs
+
+    def create_device(self):
+        ModbusSimu = get_backend(self.use_pymodbus)
+        self.modbus_device = ModbusSimu(server=self.server_type,
+                                        port=self.port,
+                                        **self._device_kwargs())
+        return self.modbus_device
+
+    def load_register_map(self, path):
+        """
+        Reads the register map, adds the slaves it names to the state and
+        grows the blocks to cover its entries.
+        """
+        started = time.time()
+        self.register_map = load_register_map(path)
+        slaves = self.state.setdefault('slaves_list', [])
+        known = set(int(slave_id) for slave_id in slaves)
+        slaves.extend(slave_id for slave_id in self.register_map.slave_ids
+                      if slave_id not in known)
+        if not slaves:
+            slaves.append(1)
+        extents = self.register_map.extents()
+        if extents:
+            self.block_size = max(self.block_size,
+                                  max(extents.values()) - self.block_start)
+        log.info("Register map '%s': %d entries loaded in %.3f s", path,
+                 len(self.register_map), time.time() - started)
+
+    def add_slaves(self):
+        for slave_id in self.state.get('slaves_list', []):
+            self.modbus_device.add_slave(int(slave_id))
+            for block_name, block_type in BLOCK_TYPES.items():
+                self.modbus_device.add_block(int(slave_id), block_name,
+                                             block_type, self.block_start,
+                                             self.block_size)
+
+    def add_clones(self):
+        """
+        Provisions the cloned slaves over a read-only template of their
+        source slave, they only get their own register pages when written.
+        """
+        slaves = [int(slave_id) for slave_id
+                  in self.state.get('slaves_list', [])]
+        for source, slave_ids in self.clones:
+            if source not in slaves:
+                raise ValueError("Clone source slave %d doesn't exist"
+                                 % source)
+            template = self.modbus_device.make_template(source)
+            for slave_id in slave_ids:
+                if slave_id in slaves:
+                    log.warning("Slave %d already exists, not cloned",
+                                slave_id)
+                    continue
+                self.modbus_device.add_slave_from_template(slave_id,
+                                                           template)
+                slaves.append(slave_id)
+            log.info("Slave %d cloned to %d slave(s)", source,
+                     len(slave_ids))
+        self.state['slaves_list'] = slaves
+
+    def load_values(self):
+        if self.state.get('images') and \
+                self.state['byte_order'] == self.config.get(
+                    "Modbus Protocol", "byte order") and \
+                self.state['word_order'] == self.config.get(
+                    "Modbus Protocol", "word order"):
+            # snapshot taken with the same byte/word order, bulk load
+            for slave_id, block_name, first, registers in \
+                    self.state['images']:
+                self.modbus_device.set_values(slave_id, block_name, first,
+                                              registers)
+            return
+        for slave_id, block_name, data in self.state.get('slaves_memory',
+                                                         []):
+            self.write_block(int(slave_id), block_name, data)
+
+    def write_block(self, slave_id, block_name, data):
+        """
+        Same as :meth:`Gui.update_backend` minus the block reset, the block
+        has just been created.
+        """
+        encode = getattr(self.modbus_device, 'encode', None)
+        for k, v in data.items():
+            if block_name in ['holding_registers', 'input_registers'] \
+                    and encode is not None:
+                encode(slave_id, block_name, k, float(v['value']),
+                       v.get('formatter', 'uint16'))
+            else:
+                self.modbus_device.set_values(slave_id, block_name,
+                                              k, int(v['value']))
+
+    def start(self):
+        started = time.time()
+        if self.metrics_address:
+            self.start_metrics()
+        self.create_device()
+        self.add_slaves()
+        if self.register_map is not None:
+            self.register_map.apply(
+                self.modbus_device,
+                [int(slave_id) for slave_id in self.state['slaves_list']],
+                self.config.get("Modbus Protocol", "byte order"),
+                self.config.get("Modbus Protocol", "word order"))
+        self.load_values()
+        self.add_clones()
+        if self.journal_file:
+            self.start_journal()
+        self.modbus_device.start()
+        if self.replay_file:
+            self.start_replay()
+        if self.register_map is not None:
+            self.start_simulation()
+        elapsed = time.time() - started
+        if self.workers > 1:
+            backend = "pymodbus, %d workers" % self.workers
+        elif self.use_pymodbus:
+            backend = "pymodbus, asyncio" if self.use_asyncio else "pymodbus"
+        else:
+            backend = "modbus_tk"
+        log.info("Modbus %s server (%s) started on %s with %d slave(s) "
+                 "in %.3f s", self.server_type, backend,
+                 self.port, len(self.state.get('slaves_list', [])), elapsed)
+        return elapsed
+
+    def start_journal(self):
+        """
+        Replays the journal of the previous run over the loaded state and
+        journals writes from now on.
+        """
+        self.journal = Journal(self.journal_file, self.modbus_device)
+        self.journal.recover()
+        for slave_id in self.state.get('slaves_list', []):
+            self.journal.track(int(slave_id))
+        self.journal.start()
+
+    def start_metrics(self):
+        """
+        Serves the server metrics on ``[host:]port``/metrics.
+        """
+        host, _, port = str(self.metrics_address).rpartition(':')
+        self.metrics = Metrics()
+        self.metrics_server = MetricsServer(self.metrics,
+                                            host or '127.0.0.1', int(port))
+        self.metrics_server.start()
+
+    def start_replay(self):
+        """
+        Plays the trace file into the registers, over the loaded state.
+        """
+        self.replay = TraceReplay(self.modbus_device, self.replay_file,
+                                  speed=self.replay_speed,
+                                  loop=self.replay_loop)
+        self.replay.start()
+
+    def start_simulation(self):
+        """
+        Simulates the entries of the register map with a profile.
+        """
+        engine = SimulationEngine(
+            self.modbus_device,
+            self.config.get("Modbus Protocol", "byte order"),
+            self.config.get("Modbus Protocol", "word order"))
+        blocks = self.register_map.simulate(
+            engine, [int(slave_id) for slave_id in self.state['slaves_list']])
+        for block_name in blocks:
+            engine.start(block_name, DEFAULT_INTERVAL, 0, 0)
+        if blocks:
+            self.simulation = engine
+
+    def stop(self, *args):
+        self._stop_event.set()
+
+    def serve_forever(self):
+        self.start()
+        signal.signal(signal.SIGTERM, self.stop)
+        self.profiler = install_toggle(self.profile_dir)
+        try:
+            while not self._stop_event.is_set():
+                self._stop_event.wait(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.profiler is not None:
+                self.profiler.finish()
+            if self.replay is not None:
+                self.replay.stop()
+            if self.simulation is not None:
+                self.simulation.stop()
+            if self.journal is not None:
+                self.journal.close()
+            self.modbus_device.stop()
+            if hasattr(self.modbus_device, 'close'):
+                self.modbus_device.close()
+            if self.metrics_server is not None:
+                self.metrics_server.stop()
+            if self.slow_requests is not None:
+                log.info("%d request(s) slower than %g s",
+                         self.slow_requests.count,
+                         self.slow_requests.threshold)
+                for sample in self.slow_requests.slowest():
+                    log.info("  %r", sample)
+            for stats in get_scheduler().stats():
+                log.debug("Periodic job %(name)s: %(runs)d runs, "
+                          "%(overruns)d overruns, jitter mean %(mean_jitter).4f"
+                          " s max %(max_jitter).4f s", stats)
+            log.info("Modbus %s server stopped", self.server_type)
+
+
+def run(use_pymodbus=False, config_file=None, state_file=None,
+        server=None, port=None, use_asyncio=None, workers=1,
+        shared_image=None, journal=None, replay=None, replay_speed=1.0,
+        replay_loop=False, metrics=None, slow_requests=None,
+        profile_dir=None, sparse=False, clones=(), register_map=None):
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s"
+    )
+    if state_file is None:
+        state_file = SNAPSHOT_FILE if os.path.isfile(SNAPSHOT_FILE) \
+            else SLAVES_FILE
+    HeadlessSimu(use_pymodbus=use_pymodbus, config_file=config_file,
+                 state_file=state_file, server=server, port=port,
+                 use_asyncio=use_asyncio, workers=workers,
+                 shared_image=shared_image, journal=journal, replay=replay,
+                 replay_speed=replay_speed,
+                 replay_loop=replay_loop, metrics=metrics,
+                 slow_requests=slow_requests,
+                 profile_dir=profile_dir, sparse=sparse,
+                 clones=clones, register_map=register_map).serve_forever()
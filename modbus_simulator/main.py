@@ -12,10 +12,82 @@ else:
     import builtins as __builtin__
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option("-p", is_flag=True, help="use pymodbus as modbus backend")
-def _run(p):
+@click.option("--headless", is_flag=True,
+              help="run the modbus server without the GUI")
+@click.option("--config", "config_file", default=None,
+              type=click.Path(dir_okay=False),
+              help="simulator settings (modbussimu.ini), headless only")
+@click.option("--state", "state_file", default=None,
+              type=click.Path(dir_okay=False),
+              help="simulator state (slaves.json), headless only")
+@click.option("--server", type=click.Choice(["tcp", "rtu"]), default=None,
+              help="server type, overrides the state file, headless only")
+@click.option("--port", default=None,
+              help="tcp port or serial device, overrides the state file, "
+                   "headless only")
+@click.option("--asyncio/--no-asyncio", "use_asyncio", default=None,
+              help="serve tcp clients from a single asyncio event loop "
+                   "(pymodbus backend), headless only")
+@click.option("--workers", default=1, type=click.IntRange(1, None),
+              help="serve tcp clients from N processes sharing the port and "
+                   "the registers (pymodbus backend), headless only")
+@click.option("--shared-image", default=None,
+              help="publish the registers in this shared memory segment "
+                   "(or file, if the name is a path) for local tools "
+                   "(pymodbus backend), headless only")
+@click.option("--journal", default=None, type=click.Path(dir_okay=False),
+              help="journal register writes to this file and recover them "
+                   "on start, headless only")
+@click.option("--replay", default=None,
+              type=click.Path(exists=True, dir_okay=False),
+              help="play a CSV trace of register values into the slaves, "
+                   "headless only")
+@click.option("--replay-speed", default=1.0,
+              type=click.FloatRange(0.001, None),
+              help="trace replay speed, times real time, headless only")
+@click.option("--replay-loop", is_flag=True,
+              help="start the trace over at its end, headless only")
+@click.option("--metrics", default=None, metavar="[HOST:]PORT",
+              help="serve request metrics on http://HOST:PORT/metrics "
+                   "(pymodbus backend), headless only")
+@click.option("--slow-requests", default=None, metavar="SECONDS",
+              type=click.FloatRange(0, None),
+              help="log requests slower than this with their framing, "
+                   "datastore and write times (pymodbus backend), "
+                   "headless only")
+@click.option("--profile-dir", default=None,
+              type=click.Path(file_okay=False, exists=True),
+              help="directory of the profiles toggled with SIGUSR2 "
+                   "(default: current directory), headless only")
+@click.option("--sparse", is_flag=True,
+              help="keep registers in pages allocated on first write, for "
+                   "large and mostly unused blocks (pymodbus backend), "
+                   "headless only")
+@click.option("--clone", "clones", multiple=True, metavar="SLAVE:FIRST[-LAST]",
+              help="add slaves FIRST to LAST sharing the registers of SLAVE "
+                   "until written (pymodbus backend), headless only")
+@click.option("--register-map", type=click.Path(exists=True, dir_okay=False),
+              help="CSV register map (address, type, formatter, scale, "
+                   "value, profile) to load and simulate, headless only")
+@click.pass_context
+def _run(ctx, p, headless, config_file, state_file, server, port, use_asyncio,
+         workers, shared_image, journal, replay, replay_speed, replay_loop,
+         metrics, slow_requests, profile_dir, sparse, clones, register_map):
+    if ctx.invoked_subcommand is not None:
+        return
     __builtin__.USE_PYMODBUS = p
+    if headless:
+        from modbus_simulator.headless import run
+        run(use_pymodbus=p, config_file=config_file, state_file=state_file,
+            server=server, port=port, use_asyncio=use_asyncio,
+            workers=workers, shared_image=shared_image, journal=journal,
+            replay=replay, replay_speed=replay_speed,
+            replay_loop=replay_loop, metrics=metrics,
+            slow_requests=slow_requests, profile_dir=profile_dir,
+            sparse=sparse, clones=clones, register_map=register_map)
+        return
     if "-p" in sys.argv:
         # cleanup before kivy gets confused
         sys.argv.remove("-p")
@@ -23,5 +95,68 @@ def _run(p):
     run()
 
 
+@_run.command()
+@click.option("--server", type=click.Choice(["tcp", "rtu"]), default="tcp",
+              help="server type")
+@click.option("--host", default="127.0.0.1", help="tcp server address")
+@click.option("--port", default="5440",
+              help="tcp port or serial device")
+@click.option("--baudrate", default=9600, type=int, help="serial baudrate")
+@click.option("--slave", "slaves", multiple=True, type=int, default=[1],
+              help="slave id, repeat to spread the requests over slaves")
+@click.option("--op", "ops", multiple=True,
+              help="request function_code:address[:count[:weight]], "
+                   "repeat for a weighted mix (default 3:0:10)")
+@click.option("-c", "--connections", default=1,
+              type=click.IntRange(1, None), help="concurrent connections")
+@click.option("-d", "--duration", default=10.0,
+              type=click.FloatRange(0, None),
+              help="seconds to run, 0 to stop after --requests")
+@click.option("-n", "--requests", default=0, type=click.IntRange(0, None),
+              help="requests per connection, 0 for no limit")
+@click.option("--timeout", default=5.0, type=float,
+              help="response timeout in seconds")
+@click.option("--seed", default=0, type=int, help="request mix seed")
+@click.option("--json", "as_json", is_flag=True,
+              help="print the report as JSON")
+def bench(**kwargs):
+    """
+    Measure request rate and latency of a running simulator.
+    """
+    from modbus_simulator.bench import run
+    try:
+        click.echo(run(**kwargs))
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+@_run.command()
+@click.option("--backend", "backends", multiple=True,
+              type=click.Choice(["pymodbus", "modbus_tk"]),
+              help="backend to time, repeat for both (default both)")
+@click.option("-k", "pattern", default=None,
+              help="only run the cases whose name contains this")
+@click.option("--repeat", default=5, type=click.IntRange(1, None),
+              help="timed rounds per case, the best one is kept")
+@click.option("--min-time", default=0.05, type=click.FloatRange(0, None),
+              help="minimum duration of a round in seconds")
+@click.option("-o", "--output", default=None,
+              type=click.Path(dir_okay=False),
+              help="write the results to this JSON file")
+@click.option("--baseline", default=None,
+              type=click.Path(exists=True, dir_okay=False),
+              help="compare against the results of a previous run")
+@click.option("--max-slowdown", default=0.2, type=click.FloatRange(0, None),
+              help="fail when a case is slower than its baseline by more "
+                   "than this fraction")
+def microbench(backends, **kwargs):
+    """
+    Time the datastore, codec, simulation and state file hot paths.
+    """
+    from modbus_simulator.microbench import BACKENDS, run
+    if not run(backends=backends or BACKENDS, echo=click.echo, **kwargs):
+        sys.exit(1)
+
+
 if __name__ == "__main__":
     _run()
@@ -0,0 +1,393 @@
+'''
+Modbus Simu Microbenchmarks
+===========================
+
+Times the hot paths of the simulator without a display or a client: the
+register store of both backends (``get_values``/``set_values``,
+``_calc_offset``), the register codecs, a simulation tick, register map
+import and the state file I/O::
+
+    $ modbus.simu microbench --output results.json
+    $ modbus.simu microbench --baseline results.json --max-slowdown 0.2
+
+A case is run in rounds of ``number`` calls (calibrated so a round takes at
+least ``min_time`` seconds), ``repeat`` rounds, and the best round is kept
+as the per call time; the median round is reported alongside. Results are
+JSON. With a baseline, a case more than ``max_slowdown`` slower than its
+baseline time fails the run.
+'''
+from __future__ import absolute_import, division, print_function
+
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import six
+
+from modbus_simulator.utils.codec import (WORD_COUNT, get_codec,
+                                          get_layout_codec)
+from modbus_simulator.utils.constants import ADDRESS_BASE, BLOCK_TYPES
+from modbus_simulator.version import __VERSION__
+
+if six.PY3:
+    xrange = range
+
+log = logging.getLogger(__name__)
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+BACKENDS = ('pymodbus', 'modbus_tk')
+BLOCK_SIZE = 1000
+SLAVES = 4
+
+
+def _device(backend):
+    if backend == 'pymodbus':
+        from modbus_simulator.utils.pymodbus_server import ModbusSimu
+    else:
+        from modbus_simulator.utils.modbus import ModbusSimu
+    # port 0, pymodbus binds its socket when created
+    device = ModbusSimu(server='tcp', port=0, address='127.0.0.1')
+    for slave_id in xrange(1, SLAVES + 1):
+        device.add_slave(slave_id)
+        for block_name, block_type in BLOCK_TYPES.items():
+            device.add_block(slave_id, block_name, block_type, 0, BLOCK_SIZE)
+    return device
+
+
+def _close(device):
+    if hasattr(device, 'close'):
+        device.close()
+    server_close = getattr(device.server, 'server_close', None)
+    if server_close is not None:
+        server_close()
+
+
+def _data_map(formatter='uint16', count=BLOCK_SIZE):
+    """
+    Register map of a holding register block as kept by the GUI.
+    """
+    words = 4 if '64' in formatter else 2 if '32' in formatter else 1
+    return dict((ADDRESS_BASE['holding_registers'] + index * words,
+                 {'value': 1, 'formatter': formatter})
+                for index in xrange(count // words))
+
+
+class Case(object):
+    """
+    A timed function, ``setup(backend)`` returns the function to time and a
+    cleanup callable (or None).
+    """
+    def __init__(self, name, setup, backends=(None,)):
+        self.name = name
+        self.setup = setup
+        self.backends = backends
+
+    def names(self, backends):
+        for backend in self.backends:
+            if backend is None:
+                yield self.name, None
+            elif backend in backends:
+                yield "%s[%s]" % (self.name, backend), backend
+
+
+def _store_get(backend):
+    device = _device(backend)
+    first = ADDRESS_BASE['holding_registers']
+    return (lambda: device.get_values(1, 'holding_registers', first, 100),
+            lambda: _close(device))
+
+
+def _store_set(backend):
+    device = _device(backend)
+    first = ADDRESS_BASE['holding_registers']
+    values = list(xrange(100))
+    return (lambda: device.set_values(1, 'holding_registers', first,
+                                      values),
+            lambda: _close(device))
+
+
+def _store_set_one(backend):
+    device = _device(backend)
+    return (lambda: device.set_values(1, 'coils', 10, 1),
+            lambda: _close(device))
+
+
+def _calc_offset(backend):
+    device = _device(backend)
+    calc_offset = device._calc_offset
+
+    def run():
+        calc_offset('holding_registers', 40101)
+        calc_offset('input_registers', 30101)
+        calc_offset('discrete_inputs', 10101)
+        calc_offset('coils', 101)
+    return run, lambda: _close(device)
+
+
+def _device_encode(backend):
+    device = _device(backend)
+    return (lambda: device.encode(1, 'holding_registers', 40001, 12.5,
+                                  'float32'),
+            lambda: _close(device))
+
+
+def _device_decode(backend):
+    device = _device(backend)
+    device.encode(1, 'holding_registers', 40001, 12.5, 'float32')
+    return (lambda: device.decode(1, 'holding_registers', 40001,
+                                  'float32'),
+            lambda: _close(device))
+
+
+def _codec_encode(backend):
+    codec = get_codec('float32', 100)
+    values = [i + 0.5 for i in xrange(100)]
+    return lambda: codec.encode(values), None
+
+
+def _codec_decode(backend):
+    codec = get_codec('float32', 100)
+    registers = codec.encode([i + 0.5 for i in xrange(100)])
+    return lambda: codec.decode(registers), None
+
+
+def _layout_decode(backend):
+    layout = []
+    offset = 0
+    for formatter, count, words in (('uint16', 10, 1), ('int32', 10, 2),
+                                    ('float32', 20, 2), ('float64', 5, 4)):
+        for _ in xrange(count):
+            layout.append((offset, formatter))
+            offset += words
+    codec = get_layout_codec(layout)
+    registers = [1] * codec.words
+    return lambda: codec.decode(registers), None
+
+
+def _simulation_tick(backend):
+    from modbus_simulator.utils.simulation import SimulationEngine
+    device = _device(backend)
+    engine = SimulationEngine(device)
+    for slave_id in xrange(1, SLAVES + 1):
+        engine.set_block(slave_id, 'holding_registers',
+                         _data_map('float32'))
+    return (lambda: engine.tick('holding_registers', 0, 1000),
+            lambda: _close(device))
+
+
+def _register_map_file(path, points=20000):
+    formatters = ('uint16', 'int16', 'float32', 'int32', 'float64')
+    address = ADDRESS_BASE['holding_registers']
+    with open(path, 'w') as f:
+        f.write("address,type,formatter,scale,value,profile\n")
+        for index in xrange(points):
+            formatter = formatters[index % len(formatters)]
+            f.write("%d,h,%s,0.1,%d.5,%s\n" % (
+                address, formatter, index % 100,
+                "sine offset=50 amplitude=10" if index % 10 == 0 else ""))
+            address += WORD_COUNT[formatter]
+
+
+def _load_register_map(backend):
+    from modbus_simulator.utils.register_map import load_register_map
+    path, cleanup = _state_file(_register_map_file)
+    return lambda: load_register_map(path), cleanup
+
+
+def _encode_register_map(backend):
+    from modbus_simulator.utils.register_map import load_register_map
+    path, cleanup = _state_file(_register_map_file)
+    block = load_register_map(path).blocks[(None, 'holding_registers')]
+    return block.encode, cleanup
+
+
+def _state(formatter='float32'):
+    memory = []
+    for slave_id in xrange(1, SLAVES + 1):
+        memory.append((slave_id, 'holding_registers', _data_map(formatter)))
+        memory.append((slave_id, 'coils', dict(
+            (index, {'value': index % 2}) for index in xrange(BLOCK_SIZE))))
+    return dict(slaves_list=list(xrange(1, SLAVES + 1)),
+                active_server='tcp', port=5440, slaves_memory=memory)
+
+
+def _state_file(save):
+    folder = tempfile.mkdtemp(prefix='modbus_simu_bench')
+    path = os.path.join(folder, 'state')
+    save(path)
+    return path, lambda: shutil.rmtree(folder, ignore_errors=True)
+
+
+def _calc(block_name, address):
+    return int(address) - ADDRESS_BASE[block_name]
+
+
+def _save_snapshot(backend):
+    from modbus_simulator.utils.snapshot import save_snapshot
+    state = _state()
+    path, cleanup = _state_file(lambda path: None)
+    return lambda: save_snapshot(path, state, _calc), cleanup
+
+
+def _load_snapshot(backend):
+    from modbus_simulator.utils.snapshot import load_state, save_snapshot
+    state = _state()
+    path, cleanup = _state_file(lambda path: save_snapshot(path, state,
+                                                           _calc))
+    return lambda: load_state(path), cleanup
+
+
+def _save_json(backend):
+    state = _state()
+    path, cleanup = _state_file(lambda path: None)
+
+    def run():
+        with open(path, 'w') as f:
+            json.dump(state, f, indent=4)
+    return run, cleanup
+
+
+def _load_json(backend):
+    from modbus_simulator.utils.snapshot import load_state
+    state = _state()
+
+    def save(path):
+        with open(path, 'w') as f:
+            json.dump(state, f, indent=4)
+    path, cleanup = _state_file(save)
+    return lambda: load_state(path), cleanup
+
+
+CASES = [
+    Case('store.get_values_100', _store_get, BACKENDS),
+    Case('store.set_values_100', _store_set, BACKENDS),
+    Case('store.set_values_1', _store_set_one, BACKENDS),
+    Case('store.calc_offset_x4', _calc_offset, BACKENDS),
+    Case('device.encode_float32', _device_encode, ('pymodbus',)),
+    Case('device.decode_float32', _device_decode, ('pymodbus',)),
+    Case('codec.encode_float32_100', _codec_encode),
+    Case('codec.decode_float32_100', _codec_decode),
+    Case('codec.decode_layout_45', _layout_decode),
+    Case('simulation.tick_4x500_float32', _simulation_tick, BACKENDS),
+    Case('register_map.load_20k', _load_register_map),
+    Case('register_map.encode_20k', _encode_register_map),
+    Case('state.save_snapshot', _save_snapshot),
+    Case('state.load_snapshot', _load_snapshot),
+    Case('state.save_json', _save_json),
+    Case('state.load_json', _load_json),
+]
+
+
+def measure(function, repeat=5, min_time=0.05):
+    """
+    :return: (best, median) seconds per call, calls per round
+    """
+    number = 1
+    while True:
+        started = _timer()
+        for _ in xrange(number):
+            function()
+        elapsed = _timer() - started
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed * 10 > min_time else 10
+    rounds = [elapsed / number]
+    for _ in xrange(repeat - 1):
+        started = _timer()
+        for _ in xrange(number):
+            function()
+        rounds.append((_timer() - started) / number)
+    rounds.sort()
+    return rounds[0], rounds[len(rounds) // 2], number
+
+
+def run_cases(backends=BACKENDS, pattern=None, repeat=5, min_time=0.05,
+              report=None):
+    """
+    Runs the cases matching ``pattern`` (a substring of their name).
+
+    :param report: Called with (name, result) after every case
+    :return: {name: result}, times in microseconds
+    """
+    results = OrderedDict()
+    for case in CASES:
+        for name, backend in case.names(backends):
+            if pattern and pattern not in name:
+                continue
+            function, cleanup = case.setup(backend)
+            try:
+                best, median, number = measure(function, repeat, min_time)
+            finally:
+                if cleanup is not None:
+                    cleanup()
+            results[name] = dict(best_us=best * 1e6, median_us=median * 1e6,
+                                 number=number, repeat=repeat)
+            if report is not None:
+                report(name, results[name])
+    return results
+
+
+def compare(results, baseline, max_slowdown):
+    """
+    :return: [(name, current us, baseline us, ratio, failed)] of the cases
+        present in both runs
+    """
+    rows = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base or not base['best_us']:
+            continue
+        ratio = result['best_us'] / base['best_us']
+        rows.append((name, result['best_us'], base['best_us'], ratio,
+                     ratio > 1 + max_slowdown))
+    return rows
+
+
+def metadata():
+    return dict(version=__VERSION__, python=sys.version.split()[0],
+                implementation=platform.python_implementation(),
+                platform=platform.platform(), machine=platform.machine(),
+                timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def run(backends=BACKENDS, pattern=None, repeat=5, min_time=0.05,
+        output=None, baseline=None, max_slowdown=0.2, echo=print):
+    """
+    Runs the suite and compares it against ``baseline``.
+
+    :return: True when no case is slower than the baseline allows
+    """
+    logging.basicConfig(level=logging.WARNING)
+    base = load_results(baseline) if baseline else None
+
+    def report(name, result):
+        echo("%-44s %12.3f us  (median %.3f us, %d x %d)" % (
+            name, result['best_us'], result['median_us'], result['number'],
+            result['repeat']))
+
+    results = run_cases(backends, pattern, repeat, min_time, report)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(dict(meta=metadata(), results=results), f, indent=2)
+    if base is None:
+        return True
+    ok = True
+    echo("")
+    for name, current, previous, ratio, failed in compare(results, base,
+                                                          max_slowdown):
+        echo("%-44s %12.3f us  baseline %12.3f us  %6.2fx%s" % (
+            name, current, previous, ratio, "  SLOWER" if failed else ""))
+        ok = ok and not failed
+    return ok
@@ -1,19 +1,18 @@
-from random import randint, uniform
 from copy import deepcopy
-from kivy.adapters.dictadapter import DictAdapter
 from kivy.event import EventDispatcher
 from kivy.lang import Builder
 from kivy.logger import Logger
-from kivy.properties import BooleanProperty, NumericProperty
+from kivy.properties import BooleanProperty, NumericProperty, ObjectProperty
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.button import Button
 from kivy.uix.gridlayout import GridLayout
 from kivy.uix.label import Label
-from kivy.uix.listview import ListItemButton, CompositeListItem, ListView, SelectableView
 from kivy.uix.popup import Popup
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
 from kivy.uix.textinput import TextInput
+from kivy.uix.togglebutton import ToggleButton
 from kivy.uix.dropdown import DropDown
-from modbus_simulator.utils.backgroundJob import BackgroundJob
 from pkg_resources import resource_filename
 
 datamodel_template = resource_filename(__name__, "../templates/datamodel.kv")
@@ -22,36 +21,18 @@ Builder.load_file(datamodel_template)
 integers_dict = {}
 
 
-class DropBut(SelectableView, Button):
-    # drop_list = None
+class DropBut(Button):
+    """
+    Formatter button of a register row. The formatter list is one
+    :class:`DropDown` shared by all the rows of a :class:`DataModel`.
+    """
     types = ['int16', 'int32', 'int64', 'uint16', 'uint32', 'uint64',
              'float32', 'float64']
-    drop_down = None
 
     def __init__(self, data_model, **kwargs):
         super(DropBut, self).__init__(**kwargs)
         self.data_model = data_model
-        self.drop_down = DropDown()
-        for i in self.types:
-            btn = Button(text=i, size_hint_y=None, height=45,
-                         background_color=(0.0, 0.5, 1.0, 1.0))
-            btn.bind(on_release=lambda b: self.drop_down.select(b.text))
-            self.drop_down.add_widget(btn)
-
-        self.bind(on_release=self.drop_down.open)
-        self.drop_down.bind(on_select=self.on_formatter_select)
-
-    def select_from_composite(self, *args):
-        # self.bold = True
-        pass
-
-    def deselect_from_composite(self, *args):
-        # self.bold = False
-        pass
-
-    def on_formatter_select(self, instance, value):
-        self.data_model.on_formatter_update(self.index, self.text, value)
-        self.text = value
+        self.bind(on_release=self.data_model.open_formatters)
 
 
 class ErrorPopup(Popup):
@@ -88,29 +69,27 @@ class ListItemReprMixin(Label):
         return '<%s text=%s>' % (self.__class__.__name__, text)
 
 
-class NumericTextInput(SelectableView, TextInput):
+class NumericTextInput(TextInput):
     """
-    :class:`~kivy.uix.listview.NumericTextInput` mixes
-    :class:`~kivy.uix.listview.SelectableView` with
-    :class:`~kivy.uix.label.TextInput` to produce a label suitable for use in
-    :class:`~kivy.uix.listview.ListView`.
+    Value field of a :class:`RegisterRow`, disabled until touched. The
+    entered value is checked against the range of the data model.
     """
     edit = BooleanProperty(False)
 
-    def __init__(self, data_model, minval, maxval, **kwargs):
-        self.minval = minval
-        self.maxval = maxval
+    def __init__(self, data_model, **kwargs):
         self.data_model = data_model
         super(NumericTextInput, self).__init__(**kwargs)
-        try:
-            self.val = int(self.text)
-        except ValueError:
-            error = "Only numeric value in range {0}-{1} to be used".format(minval, maxval)
-            self.hint_text = error
-
         self._update_width()
         self.disabled = True
 
+    @property
+    def minval(self):
+        return self.data_model.minval
+
+    @property
+    def maxval(self):
+        return self.data_model.maxval
+
     def _update_width(self):
         if self.data_model.blockname not in ['input_registers',
                                          'holding_registers']:
@@ -125,23 +104,10 @@ class NumericTextInput(SelectableView, TextInput):
     def select(self, *args):
         self.disabled = False
         self.bold = True
-        if isinstance(self.parent, CompositeListItem):
-            for child in self.parent.children:
-                # print child.children
-                pass
-            self.parent.select_from_child(self, *args)
 
     def deselect(self, *args):
         self.bold = False
         self.disabled = True
-        if isinstance(self.parent, CompositeListItem):
-            self.parent.deselect_from_child(self, *args)
-
-    def select_from_composite(self, *args):
-        self.bold = True
-
-    def deselect_from_composite(self, *args):
-        self.bold = False
 
     def on_text_validate(self, *args):
 
@@ -151,7 +117,7 @@ class NumericTextInput(SelectableView, TextInput):
             if not(self.minval <= float(self.text) <= self.maxval):
                 raise ValueError
             self.edit = False
-            self.data_model.on_data_update(self.index, self.text)
+            self.data_model.on_data_update(self.parent.key, self.text)
             self.deselect()
         except ValueError:
             error_text = ("Only numeric value "
@@ -169,6 +135,65 @@ class NumericTextInput(SelectableView, TextInput):
             self.deselect()
 
 
+class RegisterRow(RecycleDataViewBehavior, BoxLayout):
+    """
+    One row of a :class:`RegisterListView`: address, value and formatter
+    (registers only). Rows only exist for the visible registers, the view
+    rebinds them to other keys while scrolling and the value is read from
+    the data model when a row is (re)bound.
+    """
+    key = None
+    data_model = None
+    address = None
+    value = None
+    formatter = None
+
+    def _build(self, data_model):
+        self.data_model = data_model
+        self.address = ToggleButton()
+        self.address.bind(on_release=self.on_address_release)
+        self.add_widget(self.address)
+        self.value = NumericTextInput(data_model, multiline=False)
+        self.add_widget(self.value)
+        if data_model.blockname in ['input_registers', 'holding_registers']:
+            self.formatter = DropBut(data_model)
+            self.add_widget(self.formatter)
+
+    def refresh_view_attrs(self, rv, index, data):
+        if self.data_model is None:
+            self._build(rv.data_model)
+        if data['key'] != self.key and self.value.edit:
+            # recycled while being edited, the edit is dropped
+            self.value.edit = False
+            self.value.deselect()
+        super(RegisterRow, self).refresh_view_attrs(rv, index, data)
+        self.refresh_value()
+
+    def refresh_value(self):
+        entry = self.data_model.data.get(self.key)
+        if entry is None:
+            return
+        self.address.text = self.data_model.get_address(self.key,
+                                                        as_string=True)
+        self.address.state = 'down' if self.key in self.data_model.selection \
+            else 'normal'
+        if not self.value.edit:
+            self.value.text = str(entry['value'])
+        if self.formatter is not None:
+            self.formatter.text = entry.get('formatter', 'uint16')
+
+    def on_address_release(self, *args):
+        self.data_model.toggle_selection(self.key)
+
+
+class RegisterListView(RecycleView):
+    """
+    Virtualized register list of a :class:`DataModel`, ``data`` only holds
+    the keys of the registers (``{'key': key}``) in address order.
+    """
+    data_model = ObjectProperty(None, allownone=True)
+
+
 class UpdateEventDispatcher(EventDispatcher):
     '''
     Event dispatcher for updates in Data Model
@@ -192,18 +217,18 @@ class UpdateEventDispatcher(EventDispatcher):
 
 class DataModel(GridLayout):
     """
-    Uses :class:`CompositeListItem` for list item views comprised by two
-    :class:`ListItemButton`s and one :class:`ListItemLabel`. Illustrates how
-    to construct the fairly involved args_converter used with
-    :class:`CompositeListItem`.
+    Register list of a block of the active slave, shown with a
+    :class:`RegisterListView`: widgets only exist for the visible rows, so
+    memory and redraw time don't grow with the register count. ``data`` is
+    the data map of the block ({address: {'value': .., 'formatter': ..}}),
+    the view is rebuilt when registers are added or removed, value updates
+    only refresh the visible rows.
     """
     minval = NumericProperty(0)
     maxval = NumericProperty(0)
     simulate = False
     time_interval = 1
-    dirty_thread = False
     dirty_model = False
-    simulate_timer = None
     simulate = False
     dispatcher = None
     list_view = None
@@ -214,6 +239,11 @@ class DataModel(GridLayout):
     def __init__(self, **kwargs):
         kwargs['cols'] = 3
         kwargs['size_hint'] = (1.0, 1.0)
+        self.data = {}
+        self.selection = set()
+        self._keys = []
+        self._formatter_drop_down = None
+        self._formatter_target = None
         super(DataModel, self).__init__(**kwargs)
         self.init()
 
@@ -228,23 +258,13 @@ class DataModel(GridLayout):
         self.clear_widgets()
         self.simulate = simulate
         self.time_interval = time_interval
-        dict_adapter = DictAdapter(data={},
-                                   args_converter=self.arg_converter,
-                                   selection_mode='single',
-                                   allow_empty_selection=True,
-                                   cls=CompositeListItem
-                                   )
-
-        # Use the adapter in our ListView:
-        self.list_view = ListView(adapter=dict_adapter)
+        self.data = {}
+        self.selection = set()
+        self._keys = []
+        self.list_view = RegisterListView(data_model=self)
         self.add_widget(self.list_view)
         self.dispatcher = UpdateEventDispatcher()
         self._parent = kwargs.get('_parent', None)
-        self.simulate_timer = BackgroundJob(
-            "simulation",
-            self.time_interval,
-            self._simulate_block_values
-        )
 
     def clear_widgets(self, make_dirty=False, **kwargs):
         """
@@ -269,12 +289,12 @@ class DataModel(GridLayout):
         try:
             if time_interval and int(time_interval) != self.time_interval:
                 self.time_interval = time_interval
-                if self.is_simulating:
-                    self.simulate_timer.cancel()
-                self.simulate_timer = BackgroundJob("simulation", self.time_interval,
-                                                     self._simulate_block_values)
-                self.dirty_thread = False
-                self.start_stop_simulation(self.simulate)
+            simulation = self._simulation()
+            if simulation is not None:
+                # a running simulation keeps its phase, the next tick is
+                # moved to the new interval
+                simulation.configure(self.blockname, self.time_interval,
+                                     self.minval, self.maxval)
         except ValueError:
             Logger.debug("Error while reinitializing DataModel %s" % kwargs)
 
@@ -299,66 +319,51 @@ class DataModel(GridLayout):
             offset = 40001 + offset if offset < 40001 else offset
         return str(offset) if as_string else offset
 
-    def arg_converter(self, index, data):
+    def _reset_rows(self):
         """
-        arg converter to convert data to list view
-        :param index:
-        :param data:
-        :return:
+        Rebuilds the rows of the view from the keys of the data map, after
+        registers were added or removed.
         """
-        _id = self.get_address(self.list_view.adapter.sorted_keys[index])
-
-        payload = {
-            'text': str(_id),
-            'size_hint_y': None,
-            'height': 30,
-            'cls_dicts': [
-                {
-                    'cls': ListItemButton,
-                    'kwargs': {'text': str(_id)}
-                }
-            ]
-        }
-        if self.blockname in ['input_registers', 'holding_registers']:
-            payload['cls_dicts'].extend([
-                {
-                    'cls': NumericTextInput,
-                    'kwargs': {
-                        'data_model': self,
-                        'minval': self.minval,
-                        'maxval': self.maxval,
-                        'text': str(data['value']),
-                        'multiline': False,
-                        'is_representing_cls': True,
-
-                    }
-                },
-                {
-                    'cls': DropBut,
-                    'kwargs': {
-                        'data_model': self,
-                        'text': data.get('formatter', 'uint16')
-                    }
-                }
-            ]
-            )
+        self._keys = sorted(self.data, key=int)
+        self.selection.intersection_update(self.data)
+        self.list_view.data = [{'key': key} for key in self._keys]
+
+    def _refresh_visible(self):
+        """
+        Re-reads the values of the rows on screen.
+        """
+        for row in list(self.list_view.view_adapter.views.values()):
+            row.refresh_value()
+
+    def toggle_selection(self, key):
+        if key in self.selection:
+            self.selection.discard(key)
         else:
-            payload['cls_dicts'].append(
-                {
-                    'cls': NumericTextInput,
-                    'kwargs': {
-                        'data_model': self,
-                        'minval': self.minval,
-                        'maxval': self.maxval,
-                        'text': str(data['value']),
-                        'multiline': False,
-                        'is_representing_cls': True,
-
-                    }
-                }
-            )
-
-        return payload
+            self.selection.add(key)
+
+    def open_formatters(self, button):
+        """
+        Opens the formatter list for the row of `button`.
+        """
+        if self._formatter_drop_down is None:
+            drop_down = DropDown()
+            for i in DropBut.types:
+                btn = Button(text=i, size_hint_y=None, height=45,
+                             background_color=(0.0, 0.5, 1.0, 1.0))
+                btn.bind(on_release=lambda b: drop_down.select(b.text))
+                drop_down.add_widget(btn)
+            drop_down.bind(on_select=self.on_formatter_select)
+            self._formatter_drop_down = drop_down
+        # the row may be recycled before a formatter is picked, keep the key
+        self._formatter_target = (button.parent.key, button.text)
+        self._formatter_drop_down.open(button)
+
+    def on_formatter_select(self, instance, value):
+        if self._formatter_target is None:
+            return
+        key, old = self._formatter_target
+        self._formatter_target = None
+        self.on_formatter_update(key, old, value)
 
     def add_data(self, data):
         """
@@ -369,11 +374,11 @@ class DataModel(GridLayout):
         """
         item_strings = []
         self.update_view()
-        current_keys = self.list_view.adapter.sorted_keys
+        current_keys = self._keys
         next_index = 0
         key_as_string = False
         if current_keys:
-            next_index = int(max(current_keys)) + 1
+            next_index = int(current_keys[-1]) + 1
             if not isinstance(current_keys[0], int):
                 key_as_string = True
         data = {self.get_address(int(offset) + next_index, key_as_string): v
@@ -385,9 +390,9 @@ class DataModel(GridLayout):
                 if not d.get('formatter'):
                     d['formatter'] = 'uint16'
 
-        self.list_view.adapter.data.update(data)
-        self.list_view._trigger_reset_populate()
-        return self.list_view.adapter.data, item_strings
+        self.data.update(data)
+        self._reset_rows()
+        return self.data, item_strings
 
     def delete_data(self, item_strings):
         """
@@ -395,15 +400,13 @@ class DataModel(GridLayout):
         :param item_strings:
         :return:
         """
-        selections = self.list_view.adapter.selection
         items_popped = []
-        for item in selections:
-            index_popped = item_strings.pop(item_strings.index(int(item.text)))
-            self.list_view.adapter.data.pop(int(item.text), None)
-            self.list_view.adapter.update_for_new_data()
-            self.list_view._trigger_reset_populate()
+        for key in list(self.selection):
+            index_popped = item_strings.pop(item_strings.index(int(key)))
+            self.data.pop(key, None)
             items_popped.append(index_popped)
-        return items_popped,  self.list_view.adapter.data
+        self._reset_rows()
+        return items_popped,  self.data
 
     def on_selection_change(self, item):
         pass
@@ -411,50 +414,40 @@ class DataModel(GridLayout):
     def on_data_update(self, index, data):
         """
         Call back function to update data when data is changed in the list view
-        :param index:
+        :param index: Key of the register in the data map
         :param data:
         :return:
         """
-        index = self.get_address(self.list_view.adapter.sorted_keys[index])
-        try:
-            self.list_view.adapter.data[index]
-        except KeyError:
-            index = str(index)
         if self.blockname in ['input_registers', 'holding_registers']:
-            self.list_view.adapter.data[index]['value'] = float(data)
+            self.data[index]['value'] = float(data)
         else:
-            self.list_view.adapter.data[index]['value'] = int(data)
-        self.list_view._trigger_reset_populate()
+            self.data[index]['value'] = int(data)
         data = {'event': 'sync_data',
-                'data': {index: self.list_view.adapter.data[index]}}
+                'data': {index: self.data[index]}}
         self.dispatcher.dispatch('on_update',
                                  self._parent,
                                  self.blockname,
                                  data)
+        self._refresh_visible()
 
     def on_formatter_update(self, index, old, new):
         """
         Callback function to use the formatter selected in the list view
         Args:
-            index:
-            data:
+            index: Key of the register in the data map
+            old:
+            new:
 
         Returns:
 
         """
-        index = self.get_address(self.list_view.adapter.sorted_keys[index])
-        # index = self.get_address(int(index))
-        try:
-            self.list_view.adapter.data[index]['formatter'] = new
-        except KeyError:
-            index = str(index)
-            self.list_view.adapter.data[index]['formatter'] = new
+        self.data[index]['formatter'] = new
         _data = {'event': 'sync_formatter',
                  'old_formatter': old,
-                 'data': {index: self.list_view.adapter.data[index]}}
+                 'data': {index: self.data[index]}}
         self.dispatcher.dispatch('on_update', self._parent,
                                  self.blockname, _data)
-        self.list_view._trigger_reset_populate()
+        self._refresh_visible()
 
     def update_registers(self, new_values, update_info):
         # new_values = deepcopy(new_values)
@@ -465,30 +458,34 @@ class DataModel(GridLayout):
             offset = int(offset)
             to_remove = [str(o) for o in list(range(offset+1, offset+count))]
 
-        self.list_view.adapter.update_for_new_data()
         self.refresh(new_values, to_remove)
-        return self.list_view.adapter.data
+        return self.data
 
-    def refresh(self, data={}, to_remove=None):
+    def refresh(self, data=None, to_remove=None):
         """
         Data model refresh function to update when the view when slave is
-        selected
+        selected. Rows are only rebuilt if registers were added or removed,
+        otherwise the visible rows re-read their values.
         :param data:
         :param to_remove:
         :return:
         """
         self.update_view()
-        if not data or len(data) != len(self.list_view.adapter.data):
-            self.list_view.adapter.data = data
-        else:
-            self.list_view.adapter.data.update(data)
+        if data is None:
+            data = {}
+        reset = data is not self.data or len(data) != len(self._keys)
+        self.data = data
         if to_remove:
             for entry in to_remove:
-                removed = self.list_view.adapter.data.pop(entry, None)
+                removed = self.data.pop(entry, None)
                 if not removed:
-                    self.list_view.adapter.data.pop(int(entry), None)
+                    self.data.pop(int(entry), None)
+            reset = True
         self.list_view.disabled = False
-        self.list_view._trigger_reset_populate()
+        if reset:
+            self._reset_rows()
+        else:
+            self._refresh_visible()
 
     def start_stop_simulation(self, simulate):
         """
@@ -497,55 +494,33 @@ class DataModel(GridLayout):
         :return:
         """
         self.simulate = simulate
+        simulation = self._simulation()
+        if simulation is None:
+            self.is_simulating = False
+            return
 
         if self.simulate:
-            if self.dirty_thread:
-                self.simulate_timer = BackgroundJob(
-                    "simulation",
-                    self.time_interval,
-                    self._simulate_block_values
-                )
-            self.simulate_timer.start()
-            self.dirty_thread = False
+            # the engine ticks the block on all slaves in one batch, at the
+            # interval of every range, and calls back the parent to refresh
+            # the view
+            simulation.start(self.blockname, self.time_interval, self.minval,
+                             self.maxval, self._parent.on_simulated)
             self.is_simulating = True
         else:
-            self.simulate_timer.cancel()
-            self.dirty_thread = True
+            simulation.stop(self.blockname)
             self.is_simulating = False
 
-    def _simulate_block_values(self):
-        if self.simulate:
-            data = self.list_view.adapter.data
-            if data:
-                for index, value in data.items():
-                    if self.blockname in ['input_registers',
-                                          'holding_registers']:
-                        if 'float' in data[index]['formatter']:
-                            value = round(uniform(self.minval, self.maxval), 2)
-                        else:
-                            value = randint(self.minval, self.maxval)
-                            if 'uint' in data[index]['formatter']:
-                                value = abs(value)
-                    else:
-                        value = randint(self.minval, self.maxval)
-
-                    data[index]['value'] = value
-                self.refresh(data)
-                data = {'event': 'sync_data',
-                        'data': data}
-                self.dispatcher.dispatch('on_update',
-                                         self._parent,
-                                         self.blockname,
-                                         data)
+    def _simulation(self):
+        if self._parent is None:
+            return None
+        return self._parent.simulation
 
     def reset_block_values(self):
         if not self.simulate:
-            data = self.list_view.adapter.data
+            data = self.data
             if data:
                 for index, value in data.items():
                     data[index]['value'] = 1
-                self.list_view.adapter.data.update(data)
                 self.list_view.disabled = False
-                self.list_view._trigger_reset_populate()
-                self._parent.sync_data_callback(self.blockname,
-                                                self.list_view.adapter.data)
+                self._refresh_visible()
+                self._parent.sync_data_callback(self.blockname, self.data)
@@ -6,6 +6,7 @@ import kivy
 import six
 import struct
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.properties import ObjectProperty
 from kivy.uix.boxlayout import BoxLayout
 from kivy.animation import Animation
@@ -17,11 +18,18 @@ from modbus_simulator.utils.constants import BLOCK_TYPES
 from modbus_simulator.utils.common import configure_modbus_logger
 from modbus_simulator.ui.settings import SettingIntegerWithRange
 from modbus_simulator.utils.backgroundJob import BackgroundJob
+from modbus_simulator.utils.simulation import SimulationEngine
+from modbus_simulator.utils.codec import word_count
+from modbus_simulator.utils.snapshot import (atomic_write, save_snapshot,
+                                             load_state)
+from modbus_simulator.utils.journal import Journal
+from modbus_simulator.utils.update_queue import UpdateQueue
+from modbus_simulator.utils.profiler import install_toggle
 import re
 import os
 import platform
 
-from json import load, dump
+from json import dump
 from kivy.config import Config
 from kivy.lang import Builder
 import modbus_simulator.ui.datamodel  #noqa
@@ -63,6 +71,8 @@ modbus_template = resource_filename(PARENT, "templates/modbussimu.kv")
 Builder.load_file(modbus_template)
 
 SLAVES_FILE = resource_filename(__name__, "slaves.json")
+SNAPSHOT_FILE = resource_filename(__name__, "slaves.snap")
+JOURNAL_FILE = resource_filename(__name__, "slaves.journal")
 
 
 class FloatInput(TextInput):
@@ -139,7 +149,15 @@ class Gui(BoxLayout):
     sync_modbus_thread = None
     sync_modbus_time_interval = 5
     _modbus_device = {"tcp": None, 'rtu': None}
+    _simulation = {"tcp": None, 'rtu': None}
+    # {(server, slave, block): {offset: data map key}}
+    _offset_index = {}
+    # what update_backend last wrote,
+    # {(server, slave, block): {offset: (formatter, value)}}
+    _backend_blocks = {}
     _slaves = {"tcp": None, "rtu": None}
+    journal = None
+    update_queue = None
 
     last_active_port = {"tcp": "", "serial": ""}
     active_server = "tcp"
@@ -151,6 +169,9 @@ class Gui(BoxLayout):
         self.settings.icon = settings_icon
         self.riptide_logo.app_icon = app_icon
         self.config = Config.get_configparser('app')
+        self.update_queue = UpdateQueue(
+            Clock.schedule_once,
+            max_rate=float(self.config.get("Simulation", "ui refresh rate")))
         self.slave_list.adapter.bind(on_selection_change=self.select_slave)
         self.data_model_loc.disabled = True
         self.slave_pane.disabled = True
@@ -199,6 +220,14 @@ class Gui(BoxLayout):
     def modbus_device(self, value):
         self._modbus_device[self.active_server] = value
 
+    @property
+    def simulation(self):
+        return self._simulation[self.active_server]
+
+    @simulation.setter
+    def simulation(self, value):
+        self._simulation[self.active_server] = value
+
     @property
     def slave(self):
         return self._slaves[self.active_server]
@@ -303,6 +332,17 @@ class Gui(BoxLayout):
                 self.config.get('Modbus Serial', "timeout")))
         elif self.active_server == 'tcp':
             kwargs['address'] = self.config.get('Modbus Tcp', 'ip')
+            if USE_PYMODBUS:
+                kwargs['use_asyncio'] = bool(eval(
+                    self.config.get('Modbus Tcp', 'asyncio')))
+        shared_image = self.config.get('Modbus Protocol',
+                                       'shared image').strip()
+        if USE_PYMODBUS and shared_image:
+            kwargs['shared_image'] = shared_image
+            kwargs['block_size'] = self.block_start + self.block_size
+        elif USE_PYMODBUS and bool(eval(self.config.get('Modbus Protocol',
+                                                        'sparse blocks'))):
+            kwargs['sparse'] = True
         if not self.modbus_device:
             create_new = True
         else:
@@ -315,11 +355,22 @@ class Gui(BoxLayout):
             else:
                 create_new = True
         if create_new:
-
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if self.modbus_device and hasattr(self.modbus_device, 'close'):
+                self.modbus_device.close()
+            if self.simulation is not None:
+                self.simulation.stop()
             self.modbus_device = ModbusSimu(server=self.active_server,
                                             port=self.port.text,
                                             **kwargs
                                             )
+            self.simulation = SimulationEngine(self.modbus_device,
+                                               byte_order=self.byte_order,
+                                               word_order=self.word_order)
+            if bool(eval(self.config.get("State", "journal"))):
+                self.journal = Journal(JOURNAL_FILE, self.modbus_device)
             if self.slave is None:
 
                 adapter = ListAdapter(
@@ -347,8 +398,20 @@ class Gui(BoxLayout):
             self._stop_server()
             btn.text = "Start"
 
+    def _start_journal(self, recover=False):
+        """
+        Starts journaling register writes, replaying the journal of the
+        previous run first if `recover`.
+        """
+        if self.journal is None or self.journal.running:
+            return
+        if recover:
+            self.journal.recover()
+        self.journal.start()
+
     def _start_server(self):
         self._create_modbus_device()
+        self._start_journal()
 
         self.modbus_device.start()
         self.server_running = True
@@ -449,6 +512,8 @@ class Gui(BoxLayout):
                                              block_name, block_type,
                                              self.block_start,
                                              self.block_size)
+            if self.journal is not None:
+                self.journal.track(slave_to_add)
 
             data.append(str(slave_to_add))
         self.slave_list.adapter.data = data
@@ -511,7 +576,14 @@ class Gui(BoxLayout):
         slave = self.active_slave
         ct = self.data_models.current_tab
         for item in selected:
+            if self.journal is not None:
+                self.journal.untrack(int(item.text))
             self.modbus_device.remove_slave(int(item.text))
+            self.simulation.remove_slave(int(item.text))
+            self._offset_index.clear()
+            for blockname in BLOCK_TYPES:
+                self._backend_blocks.pop(
+                    (self.active_server, item.text, blockname), None)
             self.slave_list.adapter.data.remove(item.text)
             self.slave_list._trigger_reset_populate()
             ct.content.clear_widgets(make_dirty=True)
@@ -638,6 +710,13 @@ class Gui(BoxLayout):
             _data['data'] = dict(ct.content.update_registers(_data['data'],
                                                              _updated)
             )
+            self.simulation.set_block(int(self.active_slave), current_tab,
+                                      _data['data'])
+            self._offset_index.pop(
+                (self.active_server, self.active_slave, current_tab), None)
+            self._backend_blocks[
+                (self.active_server, self.active_slave, current_tab)
+            ] = self._block_entries(current_tab, _data['data'])
 
         except KeyError:
             pass
@@ -682,26 +761,149 @@ class Gui(BoxLayout):
 
     def refresh(self):
         for child in self.data_models.tab_list:
-            dm = self.data_map[self.active_slave][MAP[child.text]]['data']
+            blockname = MAP[child.text]
+            self._update_simulated_values(self.active_slave, blockname)
+            dm = self.data_map[self.active_slave][blockname]['data']
             child.content.refresh(dm)
 
+    def queue_refresh(self, blockname, slave_id=None):
+        """
+        Refreshes the view of `blockname` from the main thread, safe to call
+        from any thread. Refreshes of a block posted before the next frame
+        are merged into one.
+        """
+        key = (self.active_server, slave_id or self.active_slave, blockname)
+        self.update_queue.post(key, self._refresh_block, *key)
+
+    def _refresh_block(self, server, slave_id, blockname):
+        if server != self.active_server or slave_id is None or \
+                slave_id != self.active_slave or \
+                slave_id not in self.data_map:
+            # slave deselected or server switched since the post
+            return
+        for child in self.data_models.tab_list:
+            if MAP[child.text] == blockname:
+                child.content.refresh(
+                    self.data_map[slave_id][blockname]['data'])
+
+    def _update_simulated_values(self, slave_id, blockname):
+        """
+        Copies the values written by the last simulation tick of a block
+        into the data map, the simulation only updates the data map of the
+        active slave.
+        """
+        if self.simulation is None:
+            return
+        simulated = self.simulation.last_values(slave_id, blockname)
+        if simulated:
+            _data = self.data_map[slave_id][blockname]['data']
+            for k, v in zip(*simulated):
+                if k in _data:
+                    _data[k]['value'] = v
+
+    def on_simulated(self, blockname, ticked):
+        """
+        Simulation tick callback, on the scheduler thread: the new values
+        are already written to the modbus device, the values of the active
+        slave are copied to its data map and a view refresh is queued.
+        """
+        active_slave = self.active_slave
+        if not active_slave or int(active_slave) not in ticked:
+            return
+        _data = self.data_map[active_slave][blockname]['data']
+        for k, v in zip(*ticked[int(active_slave)]):
+            if k in _data:
+                _data[k]['value'] = v
+        self.queue_refresh(blockname, active_slave)
+
+    def _block_entries(self, blockname, data):
+        """
+        {offset: (formatter, value)} of a data map block, formatter is None
+        for coils and discrete inputs.
+        """
+        calc_offset = self.modbus_device._calc_offset
+        if blockname in ['holding_registers', 'input_registers']:
+            return {calc_offset(blockname, k): (v.get('formatter', 'uint16'),
+                                                float(v['value']))
+                    for k, v in data.items()}
+        return {calc_offset(blockname, k): (None, int(v['value']))
+                for k, v in data.items()}
+
     def update_backend(self, slave_id, blockname, new_data):
-        self.modbus_device.remove_block(slave_id, blockname)
-        self.modbus_device.add_block(slave_id, blockname,
-                                     BLOCK_TYPES[blockname], 0,
-                                     self.block_size)
-        for k, v in new_data.items():
-            if blockname in ['holding_registers', 'input_registers']:
-                self.modbus_device.encode(
-                    slave_id,
-                    blockname,
-                    k,
-                    float(v['value']),
-                    v['formatter']
-                )
-            else:
-                self.modbus_device.set_values(slave_id, blockname,
-                                              k, int(v['value']))
+        """
+        Writes the difference between `new_data` and what was last written
+        for the block: registers of removed entries are cleared and added or
+        changed entries are encoded, in contiguous runs. The block is never
+        reset, clients don't see it empty while it is updated.
+        """
+        cache_key = (self.active_server, str(slave_id), blockname)
+        old = self._backend_blocks.get(cache_key, {})
+        new = self._block_entries(blockname, new_data)
+
+        writes = {}
+        for offset, entry in new.items():
+            if old.get(offset) != entry:
+                writes[offset] = entry
+        for offset, (formatter, _) in old.items():
+            if new.get(offset) == old[offset]:
+                continue
+            # clear the registers of the old entry not covered by a new one
+            for word in xrange(offset, offset + word_count(formatter)):
+                if word in writes or word in new:
+                    continue
+                if any(word - back in new and
+                       word_count(new[word - back][0]) > back
+                       for back in xrange(1, 4)):
+                    continue
+                writes[word] = ('uint16', 0) if formatter else (None, 0)
+
+        self._write_runs(slave_id, blockname, writes)
+        self._backend_blocks[cache_key] = new
+        self.simulation.set_block(slave_id, blockname, new_data)
+        self._offset_index.pop((self.active_server, str(slave_id), blockname),
+                               None)
+
+    def _load_block_image(self, slave_id, blockname, data, first,
+                          registers):
+        """
+        Same as :meth:`update_backend` on a new block, with the registers
+        of a state snapshot written in one go.
+        """
+        self.modbus_device.set_values(slave_id, blockname, first, registers)
+        self._backend_blocks[(self.active_server, str(slave_id),
+                              blockname)] = self._block_entries(blockname,
+                                                                data)
+        self.simulation.set_block(slave_id, blockname, data)
+        self._offset_index.pop((self.active_server, str(slave_id), blockname),
+                               None)
+
+    def _write_runs(self, slave_id, blockname, writes):
+        """
+        Writes {offset: (formatter, value)} with one call per run of
+        contiguous registers.
+        """
+        run = []
+        end = None
+        for offset in sorted(writes):
+            if run and offset != end:
+                self._write_run(slave_id, blockname, run)
+                run = []
+            formatter, value = writes[offset]
+            run.append((offset, formatter, value))
+            end = offset + (word_count(formatter) if formatter else 1)
+        if run:
+            self._write_run(slave_id, blockname, run)
+
+    def _write_run(self, slave_id, blockname, run):
+        start = run[0][0]
+        if blockname in ['holding_registers', 'input_registers']:
+            self.modbus_device.encode_range(
+                slave_id, blockname, start, [value for _, _, value in run],
+                [(offset - start, formatter) for offset, formatter, _ in run]
+            )
+        else:
+            self.modbus_device.set_values(slave_id, blockname, start,
+                                          [value for _, _, value in run])
 
     def change_simulation_settings(self, **kwargs):
         self.data_model_coil.reinit(**kwargs)
@@ -739,6 +941,10 @@ class Gui(BoxLayout):
         self.data_model_input_registers.start_stop_simulation(self.simulating)
         self.data_model_holding_registers.start_stop_simulation(
             self.simulating)
+        if not self.simulating and self.simulation is not None:
+            for slave_id in self.data_map:
+                for blockname in BLOCK_TYPES:
+                    self._update_simulated_values(slave_id, blockname)
 
     def reset_simulation(self, *args):
         if not self.simulating:
@@ -747,9 +953,42 @@ class Gui(BoxLayout):
             self.data_model_input_registers.reset_block_values()
             self.data_model_holding_registers.reset_block_values()
 
+    def _block_index(self, slave_id, block_name):
+        """
+        {offset: key} of the data map of a block, cached until the block is
+        updated through update_backend or a formatter change
+        """
+        cache_key = (self.active_server, slave_id, block_name)
+        index = self._offset_index.get(cache_key)
+        if index is None:
+            calc_offset = self.modbus_device._calc_offset
+            index = {calc_offset(block_name, k): k
+                     for k in self.data_map[slave_id][block_name]['data']}
+            self._offset_index[cache_key] = index
+        return index
+
+    def _dirty_entries(self, slave_id, block_name):
+        """
+        Data map entries overlapping the ranges written to the block since
+        the last sync.
+        """
+        dirty = self.modbus_device.pop_dirty(int(slave_id), block_name)
+        data = self.data_map[slave_id][block_name]['data']
+        if not dirty or not data:
+            return
+        index = self._block_index(slave_id, block_name)
+        for start, count in dirty:
+            # a 64 bit value starting up to 3 registers before the range
+            # overlaps it
+            for offset in xrange(max(start - 3, 0), start + count):
+                k = index.get(offset)
+                if k is not None and k in data:
+                    yield k, data[k]
+
     def _sync_modbus_block_values(self):
         """
-        track external changes in modbus block values and sync GUI
+        track external changes in modbus block values and sync GUI, only
+        entries in ranges written since the last sync are decoded
         ToDo:
         A better way to update GUI when simulation is on going  !!
         """
@@ -758,7 +997,8 @@ class Gui(BoxLayout):
                 _data_map = self.data_map[self.active_slave]
                 for block_name, value in _data_map.items():
                     updated = {}
-                    for k, v in value['data'].items():
+                    for k, v in self._dirty_entries(self.active_slave,
+                                                    block_name):
                         if block_name in ['input_registers',
                                           'holding_registers']:
                             actual_data, count = self.modbus_device.decode(
@@ -781,7 +1021,7 @@ class Gui(BoxLayout):
                             pass
                     if updated:
                         value['data'].update(updated)
-                        self.refresh()
+                        self.queue_refresh(block_name, self.active_slave)
 
     def _backup(self):
         if self.slave is not None:
@@ -808,98 +1048,119 @@ class Gui(BoxLayout):
         self.slave_list._trigger_reset_populate()
 
     def save_state(self):
-        with open(SLAVES_FILE, 'w') as f:
-            slave = [int(slave_no) for slave_no in self.slave_list.adapter.data]
-            slaves_memory = []
-            for slaves, mem in self.data_map.items():
-                for name, value in mem.items():
-                    if len(value['data']) != 0:
-                        slaves_memory.append((slaves, name,
-                                              value['data']
-                                              ))
-
-            dump(dict(
-                slaves_list=slave, active_server=self.active_server,
-                port=self.port.text, slaves_memory=slaves_memory
-            ), f, indent=4)
+        slave = [int(slave_no) for slave_no in self.slave_list.adapter.data]
+        slaves_memory = []
+        for slaves, mem in self.data_map.items():
+            for name, value in mem.items():
+                if len(value['data']) != 0:
+                    slaves_memory.append((slaves, name,
+                                          value['data']
+                                          ))
+        state = dict(
+            slaves_list=slave, active_server=self.active_server,
+            port=self.port.text, slaves_memory=slaves_memory
+        )
+        if self.config.get("State", "state format") == "json":
+            with atomic_write(SLAVES_FILE) as f:
+                dump(state, f, indent=4)
+            return
+        save_snapshot(SNAPSHOT_FILE, state, ModbusSimu._calc_offset,
+                      self.byte_order, self.word_order,
+                      compress=bool(eval(self.config.get("State",
+                                                         "compress state"))))
+
+    def _state_file(self):
+        """
+        State file of the configured format, the other one if missing.
+        """
+        files = [SNAPSHOT_FILE, SLAVES_FILE]
+        if self.config.get("State", "state format") == "json":
+            files.reverse()
+        for state_file in files:
+            if os.path.isfile(state_file):
+                return state_file
 
     def load_state(self):
+        state_file = self._state_file()
         if not bool(eval(self.config.get("State", "load state"))) or \
-                not os.path.isfile(SLAVES_FILE):
+                state_file is None:
             return
 
-        with open(SLAVES_FILE, 'r') as f:
-            try:
-                data = load(f)
-            except ValueError as e:
-                self.show_error(
-                    "LoadError: Failed to load previous simulation state : %s "
-                    % e.message
-                )
-                return
+        try:
+            data = load_state(state_file)
+        except ValueError as e:
+            self.show_error(
+                "LoadError: Failed to load previous simulation state : %s "
+                % e
+            )
+            return
 
-            if ('active_server' not in data
-                    or 'port' not in data
-                    or 'slaves_list' not in data
-                    or 'slaves_memory' not in data):
-                self.show_error("LoadError: Failed to load previous "
-                                "simulation state : JSON Key Missing")
-                return
+        slaves_list = data['slaves_list']
+        if not len(slaves_list):
+            return
 
-            slaves_list = data['slaves_list']
-            if not len(slaves_list):
-                return
+        if data['active_server'] == 'tcp':
+            self.tcp.active = True
+            self.serial.active = False
+            self.interface_settings.current = self.tcp
+        else:
+            self.tcp.active = False
+            self.serial.active = True
+            self.interface_settings.current = self.serial
+
+        self.active_server = data['active_server']
+        self.port.text = data['port']
+        self.word_order = self.config.get("Modbus Protocol", "word order")
+        self.byte_order = self.config.get("Modbus Protocol", "byte order")
+        self._create_modbus_device()
 
-            if data['active_server'] == 'tcp':
-                self.tcp.active = True
-                self.serial.active = False
-                self.interface_settings.current = self.tcp
+        start_slave = 0
+        temp_list = []
+        slave_count = 1
+        for first, second in zip(slaves_list[:-1], slaves_list[1:]):
+            if first+1 == second:
+                slave_count += 1
             else:
-                self.tcp.active = False
-                self.serial.active = True
-                self.interface_settings.current = self.serial
-
-            self.active_server = data['active_server']
-            self.port.text = data['port']
-            self.word_order = self.config.get("Modbus Protocol", "word order")
-            self.byte_order = self.config.get("Modbus Protocol", "byte order")
-            self._create_modbus_device()
-
-            start_slave = 0
-            temp_list = []
-            slave_count = 1
-            for first, second in zip(slaves_list[:-1], slaves_list[1:]):
-                if first+1 == second:
-                    slave_count += 1
-                else:
-                    temp_list.append((slaves_list[start_slave], slave_count))
-                    start_slave += slave_count
-                    slave_count = 1
-            temp_list.append((slaves_list[start_slave], slave_count))
-
-            for start_slave, slave_count in temp_list:
-                self._add_slaves(
-                    self.slave_list.adapter.selection,
-                    self.slave_list.adapter.data,
-                    (True, start_slave, slave_count)
-                )
+                temp_list.append((slaves_list[start_slave], slave_count))
+                start_slave += slave_count
+                slave_count = 1
+        temp_list.append((slaves_list[start_slave], slave_count))
+
+        for start_slave, slave_count in temp_list:
+            self._add_slaves(
+                self.slave_list.adapter.selection,
+                self.slave_list.adapter.data,
+                (True, start_slave, slave_count)
+            )
 
-            memory_map = {
-                'coils': self.data_models.tab_list[3],
-                'discrete_inputs': self.data_models.tab_list[2],
-                'input_registers': self.data_models.tab_list[1],
-                'holding_registers': self.data_models.tab_list[0]
-            }
-            slaves_memory = data['slaves_memory']
-            for slave_memory in slaves_memory:
-                active_slave, memory_type, memory_data = slave_memory
-                _data = self.data_map[active_slave][memory_type]
-                _data['data'].update(memory_data)
-                _data['item_strings'] = list(sorted(memory_data.keys()))
-                self.update_backend(int(active_slave), memory_type, memory_data)
-                # self._update_data_models(active_slave,
-                #                          memory_map[memory_type],
-                #                          memory_data)
+        memory_map = {
+            'coils': self.data_models.tab_list[3],
+            'discrete_inputs': self.data_models.tab_list[2],
+            'input_registers': self.data_models.tab_list[1],
+            'holding_registers': self.data_models.tab_list[0]
+        }
+        images = {}
+        if data.get('byte_order') == self.byte_order and \
+                data.get('word_order') == self.word_order:
+            # snapshot taken with the same byte/word order, bulk load
+            images = dict(((str(slave_id), block_name), (first, registers))
+                          for slave_id, block_name, first, registers
+                          in data.get('images', []))
+        slaves_memory = data['slaves_memory']
+        for slave_memory in slaves_memory:
+            active_slave, memory_type, memory_data = slave_memory
+            _data = self.data_map[active_slave][memory_type]
+            _data['data'].update(memory_data)
+            _data['item_strings'] = list(sorted(memory_data.keys()))
+            image = images.get((active_slave, memory_type))
+            if image is not None:
+                self._load_block_image(int(active_slave), memory_type,
+                                       memory_data, *image)
+            else:
+                self.update_backend(int(active_slave), memory_type,
+                                    memory_data)
+        # values written after the state was saved (crash)
+        self._start_journal(recover=True)
 
 
 setting_panel = """
@@ -915,6 +1176,13 @@ setting_panel = """
     "section": "Modbus Tcp",
     "key": "IP"
   },
+  {
+    "type": "bool",
+    "title": "Asyncio server",
+    "desc": "Serve all tcp clients from a single asyncio event loop instead of a thread per client (pymodbus backend, takes effect on next server start)",
+    "section": "Modbus Tcp",
+    "key": "asyncio"
+  },
   {
     "type": "title",
     "title": "Modbus Serial Settings"
@@ -1051,6 +1319,20 @@ setting_panel = """
     "key": "reg max",
     "range": [0,65535]
   },
+  {
+    "type": "string",
+    "title": "Shared Image",
+    "desc": "Publish all registers in this shared memory segment (or file, if a path) for local tools, empty to disable (pymodbus backend, block size is fixed while serving)",
+    "section": "Modbus Protocol",
+    "key": "shared image"
+  },
+  {
+    "type": "bool",
+    "title": "Sparse Blocks",
+    "desc": "Keep registers in pages allocated on first write, memory follows the addresses in use instead of the block size (pymodbus backend, ignored with a shared image)",
+    "section": "Modbus Protocol",
+    "key": "sparse blocks"
+  },
   {
     "type": "title",
     "title": "Logging"
@@ -1108,6 +1390,13 @@ setting_panel = """
     "section": "Simulation",
     "key": "time interval"
   },
+  {
+    "type": "numeric",
+    "title": "UI refresh rate",
+    "desc": "Maximum number of register view refreshes per second, updates in between are merged",
+    "section": "Simulation",
+    "key": "ui refresh rate"
+  },
   {
     "type": "title",
     "title": "State"
@@ -1118,6 +1407,28 @@ setting_panel = """
     "desc": "Whether the previous state should be loaded or not, if not the original state is loaded",
     "section": "State",
     "key": "load state"
+  },
+  {
+    "type": "options",
+    "title": "State Format",
+    "desc": "Save the state as a binary snapshot (fast to load) or as JSON, either is loaded",
+    "section": "State",
+    "key": "state format",
+    "options": ["binary", "json"]
+  },
+  {
+    "type": "bool",
+    "title": "Compress State",
+    "desc": "Compress binary state snapshots",
+    "section": "State",
+    "key": "compress state"
+  },
+  {
+    "type": "bool",
+    "title": "Journal",
+    "desc": "Journal register writes to disk while running, values are recovered after a crash (takes effect on next server start)",
+    "section": "State",
+    "key": "journal"
   }
 
 ]
@@ -1128,6 +1439,7 @@ class ModbusSimuApp(App):
     '''The kivy App that runs the main root. All we do is build a Gui
     widget into the root.'''
     gui = None
+    profiler = None
     title = "Modbus Simulator"
     settings_cls = None
     use_kivy_settings = True
@@ -1138,12 +1450,16 @@ class ModbusSimuApp(App):
             modbus_log=os.path.join(self.user_data_dir, 'modbus.log')
         )
         self.gui.load_state()
+        # SIGUSR2 toggles a sampling profiler, profiles go to the data dir
+        self.profiler = install_toggle(self.user_data_dir)
         return self.gui
 
     def on_pause(self):
         return True
 
     def on_stop(self):
+        if self.profiler is not None:
+            self.profiler.finish()
         if self.gui.server_running:
             if self.gui.simulating:
                 self.gui.simulating = False
@@ -1152,6 +1468,10 @@ class ModbusSimuApp(App):
         self.gui.sync_modbus_thread.cancel()
         self.config.write()
         self.gui.save_state()
+        if self.gui.journal is not None:
+            self.gui.journal.close()
+        if hasattr(self.gui.modbus_device, 'close'):
+            self.gui.modbus_device.close()
 
     def show_settings(self, btn):
         self.open_settings()
@@ -1161,6 +1481,7 @@ class ModbusSimuApp(App):
         config.add_section('Modbus Protocol')
         config.add_section('Modbus Serial')
         config.set('Modbus Tcp', "ip", '127.0.0.1')
+        config.set('Modbus Tcp', "asyncio", 0)
         config.set('Modbus Protocol', "block start", 0)
         config.set('Modbus Protocol', "block size", 100)
         config.set('Modbus Protocol', "byte order", 'big')
@@ -1169,6 +1490,8 @@ class ModbusSimuApp(App):
         config.set('Modbus Protocol', "bin max", 1)
         config.set('Modbus Protocol', "reg min", 0)
         config.set('Modbus Protocol', "reg max", 65535)
+        config.set('Modbus Protocol', "shared image", '')
+        config.set('Modbus Protocol', "sparse blocks", 0)
         config.set('Modbus Serial', "baudrate", 9600)
         config.set('Modbus Serial', "bytesize", "8")
         config.set('Modbus Serial', "parity", 'N')
@@ -1191,9 +1514,13 @@ class ModbusSimuApp(App):
 
         config.add_section('Simulation')
         config.set('Simulation', 'time interval', 1)
+        config.set('Simulation', 'ui refresh rate', 10)
 
         config.add_section('State')
         config.set('State', 'load state', 1)
+        config.set('State', 'state format', 'binary')
+        config.set('State', 'compress state', 1)
+        config.set('State', 'journal', 1)
 
     def build_settings(self, settings):
         settings.register_type("numeric_range", SettingIntegerWithRange)
@@ -1206,6 +1533,8 @@ class ModbusSimuApp(App):
         token = section, key
         if token == ("Simulation", "time interval"):
             self.gui.change_simulation_settings(time_interval=eval(value))
+        if token == ("Simulation", "ui refresh rate"):
+            self.gui.update_queue.max_rate = value
         if section == "Modbus Protocol" and key in ("bin max",
                                            "bin min", "reg max",
                                            "reg min", "override",
@@ -0,0 +1,206 @@
+"""
+Asyncio Modbus TCP server
+=========================
+
+Serves every client connection from a single event loop instead of
+one thread per connection (``ModbusTcpServer``). Requests are decoded and
+executed with the same pymodbus framer, decoder and server context, so it
+can be swapped in behind :class:`ModbusSimu` without touching the datastore.
+
+Python 3 only.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import asyncio
+import logging
+import socket
+import threading
+import time
+import traceback
+
+from pymodbus.constants import Defaults
+from pymodbus.datastore import ModbusServerContext
+from pymodbus.device import ModbusControlBlock, ModbusDeviceIdentification
+from pymodbus.exceptions import NoSuchSlaveException
+from pymodbus.factory import ServerDecoder
+from pymodbus.pdu import ModbusExceptions as merror
+from pymodbus.transaction import ModbusSocketFramer
+
+log = logging.getLogger(__name__)
+
+_timer = time.perf_counter
+
+
+class ModbusTcpProtocol(asyncio.Protocol):
+    """
+    One instance per client connection, all of them running on the server
+    event loop.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.framer = server.framer(server.decoder, client=None)
+        self.received = 0.0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.clients.add(self)
+        if self.server.metrics is not None:
+            self.server.metrics.connection_opened()
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        log.debug("Client Connected [%s]",
+                  transport.get_extra_info('peername'))
+
+    def connection_lost(self, exc):
+        self.server.clients.discard(self)
+        if self.server.metrics is not None:
+            self.server.metrics.connection_closed()
+        log.debug("Client Disconnected [%s]",
+                  self.transport.get_extra_info('peername'))
+
+    def data_received(self, data):
+        context = self.server.context
+        self.received = _timer()
+        if self.server.metrics is not None:
+            self.server.metrics.received(len(data))
+        try:
+            self.framer.processIncomingPacket(data, self.execute,
+                                              context.slaves(),
+                                              single=context.single)
+        except Exception:
+            log.error("Socket exception occurred %s", traceback.format_exc())
+            self.framer.resetFrame()
+
+    def execute(self, request):
+        """
+        Same as :meth:`ModbusBaseRequestHandler.execute`, but the response
+        is queued on the transport instead of a blocking send.
+        """
+        metrics = self.server.metrics
+        timing = self.server.request_timing
+        if timing is not None and not timing.hooks:
+            timing = None
+        if metrics is not None or timing is not None:
+            started = _timer()
+        try:
+            context = self.server.context[request.unit_id]
+            response = request.execute(context)
+        except NoSuchSlaveException:
+            log.debug("requested slave does not exist: %s", request.unit_id)
+            if self.server.ignore_missing_slaves:
+                return
+            response = request.doException(merror.GatewayNoResponse)
+        except Exception as ex:
+            log.debug("Datastore unable to fulfill request: %s; %s",
+                      ex, traceback.format_exc())
+            response = request.doException(merror.SlaveFailure)
+        response.transaction_id = request.transaction_id
+        response.unit_id = request.unit_id
+        if timing is not None:
+            executed = _timer()
+        if response.should_respond:
+            packet = self.framer.buildPacket(response)
+            self.transport.write(packet)
+            if metrics is not None:
+                metrics.sent(len(packet))
+        if metrics is not None or timing is not None:
+            done = _timer()
+        if metrics is not None:
+            metrics.record(response.unit_id, response.function_code,
+                           done - started)
+        if timing is not None:
+            timing.record(response.unit_id, response.function_code, request,
+                          self.received, started, executed, done)
+
+
+class AsyncModbusTcpServer(object):
+    """
+    Drop in replacement for :class:`ModbusTcpServer`. The listening socket is
+    bound on creation (like socketserver), ``serve_forever`` runs the event
+    loop in the calling thread and ``shutdown`` may be called from any
+    other thread.
+
+    With ``reuse_port`` the socket is bound with ``SO_REUSEPORT``, so several
+    processes can listen on the same port and the kernel spreads incoming
+    connections across them.
+    """
+    backlog = 1024
+
+    def __init__(self, context, framer=None, identity=None, address=None,
+                 allow_reuse_address=True, reuse_port=False, **kwargs):
+        self.decoder = ServerDecoder()
+        self.framer = framer or ModbusSocketFramer
+        self.context = context or ModbusServerContext()
+        self.control = ModbusControlBlock()
+        self.address = address or ("", Defaults.Port)
+        self.ignore_missing_slaves = kwargs.get('ignore_missing_slaves',
+                                                Defaults.IgnoreMissingSlaves)
+        if isinstance(identity, ModbusDeviceIdentification):
+            self.control.Identity.update(identity)
+        self.clients = set()
+        # Metrics instance, set by the owner to record requests
+        self.metrics = kwargs.get('metrics')
+        # RequestTiming instance, same
+        self.request_timing = kwargs.get('request_timing')
+        self.loop = None
+        self._server = None
+        self._stopped = threading.Event()
+        self._stopped.set()
+        self.allow_reuse_address = allow_reuse_address
+        self.reuse_port = reuse_port
+        self.socket = None
+        self.server_bind()
+
+    def server_bind(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.allow_reuse_address:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(self.address)
+        self.socket.listen(self.backlog)
+        self.socket.setblocking(False)
+
+    def serve_forever(self):
+        self._stopped.clear()
+        if self.socket is None:
+            # The listening socket is owned and closed by the event loop
+            # server, rebind when restarted
+            self.server_bind()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self._server = self.loop.run_until_complete(
+                self.loop.create_server(lambda: ModbusTcpProtocol(self),
+                                        sock=self.socket,
+                                        backlog=self.backlog))
+            log.debug("Started asyncio modbus server on %s:%s",
+                      *self.address)
+            self.loop.run_forever()
+        finally:
+            for client in list(self.clients):
+                client.transport.close()
+            if self._server is not None:
+                self._server.close()
+                self.loop.run_until_complete(self._server.wait_closed())
+                self._server = None
+                self.socket = None
+            self.loop.close()
+            self._stopped.set()
+
+    def shutdown(self):
+        """
+        Stops the event loop and waits for the serving thread to wind down.
+        """
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._stopped.wait()
+
+    def server_close(self):
+        log.debug("Modbus server stopped")
+        self.shutdown()
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
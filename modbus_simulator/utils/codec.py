@@ -0,0 +1,214 @@
+"""
+Register codecs
+===============
+
+Converts between register values (unsigned 16 bit words) and typed values
+for a run of values sharing one formatter, with a single ``struct`` call
+each way. The register layout matches pymodbus' ``BinaryPayloadBuilder``
+and ``BinaryPayloadDecoder``:
+
+* the value is packed network ordered and split in words,
+* the words are reversed for little endian word order,
+* the bytes of every word are swapped for little endian byte order.
+
+Packing the value with the word order endianness and reading it back as
+words, big endian when byte and word order agree and little endian
+otherwise, gives the same layout in one go. As the word order endianness
+applies to each value on its own, a span mixing formatters (with gaps as
+pad bytes) is still a single ``struct`` format.
+"""
+from __future__ import absolute_import
+
+import struct
+
+FORMATTERS = {
+    'int16': 'h',
+    'int32': 'i',
+    'int64': 'q',
+    'uint16': 'H',
+    'uint32': 'I',
+    'uint64': 'Q',
+    'float32': 'f',
+    'float64': 'd',
+}
+
+WORD_COUNT = {formatter: struct.calcsize(str(fmt)) // 2
+              for formatter, fmt in FORMATTERS.items()}
+
+LIMITS = {
+    'int16': (-2 ** 15, 2 ** 15 - 1),
+    'int32': (-2 ** 31, 2 ** 31 - 1),
+    'int64': (-2 ** 63, 2 ** 63 - 1),
+    'uint16': (0, 2 ** 16 - 1),
+    'uint32': (0, 2 ** 32 - 1),
+    'uint64': (0, 2 ** 64 - 1),
+    'float32': (-3.4028234663852886e+38, 3.4028234663852886e+38),
+    'float64': (-1.7976931348623157e+308, 1.7976931348623157e+308),
+}
+
+# codecs are cached per layout, the cache is dropped when it grows past
+# _MAX_CODECS (run lengths keep changing while a map is being edited)
+_CODECS = {}
+_MAX_CODECS = 1024
+
+
+def is_big(order):
+    """
+    Byte/word order as used in the settings ('big'/'little') or as a
+    pymodbus ``Endian`` value.
+    """
+    return order in ('big', '>', '!')
+
+
+def word_count(formatter):
+    return WORD_COUNT.get(formatter, 1)
+
+
+class RegisterCodec(object):
+    """
+    Encodes/decodes ``count`` consecutive values of one formatter.
+    """
+    __slots__ = ('formatter', 'count', 'words', 'value_struct',
+                 'register_struct')
+
+    def __init__(self, formatter, count=1, byte_order='big',
+                 word_order='big'):
+        word_big = is_big(word_order)
+        same = is_big(byte_order) == word_big
+        self.formatter = formatter
+        self.count = count
+        self.words = WORD_COUNT[formatter] * count
+        self.value_struct = struct.Struct(str("%s%d%s" % (
+            ">" if word_big else "<", count, FORMATTERS[formatter])))
+        self.register_struct = struct.Struct(str("%s%dH" % (
+            ">" if same else "<", self.words)))
+
+    def encode(self, values):
+        """
+        :param values: ``count`` values
+        :return: tuple of registers
+        """
+        try:
+            packed = self.value_struct.pack(*values)
+        except struct.error:
+            if 'int' not in self.formatter:
+                raise
+            # float values for an integer formatter, same as ModbusSimu.encode
+            packed = self.value_struct.pack(*[int(v) for v in values])
+        return self.register_struct.unpack(packed)
+
+    def decode(self, registers):
+        """
+        :param registers: ``words`` registers
+        :return: tuple of values
+        """
+        return self.value_struct.unpack(self.register_struct.pack(*registers))
+
+
+class LayoutCodec(object):
+    """
+    Encodes/decodes values of mixed formatters at given register offsets.
+
+    :param layout: list of (offset, formatter), offsets relative to the start
+        of the span, entries must not overlap
+    """
+    def __init__(self, layout, byte_order='big', word_order='big'):
+        word_big = is_big(word_order)
+        value_endian = ">" if word_big else "<"
+        self.register_endian = ">" if is_big(byte_order) == word_big else "<"
+        self.formatters = [formatter for _, formatter in layout]
+        order = sorted(range(len(layout)), key=lambda i: layout[i][0])
+        # values are handed in layout order, the struct wants offset order
+        self.order = None if order == list(range(len(layout))) else order
+
+        fmt = []
+        # contiguous runs for encoding, [offset, first index, last index]
+        self.segments = []
+        end = 0
+        for position, index in enumerate(order):
+            offset, formatter = layout[index]
+            if offset < end:
+                raise ValueError("Overlapping entry at offset %s" % offset)
+            if offset > end or not self.segments:
+                if offset > end:
+                    fmt.append("%dx" % ((offset - end) * 2))
+                self.segments.append([offset, position, position + 1, []])
+            else:
+                self.segments[-1][2] = position + 1
+            self.segments[-1][3].append(FORMATTERS[formatter])
+            fmt.append(FORMATTERS[formatter])
+            end = offset + WORD_COUNT[formatter]
+        self.words = end
+        self.value_struct = struct.Struct(str(value_endian + "".join(fmt)))
+        self.register_struct = struct.Struct(str("%s%dH" % (
+            self.register_endian, self.words)))
+        self.segments = [
+            (offset, first, last,
+             struct.Struct(str(value_endian + "".join(fmts))),
+             struct.Struct(str("%s%dH" % (self.register_endian,
+                                          struct.calcsize(
+                                              str("<" + "".join(fmts))) // 2))))
+            for offset, first, last, fmts in self.segments]
+
+    def decode(self, registers):
+        """
+        :param registers: ``words`` registers of the span
+        :return: list of values in layout order
+        """
+        values = self.value_struct.unpack(self.register_struct.pack(*registers))
+        if self.order is None:
+            return list(values)
+        ordered = [None] * len(values)
+        for position, index in enumerate(self.order):
+            ordered[index] = values[position]
+        return ordered
+
+    def encode(self, values):
+        """
+        :param values: values in layout order
+        :return: list of (offset, registers) for every contiguous segment
+        """
+        if self.order is not None:
+            values = [values[index] for index in self.order]
+        encoded = []
+        for offset, first, last, value_struct, register_struct in \
+                self.segments:
+            segment = values[first:last]
+            try:
+                packed = value_struct.pack(*segment)
+            except struct.error:
+                packed = value_struct.pack(*[
+                    int(v) if 'int' in self.formatters[
+                        first + i if self.order is None
+                        else self.order[first + i]] else v
+                    for i, v in enumerate(segment)])
+            encoded.append((offset, register_struct.unpack(packed)))
+        return encoded
+
+
+def get_layout_codec(layout, byte_order='big', word_order='big'):
+    """
+    Cached :class:`LayoutCodec` for the given layout.
+    """
+    layout = tuple((int(offset), formatter) for offset, formatter in layout)
+    key = (layout, is_big(byte_order), is_big(word_order))
+    codec = _CODECS.get(key)
+    if codec is None:
+        if len(_CODECS) >= _MAX_CODECS:
+            _CODECS.clear()
+        codec = _CODECS[key] = LayoutCodec(layout, byte_order, word_order)
+    return codec
+
+
+def get_codec(formatter, count=1, byte_order='big', word_order='big'):
+    """
+    Cached :class:`RegisterCodec` for the given layout.
+    """
+    key = (formatter, count, is_big(byte_order), is_big(word_order))
+    codec = _CODECS.get(key)
+    if codec is None:
+        if len(_CODECS) >= _MAX_CODECS:
+            _CODECS.clear()
+        codec = _CODECS[key] = RegisterCodec(formatter, count,
+                                             byte_order, word_order)
+    return codec
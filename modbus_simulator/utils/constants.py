@@ -29,4 +29,20 @@ BLOCK_TYPES = {"coils": COILS,
                "discrete_inputs": DISCRETE_INPUTS,
                "holding_registers": HOLDING_REGISTERS,
                "input_registers": ANALOG_INPUTS}
+
+# set_values/get_values take addresses, base + offset maps to the offset
+# for any offset (see ModbusSimu._calc_offset)
+ADDRESS_BASE = {
+    'coils': 0,
+    'discrete_inputs': 10001,
+    'input_registers': 30001,
+    'holding_registers': 40001
+}
+# block name aliases, same as the shared image tables
+BLOCK_ALIASES = {
+    'c': 'coils',
+    'd': 'discrete_inputs',
+    'i': 'input_registers',
+    'h': 'holding_registers'
+}
 MODBUS_TCP_PORT = 5440
\ No newline at end of file
@@ -0,0 +1,503 @@
+"""
+Compact pymodbus data blocks
+============================
+
+Registers are held in an ``array('H')`` (two bytes per register) and
+coils/discrete inputs are bit packed in a ``bytearray``, instead of a list
+of Python ints per value as in ``ModbusSequentialDataBlock``. Reads and
+writes of a range are slice operations.
+
+Both blocks keep the pymodbus data block interface (``validate``,
+``getValues``, ``setValues``, ``reset``) plus ``update`` used by
+:meth:`ModbusSimu.add_block` to grow a block, and record written ranges in
+a :class:`DirtyTracker`. Either block can be laid over an existing buffer
+(e.g. shared memory) instead, such a block has a fixed size.
+
+:class:`PagedRegisterDataBlock` and :class:`PagedBitDataBlock` have the
+same interface for large, sparsely used address spaces: values are kept in
+pages allocated on first write. A paged block may read the pages of a
+read-only template block it hasn't written yet (copy on write), see
+:class:`SlaveTemplate`.
+"""
+from __future__ import absolute_import
+
+from array import array
+from threading import Lock, RLock
+
+from pymodbus.datastore.store import BaseModbusDataBlock
+
+# bit values (lsb first) for every byte value, used to unpack coils a byte at
+# a time
+_BITS = [tuple((byte >> bit) & 1 for bit in range(8)) for byte in range(256)]
+
+
+class DirtyTracker(object):
+    """
+    Written ranges of a data block, kept as a bitmap of ``chunk`` sized
+    chunks (one byte per chunk) and a generation counter bumped on every
+    write. Lets a consumer find out what changed without reading the whole
+    block.
+
+    Callables in ``listeners`` get every marked range as (start, count),
+    for consumers keeping their own view of what changed.
+    """
+    chunk = 16
+
+    def __init__(self, size=0):
+        self.generation = 0
+        self.chunks = bytearray(self._nchunks(size))
+        self.listeners = []
+        self._lock = Lock()
+
+    def _nchunks(self, size):
+        return (size + self.chunk - 1) // self.chunk
+
+    def resize(self, size):
+        with self._lock:
+            missing = self._nchunks(size) - len(self.chunks)
+            if missing > 0:
+                self.chunks.extend(bytearray(missing))
+
+    def mark(self, start, count=1):
+        if count <= 0:
+            return
+        first = start // self.chunk
+        last = (start + count - 1) // self.chunk + 1
+        with self._lock:
+            if last > len(self.chunks):
+                self.chunks.extend(bytearray(last - len(self.chunks)))
+            self.chunks[first:last] = b'\x01' * (last - first)
+            self.generation += 1
+        for listener in self.listeners:
+            listener(start, count)
+
+    def mark_all(self):
+        with self._lock:
+            self.chunks[:] = b'\x01' * len(self.chunks)
+            self.generation += 1
+        for listener in self.listeners:
+            listener(0, len(self.chunks) * self.chunk)
+
+    def is_dirty(self):
+        return b'\x01' in self.chunks
+
+    def pop(self):
+        """
+        Returns the written ranges as (start, count) and clears them. Ranges
+        are chunk aligned and may go past the end of the block.
+        """
+        with self._lock:
+            chunks = self.chunks
+            ranges = []
+            first = chunks.find(b'\x01')
+            while first != -1:
+                last = chunks.find(b'\x00', first)
+                if last == -1:
+                    last = len(chunks)
+                ranges.append((first * self.chunk,
+                               (last - first) * self.chunk))
+                first = chunks.find(b'\x01', last)
+            if ranges:
+                chunks[:] = bytearray(len(chunks))
+        return ranges
+
+
+class RegisterDataBlock(BaseModbusDataBlock):
+    """
+    16 bit registers stored in an ``array('H')``.
+    """
+    typecode = str('H')
+
+    def __init__(self, address=0, size=0, default_value=0, buffer=None,
+                 dirty=None):
+        """
+        :param buffer: uint16 buffer (e.g. a memoryview cast to 'H') to keep
+            the registers in, fixed size
+        :param dirty: DirtyTracker to use
+        """
+        self.address = address
+        self.default_value = default_value
+        if buffer is None:
+            self.values = array(self.typecode, [default_value]) * (size or 1)
+        else:
+            self.values = buffer
+        self.dirty = dirty or DirtyTracker(len(self.values))
+        self._data_lock = RLock()
+
+    def __len__(self):
+        return len(self.values)
+
+    def __str__(self):
+        return "RegisterDataBlock(%d, %d)" % (len(self.values),
+                                              self.default_value)
+
+    def update(self, size):
+        if not isinstance(self.values, array):
+            raise ValueError("Block over a fixed buffer of %d registers "
+                             "can't grow" % len(self.values))
+        with self._data_lock:
+            self.values.extend(array(self.typecode,
+                                     [self.default_value]) * size)
+            self.dirty.resize(len(self.values))
+
+    def reset(self):
+        with self._data_lock:
+            self.values[:] = array(self.typecode,
+                                   [self.default_value]) * len(self.values)
+            self.dirty.mark_all()
+
+    def validate(self, address, count=1):
+        return (self.address <= address and
+                self.address + len(self.values) >= address + count)
+
+    def getValues(self, address, count=1):
+        start = address - self.address
+        return self.values[start:start + count].tolist()
+
+    def setValues(self, address, values):
+        if not isinstance(values, (list, tuple, array)):
+            values = [values]
+        start = address - self.address
+        try:
+            values = array(self.typecode, values)
+        except (OverflowError, TypeError):
+            # negative or float values, keep the 16 bit pattern as the list
+            # block used to hand them over to the framer
+            values = array(self.typecode, [int(v) & 0xFFFF for v in values])
+        with self._data_lock:
+            self.values[start:start + len(values)] = values
+        self.dirty.mark(start, len(values))
+
+
+class BitDataBlock(BaseModbusDataBlock):
+    """
+    Coils and discrete inputs, bit packed in a ``bytearray`` (lsb first).
+    """
+
+    def __init__(self, address=0, size=0, default_value=0, buffer=None,
+                 dirty=None):
+        """
+        :param buffer: byte buffer of at least ``(size + 7) // 8`` bytes to
+            keep the bits in, fixed size
+        :param dirty: DirtyTracker to use
+        """
+        self.address = address
+        self.default_value = default_value
+        self.size = size or 1
+        if buffer is None:
+            self.values = bytearray(self._fill_byte()) * self._nbytes(
+                self.size)
+        else:
+            self.values = buffer
+        self.dirty = dirty or DirtyTracker(self.size)
+        self._data_lock = RLock()
+
+    @staticmethod
+    def _nbytes(size):
+        return (size + 7) // 8
+
+    def _fill_byte(self):
+        return [0xFF if self.default_value else 0x00]
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return "BitDataBlock(%d, %d)" % (self.size, self.default_value)
+
+    def __iter__(self):
+        return enumerate(self.getValues(self.address, self.size),
+                         self.address)
+
+    def update(self, size):
+        if not isinstance(self.values, bytearray):
+            raise ValueError("Block over a fixed buffer of %d bits can't "
+                             "grow" % self.size)
+        with self._data_lock:
+            self.size += size
+            missing = self._nbytes(self.size) - len(self.values)
+            if missing > 0:
+                self.values.extend(bytearray(self._fill_byte()) * missing)
+            self.dirty.resize(self.size)
+
+    def reset(self):
+        with self._data_lock:
+            self.values[:] = bytearray(self._fill_byte()) * len(self.values)
+            self.dirty.mark_all()
+
+    def validate(self, address, count=1):
+        return (self.address <= address and
+                self.address + self.size >= address + count)
+
+    def getValues(self, address, count=1):
+        start = address - self.address
+        first, skip = divmod(start, 8)
+        bits = []
+        for byte in self.values[first:self._nbytes(start + count)]:
+            bits.extend(_BITS[byte])
+        return bits[skip:skip + count]
+
+    def setValues(self, address, values):
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        bit = address - self.address
+        with self._data_lock:
+            data = self.values
+            for value in values:
+                index, mask = bit >> 3, 1 << (bit & 7)
+                if value:
+                    data[index] |= mask
+                else:
+                    data[index] &= ~mask & 0xFF
+                bit += 1
+        self.dirty.mark(address - self.address, len(values))
+
+
+class PagedDataBlock(BaseModbusDataBlock):
+    """
+    Sparse block of ``size`` values kept in fixed size pages, a page is
+    allocated on the first write to it and reads of unwritten pages return
+    the default value without allocating. Memory follows the addresses in
+    use rather than the block size, so full 0-65535 blocks cost nothing
+    until written.
+
+    With a ``template`` (a block of the same type and page size that is no
+    longer written to), unwritten pages are read from the template and a
+    page is copied from it on first write.
+
+    Subclasses define the page storage (:meth:`_blank_page`,
+    :meth:`_copy_page`, :meth:`_read` and :meth:`_write`).
+    """
+    page_size = 256
+
+    def __init__(self, address=0, size=0, default_value=0, page_size=None,
+                 dirty=None, template=None):
+        self.address = address
+        self.template = template
+        self.default_value = default_value
+        if page_size:
+            self.page_size = page_size
+        self.size = size or 1
+        self.pages = {}
+        # shared by all the unwritten pages, never written to
+        self._blank = self._blank_page()
+        # grows with the written ranges instead of the block size
+        self.dirty = dirty or DirtyTracker()
+        self._data_lock = RLock()
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return "%s(%d, %d, %d pages)" % (type(self).__name__, self.size,
+                                         self.default_value, len(self.pages))
+
+    def _blank_page(self):
+        raise NotImplementedError
+
+    def _copy_page(self, page):
+        raise NotImplementedError
+
+    def _read(self, page, offset, count, values):
+        """
+        Appends ``count`` values of ``page`` from ``offset`` to ``values``.
+        """
+        raise NotImplementedError
+
+    def _write(self, page, offset, values):
+        raise NotImplementedError
+
+    def _page(self, index):
+        """
+        Page ``index`` for reading, from the template or blank if never
+        written.
+        """
+        page = self.pages.get(index)
+        if page is None:
+            if self.template is not None:
+                return self.template._page(index)
+            return self._blank
+        return page
+
+    def _new_page(self, index):
+        if self.template is not None:
+            return self._copy_page(self.template._page(index))
+        return self._blank_page()
+
+    def written_pages(self):
+        """
+        Indexes of the pages holding values, own or from the template.
+        """
+        indexes = set(self.pages)
+        if self.template is not None:
+            indexes.update(self.template.written_pages())
+        return indexes
+
+    def update(self, size):
+        with self._data_lock:
+            self.size += size
+
+    def reset(self):
+        with self._data_lock:
+            written = sorted(self.written_pages())
+            self.pages = {}
+            self.template = None
+        for index in written:
+            self.dirty.mark(index * self.page_size, self.page_size)
+
+    def validate(self, address, count=1):
+        return (self.address <= address and
+                self.address + self.size >= address + count)
+
+    def getValues(self, address, count=1):
+        start = address - self.address
+        end = start + count
+        values = []
+        page_size = self.page_size
+        while start < end:
+            index, offset = divmod(start, page_size)
+            chunk = min(end - start, page_size - offset)
+            self._read(self._page(index), offset, chunk, values)
+            start += chunk
+        return values
+
+    def setValues(self, address, values):
+        if not isinstance(values, (list, tuple, array)):
+            values = [values]
+        first = start = address - self.address
+        page_size = self.page_size
+        position = 0
+        with self._data_lock:
+            while position < len(values):
+                index, offset = divmod(start, page_size)
+                chunk = min(len(values) - position, page_size - offset)
+                page = self.pages.get(index)
+                if page is None:
+                    page = self.pages[index] = self._new_page(index)
+                self._write(page, offset, values[position:position + chunk])
+                position += chunk
+                start += chunk
+        self.dirty.mark(first, len(values))
+
+
+class PagedRegisterDataBlock(PagedDataBlock):
+    """
+    16 bit registers in ``array('H')`` pages.
+    """
+    typecode = str('H')
+
+    def _blank_page(self):
+        return array(self.typecode, [self.default_value]) * self.page_size
+
+    def _copy_page(self, page):
+        return array(self.typecode, page)
+
+    def _read(self, page, offset, count, values):
+        values.extend(page[offset:offset + count])
+
+    def _write(self, page, offset, values):
+        try:
+            values = array(self.typecode, values)
+        except (OverflowError, TypeError):
+            values = array(self.typecode, [int(v) & 0xFFFF for v in values])
+        page[offset:offset + len(values)] = values
+
+
+class PagedBitDataBlock(PagedDataBlock):
+    """
+    Coils and discrete inputs in bit packed ``bytearray`` pages (lsb first),
+    the page size is a multiple of 8 bits.
+    """
+    page_size = 2048
+
+    def _blank_page(self):
+        if self.page_size % 8:
+            raise ValueError("Bit block pages must be a multiple of 8 bits, "
+                             "got %d" % self.page_size)
+        return bytearray([0xFF if self.default_value else 0x00]) * (
+            self.page_size // 8)
+
+    def _copy_page(self, page):
+        return bytearray(page)
+
+    def __iter__(self):
+        return enumerate(self.getValues(self.address, self.size),
+                         self.address)
+
+    def _read(self, page, offset, count, values):
+        first, skip = divmod(offset, 8)
+        bits = []
+        for byte in page[first:(offset + count + 7) // 8]:
+            bits.extend(_BITS[byte])
+        values.extend(bits[skip:skip + count])
+
+    def _write(self, page, offset, values):
+        for value in values:
+            index, mask = offset >> 3, 1 << (offset & 7)
+            if value:
+                page[index] |= mask
+            else:
+                page[index] &= ~mask & 0xFF
+            offset += 1
+
+
+def _freeze(block):
+    """
+    Paged copy of a data block that nothing writes to.
+    """
+    if isinstance(block, PagedDataBlock):
+        frozen = type(block)(block.address, block.size, block.default_value,
+                             block.page_size)
+        with block._data_lock:
+            for index in block.written_pages():
+                frozen.pages[index] = frozen._copy_page(block._page(index))
+        return frozen
+    if not isinstance(block.values, (array, bytearray)):
+        raise ValueError("Can't make a template of a block over a fixed "
+                         "buffer")
+    paged = PagedBitDataBlock if isinstance(block, BitDataBlock) \
+        else PagedRegisterDataBlock
+    frozen = paged(block.address, len(block), block.default_value)
+    blank = frozen._blank
+    # page length in the dense block storage (bytes for bits)
+    step = len(blank)
+    with block._data_lock:
+        values = block.values[:]
+    for index, start in enumerate(range(0, len(values), step)):
+        chunk = values[start:start + step]
+        if chunk != blank[:len(chunk)]:
+            page = frozen._blank_page()
+            page[:len(chunk)] = chunk
+            frozen.pages[index] = page
+    return frozen
+
+
+class SlaveTemplate(object):
+    """
+    Read-only register image of a slave, shared by the slaves created from
+    it. Their blocks (:meth:`blocks`) read the template pages until they
+    write to them, so provisioning many identical slaves costs about the
+    memory of one plus the pages they change.
+    """
+    def __init__(self, blocks):
+        """
+        :param blocks: {store key: paged block} never written to
+        """
+        self._blocks = blocks
+
+    @classmethod
+    def from_store(cls, store):
+        """
+        Template of the current values of a slave context ``store``.
+        """
+        return cls(dict((key, _freeze(block))
+                        for key, block in store.items()))
+
+    def blocks(self):
+        """
+        New copy on write blocks over the template, {store key: block}.
+        """
+        return dict((key, type(block)(block.address, block.size,
+                                      block.default_value, block.page_size,
+                                      template=block))
+                    for key, block in self._blocks.items())
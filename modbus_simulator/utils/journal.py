@@ -0,0 +1,306 @@
+"""
+Write-ahead journal
+===================
+
+Keeps the register values of a :class:`ModbusSimu` on disk while it runs,
+so values written by clients or the simulation survive a crash.
+
+Writers only mark the written range in a per block :class:`DirtyTracker`
+(hooked on the block's tracker). A background job appends the current
+values of the marked ranges to the journal every ``flush_interval`` seconds,
+so a register written many times between two flushes costs one record.
+Once the journal grows past ``checkpoint_size`` the full image of every
+block is written to a checkpoint and the journal starts over.
+
+Files (little endian), ``<path>`` and ``<path>.ckpt``::
+
+    header  8s magic (b"MBSIMJNL" / b"MBSIMCKP"), H version, H reserved,
+            Q epoch
+    record  I body length, I crc32 of the body
+            body: B slave id, B block (index in BLOCKS), I register offset,
+                  I count, count x H values
+
+A checkpoint of epoch N holds everything written before the journal of
+epoch N was started. Recovery replays the checkpoint, then the journal if
+it has the same epoch, up to the first torn or corrupt record.
+"""
+from __future__ import absolute_import
+
+import logging
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from threading import RLock
+
+from modbus_simulator.utils.backgroundJob import BackgroundJob
+from modbus_simulator.utils.constants import ADDRESS_BASE
+from modbus_simulator.utils.datastore import DirtyTracker
+
+log = logging.getLogger(__name__)
+
+JOURNAL_MAGIC = b"MBSIMJNL"
+CHECKPOINT_MAGIC = b"MBSIMCKP"
+VERSION = 1
+FILE_HEADER = struct.Struct(str("<8sHHQ"))
+RECORD = struct.Struct(str("<II"))
+RECORD_BODY = struct.Struct(str("<BBII"))
+BLOCKS = ('coils', 'discrete_inputs', 'input_registers', 'holding_registers')
+
+_SWAP = sys.byteorder == 'big'
+
+
+def _record(slave_id, block_name, offset, values):
+    registers = array(str('H'), [int(value) & 0xFFFF for value in values])
+    if _SWAP:
+        registers.byteswap()
+    body = RECORD_BODY.pack(slave_id, BLOCKS.index(block_name), offset,
+                            len(registers))
+    body += registers.tobytes() if hasattr(registers, 'tobytes') \
+        else registers.tostring()
+    return RECORD.pack(len(body), zlib.crc32(body) & 0xFFFFFFFF) + body
+
+
+def _records(content):
+    """
+    Yields (slave_id, block_name, offset, values) of the records in
+    ``content`` (past the file header), stops at the first torn or corrupt
+    record.
+    """
+    position = FILE_HEADER.size
+    while position < len(content):
+        if position + RECORD.size > len(content):
+            log.warning("Torn journal record at %d, ignored", position)
+            return
+        length, crc = RECORD.unpack_from(content, position)
+        body = content[position + RECORD.size:
+                       position + RECORD.size + length]
+        if len(body) != length or zlib.crc32(body) & 0xFFFFFFFF != crc:
+            log.warning("Corrupt journal record at %d, ignored with what "
+                        "follows", position)
+            return
+        slave_id, block, offset, count = RECORD_BODY.unpack_from(body, 0)
+        values = array(str('H'))
+        if hasattr(values, 'frombytes'):
+            values.frombytes(body[RECORD_BODY.size:])
+        else:
+            values.fromstring(body[RECORD_BODY.size:])
+        if _SWAP:
+            values.byteswap()
+        yield slave_id, BLOCKS[block], offset, values.tolist()
+        position += RECORD.size + length
+
+
+def _read(path, magic):
+    """
+    (epoch, content) of a journal or checkpoint file, None if missing or
+    not one.
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        content = f.read()
+    if len(content) < FILE_HEADER.size:
+        return None
+    file_magic, version, _, epoch = FILE_HEADER.unpack_from(content, 0)
+    if file_magic != magic or version > VERSION:
+        log.warning("'%s' is not a simulator journal, ignored", path)
+        return None
+    return epoch, content
+
+
+def _fsync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class Journal(object):
+    """
+    Write-ahead journal of the registers of ``modbus_device``.
+
+    Call :meth:`recover` once slaves and blocks exist, :meth:`track` for
+    every slave (also slaves added later), then :meth:`start`.
+    :meth:`close` writes a final checkpoint.
+    """
+    def __init__(self, path, modbus_device, flush_interval=0.2,
+                 checkpoint_size=8 * 1024 * 1024, fsync=True):
+        self.path = path
+        self.checkpoint_path = path + ".ckpt"
+        self.modbus_device = modbus_device
+        self.flush_interval = flush_interval
+        self.checkpoint_size = checkpoint_size
+        self.fsync = fsync
+        self.epoch = 0
+        self._blocks = {}
+        self._file = None
+        self._job = None
+        self._lock = RLock()
+
+    def recover(self):
+        """
+        Writes the values of the last checkpoint and journal to the device.
+
+        :return: Number of records replayed
+        """
+        started = time.time()
+        replayed = 0
+        checkpoint = _read(self.checkpoint_path, CHECKPOINT_MAGIC)
+        if checkpoint is not None:
+            self.epoch, content = checkpoint
+            replayed += self._replay(content)
+        journal = _read(self.path, JOURNAL_MAGIC)
+        if journal is not None:
+            epoch, content = journal
+            if epoch == self.epoch:
+                replayed += self._replay(content)
+            else:
+                # crashed while switching to a new epoch, the checkpoint
+                # already holds these writes
+                log.debug("Skipping journal of epoch %d (checkpoint %d)",
+                          epoch, self.epoch)
+        if replayed:
+            log.info("Recovered %d journal records (epoch %d) in %.3f s",
+                     replayed, self.epoch, time.time() - started)
+        return replayed
+
+    def _replay(self, content):
+        replayed = 0
+        for slave_id, block_name, offset, values in _records(content):
+            try:
+                self.modbus_device.set_values(
+                    slave_id, block_name, ADDRESS_BASE[block_name] + offset,
+                    values)
+            except Exception as e:
+                log.debug("Journal record for %s %s@%d not replayed: %s",
+                          slave_id, block_name, offset, e)
+                continue
+            replayed += 1
+        return replayed
+
+    def track(self, slave_id, block_names=BLOCKS):
+        """
+        Journals the writes to the blocks of a slave.
+        """
+        with self._lock:
+            for block_name in block_names:
+                self.untrack(slave_id, [block_name])
+                shift, size, tracker = \
+                    self.modbus_device.get_block_tracker(slave_id,
+                                                         block_name)
+                if hasattr(tracker, 'generations'):
+                    # shared image, writes of other processes only show up
+                    # in the generation counter (bumped by local writes as
+                    # well), changed blocks are journaled whole
+                    journal_tracker = type(tracker)(size, tracker.generations,
+                                                    tracker.index)
+                    listener = None
+                else:
+                    journal_tracker = DirtyTracker(size)
+                    listener = journal_tracker.mark
+                    tracker.listeners.append(listener)
+                self._blocks[(int(slave_id), block_name)] = (
+                    shift, size, tracker, journal_tracker, listener)
+
+    def untrack(self, slave_id, block_names=BLOCKS):
+        with self._lock:
+            for block_name in block_names:
+                entry = self._blocks.pop((int(slave_id), block_name), None)
+                if entry is not None and entry[4] is not None:
+                    entry[2].listeners.remove(entry[4])
+
+    def _ranges(self, full=False):
+        """
+        (slave_id, block_name, offset, values) to write, every written range
+        or whole blocks.
+        """
+        for (slave_id, block_name), (shift, size, _, journal_tracker, _) in \
+                sorted(self._blocks.items()):
+            if full:
+                journal_tracker.pop()
+                ranges = [(0, size)]
+            else:
+                ranges = journal_tracker.pop()
+            for start, count in ranges:
+                end = min(start + count, size) + shift
+                start = max(start + shift, 0)
+                if end <= start:
+                    continue
+                values = self.modbus_device.get_values(
+                    slave_id, block_name, ADDRESS_BASE[block_name] + start,
+                    end - start)
+                if values:
+                    yield slave_id, block_name, start, values
+
+    def _open_journal(self):
+        if self._file is not None:
+            self._file.close()
+        tmp = self.path + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(FILE_HEADER.pack(JOURNAL_MAGIC, VERSION, 0, self.epoch))
+            _fsync(f)
+        os.rename(tmp, self.path)
+        self._file = open(self.path, 'ab')
+
+    def flush(self):
+        """
+        Appends the values written since the last flush.
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            records = [_record(*entry) for entry in self._ranges()]
+            if records:
+                self._file.write(b"".join(records))
+                if self.fsync:
+                    _fsync(self._file)
+                else:
+                    self._file.flush()
+            if self._file.tell() > self.checkpoint_size:
+                self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Writes the image of every tracked block to the checkpoint and starts
+        a new (empty) journal.
+        """
+        with self._lock:
+            started = time.time()
+            self.epoch += 1
+            tmp = self.checkpoint_path + ".tmp"
+            with open(tmp, 'wb') as f:
+                f.write(FILE_HEADER.pack(CHECKPOINT_MAGIC, VERSION, 0,
+                                         self.epoch))
+                for entry in self._ranges(full=True):
+                    f.write(_record(*entry))
+                _fsync(f)
+            os.rename(tmp, self.checkpoint_path)
+            self._open_journal()
+            log.info("Journal checkpoint (epoch %d) written in %.3f s",
+                     self.epoch, time.time() - started)
+
+    @property
+    def running(self):
+        return self._job is not None
+
+    def start(self):
+        """
+        Starts a new epoch from the current values and the flush job.
+        """
+        self.checkpoint()
+        if self._job is None:
+            self._job = BackgroundJob("journal", self.flush_interval,
+                                      self.flush)
+            self._job.start()
+
+    def close(self):
+        if self._job is not None:
+            self._job.cancel()
+            self._job.join()
+            self._job = None
+        with self._lock:
+            if self._file is not None:
+                self.checkpoint()
+                self._file.close()
+                self._file = None
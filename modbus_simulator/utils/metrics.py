@@ -0,0 +1,220 @@
+"""
+Server metrics
+==============
+
+In-process counters of the Modbus server, served in the OpenMetrics text
+format on a local HTTP endpoint (``GET /metrics``)::
+
+    modbus_requests_total{slave="1",function="3"} 1200
+    modbus_exception_responses_total{slave="1",function="3"} 2
+    modbus_request_duration_seconds_bucket{slave="1",function="3",le="0.001"} 1180
+    modbus_connections_total 4
+    modbus_active_connections 2
+    modbus_received_bytes_total 14400
+    modbus_sent_bytes_total 30000
+
+Request counters and latency histograms are kept per slave and function
+code. They live in flat arrays of doubles: a preallocated table maps
+``slave * 128 + function code`` to a row, and a row is appended the first
+time a pair is seen. Recording a request takes one bisect plus a handful of
+array increments under a lock, with no per-request container or object, so
+it can stay enabled at full load.
+"""
+from __future__ import absolute_import
+
+import bisect
+import logging
+import threading
+from array import array
+
+from six.moves import socketserver
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+log = logging.getLogger(__name__)
+
+# request latency buckets, seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0)
+MAX_SLAVES = 256
+FUNCTION_CODES = 128
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# server wide counters
+CONNECTIONS, ACTIVE, RECEIVED, SENT = range(4)
+
+
+class Metrics(object):
+    """
+    Counters of one server, safe to update from any thread.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._width = len(self.buckets) + 1
+        self._lock = threading.Lock()
+        # slave * FUNCTION_CODES + function code -> row, -1 before first use
+        self._index = array(str('i'), [-1]) * (MAX_SLAVES * FUNCTION_CODES)
+        self._labels = []
+        self._requests = array(str('d'))
+        self._exceptions = array(str('d'))
+        self._seconds = array(str('d'))
+        self._histogram = array(str('d'))
+        self._totals = array(str('d'), [0.0] * 4)
+
+    def _add_row(self, key):
+        row = len(self._labels)
+        self._labels.append(divmod(key, FUNCTION_CODES))
+        self._requests.append(0.0)
+        self._exceptions.append(0.0)
+        self._seconds.append(0.0)
+        self._histogram.extend([0.0] * self._width)
+        self._index[key] = row
+        return row
+
+    def record(self, slave_id, function_code, seconds):
+        """
+        Records a response, exception responses have the 0x80 bit of the
+        function code set.
+        """
+        key = (slave_id % MAX_SLAVES) * FUNCTION_CODES + \
+            (function_code & 0x7f)
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            row = self._index[key]
+            if row < 0:
+                row = self._add_row(key)
+            self._requests[row] += 1
+            if function_code & 0x80:
+                self._exceptions[row] += 1
+            self._seconds[row] += seconds
+            self._histogram[row * self._width + bucket] += 1
+
+    def connection_opened(self):
+        with self._lock:
+            self._totals[CONNECTIONS] += 1
+            self._totals[ACTIVE] += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self._totals[ACTIVE] -= 1
+
+    def received(self, size):
+        with self._lock:
+            self._totals[RECEIVED] += size
+
+    def sent(self, size):
+        with self._lock:
+            self._totals[SENT] += size
+
+    def render(self):
+        """
+        OpenMetrics text exposition of every counter.
+        """
+        with self._lock:
+            labels = list(self._labels)
+            requests = self._requests.tolist()
+            exceptions = self._exceptions.tolist()
+            seconds = self._seconds.tolist()
+            histogram = self._histogram.tolist()
+            totals = self._totals.tolist()
+        order = sorted(range(len(labels)), key=labels.__getitem__)
+        lines = [
+            "# TYPE modbus_requests counter",
+            "# HELP modbus_requests Responses sent, per slave and function "
+            "code.",
+        ]
+        for row in order:
+            lines.append('modbus_requests_total{slave="%d",function="%d"} %d'
+                         % (labels[row] + (requests[row],)))
+        lines += [
+            "# TYPE modbus_exception_responses counter",
+            "# HELP modbus_exception_responses Exception responses sent, "
+            "per slave and function code.",
+        ]
+        for row in order:
+            lines.append('modbus_exception_responses_total{slave="%d",'
+                         'function="%d"} %d'
+                         % (labels[row] + (exceptions[row],)))
+        lines += [
+            "# TYPE modbus_request_duration_seconds histogram",
+            "# HELP modbus_request_duration_seconds Time from request "
+            "decoded to response sent.",
+            "# UNIT modbus_request_duration_seconds seconds",
+        ]
+        bounds = ["%g" % bound for bound in self.buckets] + ["+Inf"]
+        for row in order:
+            label = 'slave="%d",function="%d"' % labels[row]
+            count = 0
+            for bucket, bound in enumerate(bounds):
+                count += histogram[row * self._width + bucket]
+                lines.append('modbus_request_duration_seconds_bucket{%s,'
+                             'le="%s"} %d' % (label, bound, count))
+            lines.append('modbus_request_duration_seconds_count{%s} %d'
+                         % (label, requests[row]))
+            lines.append('modbus_request_duration_seconds_sum{%s} %r'
+                         % (label, seconds[row]))
+        lines += [
+            "# TYPE modbus_connections counter",
+            "# HELP modbus_connections Client connections accepted.",
+            "modbus_connections_total %d" % totals[CONNECTIONS],
+            "# TYPE modbus_active_connections gauge",
+            "# HELP modbus_active_connections Client connections open.",
+            "modbus_active_connections %d" % totals[ACTIVE],
+            "# TYPE modbus_received_bytes counter",
+            "# HELP modbus_received_bytes Bytes received from clients.",
+            "modbus_received_bytes_total %d" % totals[RECEIVED],
+            "# TYPE modbus_sent_bytes counter",
+            "# HELP modbus_sent_bytes Bytes sent to clients.",
+            "modbus_sent_bytes_total %d" % totals[SENT],
+            "# EOF",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        log.debug("%s - %s", self.address_string(), fmt % args)
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsServer(object):
+    """
+    Serves ``metrics`` on ``http://host:port/metrics`` from a daemon thread.
+    """
+    def __init__(self, metrics, host='127.0.0.1', port=9102):
+        self.metrics = metrics
+        self.httpd = _HTTPServer((host, int(port)), _MetricsHandler)
+        self.httpd.metrics = metrics
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name="MetricsServer")
+        self.thread.daemon = True
+        self.thread.start()
+        log.info("Metrics served on http://%s:%d/metrics", *self.address)
+
+    def stop(self):
+        if self.thread is not None:
+            self.httpd.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.httpd.server_close()
@@ -7,10 +7,12 @@ import serial
 import struct
 from modbus_tk.defines import (
     COILS, DISCRETE_INPUTS, HOLDING_REGISTERS, ANALOG_INPUTS)
+from modbus_tk import hooks
 from modbus_tk.modbus_rtu import RtuServer, RtuMaster
 from modbus_tk.modbus_tcp import TcpServer, TcpMaster
 
 from modbus_simulator.utils.common import path, make_dir, remove_file
+from modbus_simulator.utils.datastore import DirtyTracker
 
 ADDRESS_RANGE = {
     COILS: 0,
@@ -45,6 +47,24 @@ BLOCK_TYPES = {"coils": COILS,
 MODBUS_TCP_PORT = 5440
 
 
+def _mark_dirty(args):
+    """
+    modbus_tk hook called on every block write, records the written range
+    in the block's DirtyTracker (only blocks created by ModbusSimu have one)
+    """
+    block, item, value = args
+    dirty = getattr(block, 'dirty', None)
+    if dirty is not None:
+        if isinstance(item, slice):
+            start, stop, _ = item.indices(block.size)
+            dirty.mark(start, stop - start)
+        else:
+            dirty.mark(item)
+
+
+hooks.install_hook("modbus.ModbusBlock.setitem", _mark_dirty)
+
+
 class PseudoSerial(object):
     def __init__(self, tty_name, **kwargs):
         self.ser = serial.Serial()
@@ -82,6 +102,8 @@ class ModbusSimu(object):
     def __init__(self, server="tcp", *args, **kwargs):
         self._server_type = server
         self._port = kwargs.get('port', None)
+        self.byte_order = kwargs.pop("byte_order", "big")
+        self.word_order = kwargs.pop("word_order", "big")
         if server == 'rtu':
             tty_name = kwargs['port']
             kwargs.pop('port', None)
@@ -101,6 +123,18 @@ class ModbusSimu(object):
     def port(self):
         return self._port
 
+    @staticmethod
+    def _calc_offset(block_name, address):
+        address = int(address)
+        if block_name == "coils":
+            return address
+        elif block_name == "discrete_inputs":
+            return address-10001 if address >= 10001 else address
+        elif block_name == "input_registers":
+            return address - 30001 if address >= 30001 else address
+        else:
+            return address - 40001 if address >= 40001 else address
+
     def add_slave(self, slave_id):
         self.server.add_slave(slave_id)
 
@@ -113,6 +147,7 @@ class ModbusSimu(object):
     def add_block(self, slave_id, block_name, block_type, starting_add, size):
         slave = self.server.get_slave(slave_id)
         slave.add_block(block_name, block_type, starting_add, size)
+        slave._get_block(block_name).dirty = DirtyTracker(size)
 
     def remove_block(self, slave_id, block_name):
         slave = self.server.get_slave(slave_id)
@@ -124,12 +159,33 @@ class ModbusSimu(object):
 
     def set_values(self, slave_id, block_name, address, values):
         slave = self.server.get_slave(slave_id)
+        address = self._calc_offset(block_name, address)
         slave.set_values(block_name, address, values)
 
     def get_values(self, slave_id, block_name, address, size=1):
         slave = self.server.get_slave(slave_id)
+        address = self._calc_offset(block_name, address)
         return slave.get_values(block_name, address, size)
 
+    def pop_dirty(self, slave_id, block_name):
+        """
+        Offset ranges written to a block since the last call, as
+        (offset, count) tuples.
+        """
+        slave = self.server.get_slave(slave_id)
+        block = slave._get_block(block_name)
+        return [(block.starting_address + start, count)
+                for start, count in block.dirty.pop()]
+
+    def get_block_tracker(self, slave_id, block_name):
+        """
+        DirtyTracker of a block as (shift, size, tracker), position p of the
+        tracker is register offset p + shift.
+        """
+        slave = self.server.get_slave(slave_id)
+        block = slave._get_block(block_name)
+        return block.starting_address, block.size, block.dirty
+
     def start(self):
         self.server.start()
         if self._server_type == "tcp":
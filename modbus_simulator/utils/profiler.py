@@ -0,0 +1,170 @@
+"""
+Sampling profiler
+=================
+
+Samples the Python stack of every thread (server, scheduler, GUI loop)
+every ``interval`` seconds from a daemon thread, without stopping any of
+them, and writes the samples as collapsed stacks (one
+``thread;outer frame;...;inner frame count`` line per distinct stack) that
+flame graph tools (``flamegraph.pl``, speedscope, inferno) read as is.
+
+A running simulator toggles it on ``SIGUSR2``::
+
+    $ kill -USR2 <pid>     # start sampling
+    $ kill -USR2 <pid>     # stop, writes modbus_simu-<pid>-<time>.collapsed
+"""
+from __future__ import absolute_import
+
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import defaultdict
+
+log = logging.getLogger(__name__)
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+TOGGLE_SIGNAL = getattr(signal, 'SIGUSR2', None)
+
+
+class SamplingProfiler(object):
+    """
+    Collects stack samples of all the threads but its own.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self.stacks = defaultdict(int)
+        self.started = None
+        self.elapsed = 0.0
+        self._labels = {}
+        self._names = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self.started = _monotonic()
+        self._thread = threading.Thread(target=self._run, name="Profiler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.elapsed += _monotonic() - self.started
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            filename = "/".join(code.co_filename.replace(
+                "\\", "/").split("/")[-2:])
+            label = self._labels[code] = ("%s (%s:%d)" % (
+                code.co_name, filename, code.co_firstlineno)).replace(
+                ";", ":")
+        return label
+
+    def _thread_name(self, ident):
+        name = self._names.get(ident)
+        if name is None:
+            self._names = dict((thread.ident, thread.name.replace(";", ":"))
+                               for thread in threading.enumerate())
+            name = self._names.get(ident, "thread-%s" % ident)
+        return name
+
+    def sample(self):
+        own = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(self._label(frame.f_code))
+                frame = frame.f_back
+            labels.append(self._thread_name(ident))
+            labels.reverse()
+            self.stacks[";".join(labels)] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:
+                log.exception("Profiler sample failed")
+
+    def write(self, path):
+        """
+        Writes the collapsed stacks, most sampled first.
+        """
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items(),
+                                       key=lambda item: -item[1]):
+                f.write("%s %d\n" % (stack, count))
+        return path
+
+
+class ProfilerToggle(object):
+    """
+    Signal handler starting a :class:`SamplingProfiler` and, on the next
+    call, stopping it and writing its samples to ``directory``.
+    """
+    def __init__(self, directory=None, interval=0.005):
+        self.directory = directory or os.getcwd()
+        self.interval = interval
+        self.profiler = None
+
+    def __call__(self, *args):
+        if self.profiler is None:
+            self.profiler = SamplingProfiler(self.interval)
+            self.profiler.start()
+            log.info("Profiler started, sampling every %g s", self.interval)
+            return None
+        return self.finish()
+
+    def finish(self):
+        """
+        Stops a running profiler and writes its samples.
+
+        :return: Path of the collapsed stacks, None if not running
+        """
+        profiler, self.profiler = self.profiler, None
+        if profiler is None:
+            return None
+        profiler.stop()
+        path = os.path.join(self.directory, "modbus_simu-%d-%s.collapsed" % (
+            os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+        try:
+            profiler.write(path)
+        except (IOError, OSError) as e:
+            log.error("Failed to write profile '%s': %s", path, e)
+            return None
+        log.info("Profiler stopped, %d samples over %.1f s written to %s",
+                 profiler.samples, profiler.elapsed, path)
+        return path
+
+
+def install_toggle(directory=None, interval=0.005, signum=TOGGLE_SIGNAL):
+    """
+    Toggles the profiler on ``signum`` (``SIGUSR2``), from the main thread.
+
+    :return: :class:`ProfilerToggle`, None where the signal doesn't exist
+    """
+    if signum is None:
+        log.debug("No profiler toggle signal on this platform")
+        return None
+    toggle = ProfilerToggle(directory, interval)
+    signal.signal(signum, toggle)
+    return toggle
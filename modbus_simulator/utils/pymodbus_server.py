@@ -3,18 +3,41 @@ from __future__ import absolute_import, unicode_literals
 from pymodbus.server.sync import ModbusSerialServer
 from pymodbus.server.sync import ModbusTcpServer
 from pymodbus.server.sync import ModbusSingleRequestHandler
+from pymodbus.server.sync import ModbusConnectedRequestHandler
 from pymodbus.device import ModbusDeviceIdentification
-from pymodbus.datastore import ModbusSequentialDataBlock
 from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
 
 from pymodbus.transaction import ModbusRtuFramer
 from pymodbus.payload import BinaryPayloadDecoder, Endian, BinaryPayloadBuilder
 
-from threading import Thread, RLock
+from threading import Thread
 import logging
+import time
+
+from modbus_simulator.utils.datastore import (RegisterDataBlock, BitDataBlock,
+                                              PagedRegisterDataBlock,
+                                              PagedBitDataBlock,
+                                              SlaveTemplate)
+from modbus_simulator.utils.codec import get_codec, get_layout_codec
+
+try:
+    from modbus_simulator.utils.async_server import AsyncModbusTcpServer
+except (ImportError, SyntaxError):
+    # Python 2, no asyncio
+    AsyncModbusTcpServer = None
+
+try:
+    from modbus_simulator.utils.shared_image import (SharedImage,
+                                                     SharedServerContext)
+    from modbus_simulator.utils.workers import ModbusWorkerPool
+except (ImportError, SyntaxError):
+    # Python < 3.8, no multiprocessing.shared_memory
+    SharedImage = SharedServerContext = ModbusWorkerPool = None
 
 log = logging.getLogger(__name__)
 
+_timer = getattr(time, 'perf_counter', time.time)
+
 SERVERS = {
     "tcp": ModbusTcpServer,
     "rtu": ModbusSerialServer
@@ -59,19 +82,97 @@ ENCODERS = {
 }
 
 
-class CustomDataBlock(ModbusSequentialDataBlock):
-
-    def __init__(self, *args, **kwargs):
-        super(CustomDataBlock, self).__init__(*args, **kwargs)
-        self._data_lock = RLock()
-
-    def update(self, size):
-        with self._data_lock:
-            values = [self.default_value] * size
-            self.values.extend(values)
-
-
-class CustomSingleRequestHandler(ModbusSingleRequestHandler):
+class _HandlerSocket(object):
+    """
+    ``recv``/``send`` of a request handler socket (or of a serial port
+    patched to look like one), stamping the time the last bytes were read
+    and counting the traffic.
+    """
+    __slots__ = ('_sock', '_handler')
+
+    def __init__(self, sock, handler):
+        self._sock = sock
+        self._handler = handler
+
+    def recv(self, size):
+        data = self._sock.recv(size)
+        if data:
+            self._handler._received = _timer()
+            if self._handler.metrics is not None:
+                self._handler.metrics.received(len(data))
+        return data
+
+    def send(self, data):
+        if self._handler.metrics is not None:
+            self._handler.metrics.sent(len(data))
+        return self._sock.send(data)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+class MeteredHandlerMixin(object):
+    """
+    Records requests and connection traffic in ``server.metrics`` (a
+    :class:`~modbus_simulator.utils.metrics.Metrics`) and hands the phase
+    timings of requests to ``server.request_timing`` (a
+    :class:`~modbus_simulator.utils.request_timing.RequestTiming`), when the
+    server has them. Without either a request costs two attribute checks.
+    """
+    metrics = None
+    timing = None
+    _request = None
+    _received = 0.0
+    _decoded = 0.0
+
+    def setup(self):
+        super(MeteredHandlerMixin, self).setup()
+        self.metrics = getattr(self.server, 'metrics', None)
+        self.timing = getattr(self.server, 'request_timing', None)
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+        if self.metrics is not None or self.timing is not None:
+            self.request = _HandlerSocket(self.request, self)
+
+    def finish(self):
+        if self.metrics is not None:
+            self.metrics.connection_closed()
+        super(MeteredHandlerMixin, self).finish()
+
+    def execute(self, request):
+        if self.metrics is None and not (self.timing is not None and
+                                         self.timing.hooks):
+            return super(MeteredHandlerMixin, self).execute(request)
+        self._request = request
+        self._decoded = _timer()
+        try:
+            super(MeteredHandlerMixin, self).execute(request)
+        finally:
+            self._request = None
+
+    def send(self, message):
+        if self._request is None:
+            return super(MeteredHandlerMixin, self).send(message)
+        executed = _timer()
+        sent = super(MeteredHandlerMixin, self).send(message)
+        done = _timer()
+        if self.metrics is not None:
+            self.metrics.record(message.unit_id, message.function_code,
+                                done - self._decoded)
+        if self.timing is not None and self.timing.hooks:
+            self.timing.record(message.unit_id, message.function_code,
+                               self._request, self._received, self._decoded,
+                               executed, done)
+        return sent
+
+
+class MeteredRequestHandler(MeteredHandlerMixin,
+                            ModbusConnectedRequestHandler):
+    pass
+
+
+class CustomSingleRequestHandler(MeteredHandlerMixin,
+                                 ModbusSingleRequestHandler):
 
     def __init__(self, request, client_address, server):
         self.request = request
@@ -86,6 +187,9 @@ class MbusSerialServer(ModbusSerialServer):
     handler = None
 
     def __init__(self, *args, **kwargs):
+        # set before the handler is built
+        self.metrics = kwargs.pop('metrics', None)
+        self.request_timing = kwargs.pop('request_timing', None)
         super(MbusSerialServer, self).__init__(*args, **kwargs)
         self._build_handler()
 
@@ -135,7 +239,11 @@ class ThreadedModbusServer(Thread):
         self._server.serve_forever()
 
     def stop(self):
-        if isinstance(self._server, ModbusTcpServer):
+        if isinstance(self._server, ModbusTcpServer) or (
+                AsyncModbusTcpServer is not None and
+                isinstance(self._server, AsyncModbusTcpServer)) or (
+                ModbusWorkerPool is not None and
+                isinstance(self._server, ModbusWorkerPool)):
             self._server.shutdown()
         else:
             if self._server.socket:
@@ -152,23 +260,75 @@ class ModbusSimu(object):
         self._server_type = server
         self._port = kwargs.get('port', None)
 
-        self.context = ModbusServerContext(single=False)
+        self.workers = int(kwargs.pop("workers", 1) or 1)
+        block_size = kwargs.pop("block_size", None)
+        shared_image = kwargs.pop("shared_image", None)
+        # paged blocks, memory only for the addresses written
+        self.sparse = kwargs.pop("sparse", False)
+        self.shared_image = None
+        if self.sparse and (self.workers > 1 or shared_image):
+            raise RuntimeError("Sparse blocks can't be laid over a shared "
+                               "register image")
+        if self.workers > 1 and server != "tcp":
+            raise RuntimeError("Multiple workers are only supported "
+                               "with the tcp server")
+        if self.workers > 1 or shared_image:
+            if SharedImage is None:
+                raise RuntimeError("Shared register image needs "
+                                   "Python 3.8+")
+            if not block_size:
+                raise RuntimeError("Shared register image needs a fixed "
+                                   "block size")
+            self.shared_image = SharedImage.create(int(block_size),
+                                                   name=shared_image)
+            log.info("Registers shared in '%s'", self.shared_image.name)
+            self.context = SharedServerContext(self.shared_image)
+        else:
+            self.context = ModbusServerContext(single=False)
         self.simulate = kwargs.get('simulate', False)
         byte_order = kwargs.pop("byte_order", "big")
         word_order = kwargs.pop("word_order", "big")
         self.byte_order = Endian.Big if byte_order == "big" else Endian.Little
         self.word_order = Endian.Big if word_order == "big" else Endian.Little
         self.dirty = False
+        self.use_asyncio = kwargs.pop("use_asyncio", False)
+        self.metrics = kwargs.pop("metrics", None)
+        self.request_timing = kwargs.pop("request_timing", None)
+        if self.workers > 1 and (self.metrics is not None or
+                                 self.request_timing is not None):
+            raise RuntimeError("Metrics and request timing are not "
+                               "collected across workers")
         if server == "tcp":
             self._port = int(self._port)
             self._address = kwargs.get("address", "localhost")
-            self.server = ModbusTcpServer(self.context,
-                                          identity=self.identity,
-                                          address=(self._address, self._port))
+            if self.workers > 1:
+                try:
+                    self.server = ModbusWorkerPool(
+                        self.shared_image, (self._address, self._port),
+                        self.workers, identity=self.identity)
+                except Exception:
+                    self.close()
+                    raise
+            elif self.use_asyncio:
+                if AsyncModbusTcpServer is None:
+                    raise RuntimeError("asyncio tcp server needs Python 3")
+                self.server = AsyncModbusTcpServer(
+                    self.context, identity=self.identity,
+                    address=(self._address, self._port))
+            else:
+                self.server = ModbusTcpServer(
+                    self.context, identity=self.identity,
+                    address=(self._address, self._port),
+                    handler=MeteredRequestHandler)
+            self.server.metrics = self.metrics
+            self.server.request_timing = self.request_timing
         else:
             self.server = MbusSerialServer(self.context,
                                            framer=ModbusRtuFramer,
-                                           identity=self.identity, **kwargs)
+                                           identity=self.identity,
+                                           metrics=self.metrics,
+                                           request_timing=self.request_timing,
+                                           **kwargs)
         self.server_thread = ThreadedModbusServer(self.server)
 
     def _add_device_info(self):
@@ -188,11 +348,18 @@ class ModbusSimu(object):
         return self._port
 
     def _add_default_slave_context(self):
+        if self.sparse:
+            return ModbusSlaveContext(
+                di=PagedBitDataBlock(),
+                hr=PagedRegisterDataBlock(),
+                co=PagedBitDataBlock(),
+                ir=PagedRegisterDataBlock(),
+            )
         return ModbusSlaveContext(
-            di=CustomDataBlock(0, 0),
-            hr=CustomDataBlock(0, 0),
-            co=CustomDataBlock(0, 0),
-            ir=CustomDataBlock(0, 0),
+            di=BitDataBlock(),
+            hr=RegisterDataBlock(),
+            co=BitDataBlock(),
+            ir=RegisterDataBlock(),
 
         )
 
@@ -209,13 +376,43 @@ class ModbusSimu(object):
             return address - 40001 if address >= 40001 else address
 
     def add_slave(self, slave_id):
-        self.context[slave_id] = self._add_default_slave_context()
+        if self.shared_image is not None:
+            # tables are preallocated in the shared image
+            self.context[slave_id] = None
+        else:
+            self.context[slave_id] = self._add_default_slave_context()
+
+    def make_template(self, slave_id):
+        """
+        Read-only copy of the current registers of ``slave_id`` for
+        :meth:`add_slave_from_template`.
+        """
+        if self.shared_image is not None:
+            raise RuntimeError("Slave templates aren't supported with a "
+                               "shared register image")
+        return SlaveTemplate.from_store(self.get_slave(slave_id).store)
+
+    def add_slave_from_template(self, slave_id, template):
+        """
+        Adds ``slave_id`` with the registers of ``template``, shared until
+        written (copy on write, one page at a time).
+        """
+        if self.shared_image is not None:
+            raise RuntimeError("Slave templates aren't supported with a "
+                               "shared register image")
+        blocks = template.blocks()
+        self.context[slave_id] = ModbusSlaveContext(
+            di=blocks['d'], co=blocks['c'], hr=blocks['h'], ir=blocks['i'])
 
     def remove_slave(self, slave_id):
         del self.context[slave_id]
 
     def remove_all_slave(self):
-        self.context = ModbusServerContext(single=False)
+        if self.shared_image is not None:
+            for slave_id in list(self.context.slaves()):
+                del self.context[slave_id]
+        else:
+            self.context = ModbusServerContext(single=False)
 
     def add_block(self, slave_id, block_name, block_type, starting_add, size):
         slave = self.get_slave(slave_id)
@@ -248,6 +445,34 @@ class ModbusSimu(object):
     def get_slave(self, slave_id):
         return self.context[slave_id]
 
+    def pop_dirty(self, slave_id, block_name):
+        """
+        Offset ranges written to a block since the last call, as
+        (offset, count) tuples.
+        """
+        slave = self.get_slave(slave_id)
+        block = slave.store[_STORE_MAPPER[block_name]]
+        # the slave context shifts addresses by one unless in zero mode
+        shift = block.address - (0 if slave.zero_mode else 1)
+        ranges = []
+        for start, count in block.dirty.pop():
+            start += shift
+            if start < 0:
+                count += start
+                start = 0
+            ranges.append((start, count))
+        return ranges
+
+    def get_block_tracker(self, slave_id, block_name):
+        """
+        DirtyTracker of a block as (shift, size, tracker), position p of the
+        tracker is register offset p + shift.
+        """
+        slave = self.get_slave(slave_id)
+        block = slave.store[_STORE_MAPPER[block_name]]
+        shift = block.address - (0 if slave.zero_mode else 1)
+        return shift, len(block), block.dirty
+
     def decode(self, slave_id, block_name, offset, formatter):
         count = 1
         if '32' in formatter:
@@ -271,6 +496,45 @@ class ModbusSimu(object):
         payload = builder.to_registers()
         return self.set_values(slave_id, block_name, offset, payload)
 
+    def _range_codec(self, layout, count):
+        if isinstance(layout, (list, tuple)):
+            return get_layout_codec(layout, self.byte_order, self.word_order)
+        return get_codec(layout, count, self.byte_order, self.word_order)
+
+    def decode_range(self, slave_id, block_name, address, layout, count=1):
+        """
+        Decodes a span of registers with a single struct call.
+
+        :param address: Address of the first register of the span
+        :param layout: A formatter, to decode `count` consecutive values of
+            it, or a list of (offset, formatter) with offsets relative to
+            `address`
+        :param count: Number of values, only used with a formatter
+        :return: List of values, None if the span is out of the block
+        """
+        codec = self._range_codec(layout, count)
+        values = self.get_values(slave_id, block_name, address, codec.words)
+        if values:
+            return list(codec.decode(values))
+
+    def encode_range(self, slave_id, block_name, address, values, layout):
+        """
+        Encodes `values` and writes them with one set_values per contiguous
+        run of registers, registers in gaps of the layout are left as is.
+
+        :param layout: A formatter for all values or a list of
+            (offset, formatter) with offsets relative to `address`
+        """
+        codec = self._range_codec(layout, len(values))
+        start = self._calc_offset(block_name, address)
+        if isinstance(layout, (list, tuple)):
+            for offset, registers in codec.encode(values):
+                self.set_values(slave_id, block_name, start + offset,
+                                list(registers))
+        else:
+            self.set_values(slave_id, block_name, start,
+                            list(codec.encode(values)))
+
     def start(self):
         if self.dirty:
             self.server_thread = ThreadedModbusServer(self.server)
@@ -283,6 +547,16 @@ class ModbusSimu(object):
         #     self._serial.close()
         # self._server_add = ()
 
+    def close(self):
+        """
+        Releases the shared register image, if any. Call once the server is
+        stopped for good.
+        """
+        if self.shared_image is not None:
+            self.shared_image.close()
+            self.shared_image.unlink()
+            self.shared_image = None
+
     def get_slaves(self):
         if self.server is not None:
             return self.server._databank._slaves
@@ -0,0 +1,468 @@
+"""
+Register maps
+=============
+
+Imports a vendor register map from a CSV file. The first row names the
+columns, in any order; other columns (names, units, descriptions) are
+ignored::
+
+    slave,address,type,formatter,scale,value,profile,interval
+    ,40001,holding_registers,float32,0.1,230,sine offset=230 amplitude=5,
+    ,40003,h,uint16,1,50,,
+    2,30001,input_registers,int32,0.01,-12.5,noise value=-12.5 noise=0.2,0.5
+    ,1,coils,,,1,square period=10,
+
+- ``address``: address as in the state file (40001) or offset in the block,
+  the only required column
+- ``type``: block name or alias (c, d, i, h), from the address when empty
+- ``formatter``: register formatter, uint16 by default
+- ``scale``: engineering value = register value * scale, 1 by default
+- ``value``: initial engineering value, 0 by default
+- ``profile``: waveform profile (see :mod:`modbus_simulator.utils.waveforms`)
+  as ``type name=value ...`` with ``|`` separated steps values, or as a JSON
+  object, its parameters in engineering units
+- ``interval``: update period of the profile in seconds
+- ``slave``: slave id, the entry applies to every slave when empty
+
+The map is compiled once into a flat plan per slave and block: parallel
+arrays of offsets, formatters, scales and values sorted by offset, one
+:class:`~modbus_simulator.utils.codec.LayoutCodec` for the whole block and
+a simulation :class:`~modbus_simulator.utils.simulation.BlockPlan` of the
+profiled entries, with the profile parameters scaled to register values.
+Writing the map takes one codec call per block and one ``set_values`` per
+contiguous span, no per register dict is built.
+"""
+from __future__ import absolute_import, division
+
+import csv
+import io
+import json
+import logging
+from array import array
+
+import six
+
+from modbus_simulator.utils.codec import (FORMATTERS, LIMITS, LayoutCodec,
+                                          is_big, word_count)
+from modbus_simulator.utils.constants import ADDRESS_BASE, BLOCK_ALIASES
+from modbus_simulator.utils.simulation import compile_entries
+from modbus_simulator.utils.waveforms import validate
+
+if six.PY3:
+    xrange = range
+
+log = logging.getLogger(__name__)
+
+REGISTERS = ('input_registers', 'holding_registers')
+COLUMNS = ('slave', 'address', 'type', 'formatter', 'scale', 'value',
+           'profile', 'interval')
+# profile parameters in engineering units
+SCALED = ('offset', 'amplitude', 'low', 'high', 'start', 'step', 'value',
+          'noise', 'values')
+# update period of the profiles without an interval, seconds
+DEFAULT_INTERVAL = 1.0
+
+
+def _open(path):
+    if six.PY3:
+        return io.open(path, 'r', newline='')
+    return open(path, 'rb')
+
+
+def block_of(address):
+    """
+    Block of a state file address, coils below 10001.
+    """
+    for block_name in ('holding_registers', 'input_registers',
+                       'discrete_inputs'):
+        if address >= ADDRESS_BASE[block_name]:
+            return block_name
+    return 'coils'
+
+
+def parse_profile(text):
+    """
+    Profile of a map cell, ``type name=value ...`` or a JSON object.
+
+    :return: Profile as returned by :func:`validate`
+    :raises ValueError: Malformed or invalid profile
+    """
+    if text.startswith('{'):
+        return validate(json.loads(text))
+    words = text.split()
+    profile = {'type': words[0]}
+    for word in words[1:]:
+        name, sep, value = word.partition('=')
+        if not sep:
+            raise ValueError("Invalid profile parameter '%s'" % word)
+        profile[name] = value.split('|') if name == 'values' else value
+    return validate(profile)
+
+
+def scale_profile(profile, scale):
+    """
+    Profile in register values of a profile in engineering units.
+    """
+    if profile is None or scale == 1:
+        return profile
+    scaled = dict(profile)
+    for name in SCALED:
+        if name not in scaled:
+            continue
+        if name == 'values':
+            scaled[name] = [value / scale for value in scaled[name]]
+        else:
+            scaled[name] = scaled[name] / scale
+    if 'noise' in scaled:
+        scaled['noise'] = abs(scaled['noise'])
+    if scaled['type'] == 'random_walk':
+        scaled['step'] = abs(scaled['step'])
+        if scaled['low'] > scaled['high']:
+            scaled['low'], scaled['high'] = scaled['high'], scaled['low']
+    return scaled
+
+
+class BlockMap(object):
+    """
+    Entries of one block in parallel arrays, in offset order once
+    compiled. Profiles are kept by entry index, intervals are 0 for the
+    default update period.
+    """
+    def __init__(self, block_name):
+        self.block_name = block_name
+        self.registers = block_name in REGISTERS
+        self.offsets = array(str('i'))
+        self.formatters = []
+        self.scales = array(str('d'))
+        self.values = array(str('d'))
+        self.intervals = array(str('d'))
+        self.profiles = {}
+        self.first = 0
+        self.end = 0
+        self._codecs = {}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def add(self, offset, formatter, scale, value, profile, interval):
+        if profile is not None:
+            self.profiles[len(self.offsets)] = profile
+        self.offsets.append(offset)
+        self.formatters.append(formatter)
+        self.scales.append(scale)
+        self.values.append(value)
+        self.intervals.append(interval)
+
+    def extend(self, other):
+        base = len(self.offsets)
+        self.offsets.extend(other.offsets)
+        self.formatters.extend(other.formatters)
+        self.scales.extend(other.scales)
+        self.values.extend(other.values)
+        self.intervals.extend(other.intervals)
+        self.profiles.update((base + index, profile)
+                             for index, profile in other.profiles.items())
+
+    def compile(self):
+        """
+        Sorts the entries by offset.
+
+        :raises ValueError: Overlapping entries
+        """
+        offsets = self.offsets
+        order = sorted(xrange(len(offsets)), key=offsets.__getitem__)
+        if order != list(xrange(len(offsets))):
+            self.offsets = array(str('i'), [offsets[i] for i in order])
+            self.formatters = [self.formatters[i] for i in order]
+            self.scales = array(str('d'), [self.scales[i] for i in order])
+            self.values = array(str('d'), [self.values[i] for i in order])
+            self.intervals = array(str('d'),
+                                   [self.intervals[i] for i in order])
+            positions = dict((index, position)
+                             for position, index in enumerate(order))
+            self.profiles = dict((positions[index], profile)
+                                 for index, profile in self.profiles.items())
+        end = None
+        for offset, formatter in zip(self.offsets, self.formatters):
+            if end is not None and offset < end:
+                raise ValueError("%s %d overlaps the previous entry" % (
+                    self.block_name, ADDRESS_BASE[self.block_name] + offset))
+            end = offset + (word_count(formatter) if formatter else 1)
+        self.first = self.offsets[0] if self.offsets else 0
+        self.end = end or 0
+        self._codecs = {}
+        return self
+
+    def codec(self, byte_order='big', word_order='big'):
+        """
+        :class:`LayoutCodec` of the registers from ``first`` to ``end``.
+        """
+        key = (is_big(byte_order), is_big(word_order))
+        codec = self._codecs.get(key)
+        if codec is None:
+            first = self.first
+            codec = self._codecs[key] = LayoutCodec(
+                [(offset - first, formatter) for offset, formatter
+                 in zip(self.offsets, self.formatters)],
+                byte_order, word_order)
+        return codec
+
+    def register_values(self, values=None):
+        """
+        Engineering values (the initial values by default) scaled to
+        register values, rounded and clamped to the formatters.
+        """
+        values = self.values if values is None else values
+        if not self.registers:
+            return [1 if value else 0 for value in values]
+        fitted = []
+        for value, scale, formatter in zip(values, self.scales,
+                                           self.formatters):
+            low, high = LIMITS[formatter]
+            value = value / scale
+            if 'float' not in formatter:
+                value = int(round(value))
+            fitted.append(min(max(value, low), high))
+        return fitted
+
+    def encode(self, values=None, byte_order='big', word_order='big'):
+        """
+        :return: [(offset, registers)] of every contiguous span
+        """
+        fitted = self.register_values(values)
+        if self.registers:
+            return [(self.first + offset, list(registers)) for
+                    offset, registers in self.codec(
+                        byte_order, word_order).encode(fitted)]
+        spans = []
+        end = None
+        for offset, bit in zip(self.offsets, fitted):
+            if offset != end:
+                spans.append((offset, []))
+            spans[-1][1].append(bit)
+            end = offset + 1
+        return spans
+
+    def decode(self, registers, byte_order='big', word_order='big'):
+        """
+        Engineering values of the entries, from the registers ``first`` to
+        ``end`` of the block.
+        """
+        if not self.registers:
+            first = self.first
+            return [registers[offset - first] for offset in self.offsets]
+        return [value * scale for value, scale in zip(
+            self.codec(byte_order, word_order).decode(registers),
+            self.scales)]
+
+    def simulation_plan(self):
+        """
+        :class:`BlockPlan` of the profiled entries, None without any.
+        """
+        if not self.profiles:
+            return None
+        base = ADDRESS_BASE[self.block_name]
+        entries = []
+        for index in sorted(self.profiles):
+            offset = self.offsets[index]
+            entries.append((offset, base + offset, self.formatters[index],
+                            self.profiles[index],
+                            self.intervals[index] or None))
+        return compile_entries(entries)
+
+
+class RegisterMap(object):
+    """
+    Compiled register map, :class:`BlockMap` by (slave id, block name), the
+    slave id is None for the entries of every slave. The blocks of a slave
+    include the entries of every slave.
+    """
+    def __init__(self, blocks, path=None, points=0):
+        self.blocks = blocks
+        self.path = path
+        self.points = points
+
+    def __len__(self):
+        return self.points
+
+    @property
+    def slave_ids(self):
+        """
+        Slaves with entries of their own.
+        """
+        return sorted(set(slave_id for slave_id, _ in self.blocks
+                          if slave_id is not None))
+
+    def extents(self):
+        """
+        {block name: end offset} over every slave.
+        """
+        extents = {}
+        for (_, block_name), block in self.blocks.items():
+            extents[block_name] = max(extents.get(block_name, 0), block.end)
+        return extents
+
+    def slave_blocks(self, slave_id):
+        """
+        :class:`BlockMap` list of a slave.
+        """
+        blocks = []
+        for block_name in ADDRESS_BASE:
+            block = self.blocks.get((slave_id, block_name),
+                                    self.blocks.get((None, block_name)))
+            if block is not None:
+                blocks.append(block)
+        return blocks
+
+    def apply(self, modbus_device, slave_ids, byte_order='big',
+              word_order='big'):
+        """
+        Writes the initial values of the map to the slaves, every block is
+        encoded once whatever the number of slaves.
+        """
+        encoded = {}
+        for slave_id in slave_ids:
+            for block in self.slave_blocks(slave_id):
+                spans = encoded.get(id(block))
+                if spans is None:
+                    spans = encoded[id(block)] = block.encode(
+                        byte_order=byte_order, word_order=word_order)
+                base = ADDRESS_BASE[block.block_name]
+                for offset, registers in spans:
+                    modbus_device.set_values(slave_id, block.block_name,
+                                             base + offset, registers)
+
+    def read(self, modbus_device, slave_id, block_name, byte_order='big',
+             word_order='big'):
+        """
+        Current engineering values of the entries of a block of a slave.
+        """
+        block = self.blocks.get((slave_id, block_name),
+                                self.blocks.get((None, block_name)))
+        if block is None or not len(block):
+            return []
+        registers = modbus_device.get_values(
+            slave_id, block_name, ADDRESS_BASE[block_name] + block.first,
+            block.end - block.first)
+        return block.decode(registers, byte_order, word_order)
+
+    def simulate(self, engine, slave_ids):
+        """
+        Hands the profiled entries to a
+        :class:`~modbus_simulator.utils.simulation.SimulationEngine`, the
+        profile state is per slave so every slave gets its own plan.
+
+        :return: Names of the blocks with profiles
+        """
+        simulated = set()
+        for slave_id in slave_ids:
+            for block in self.slave_blocks(slave_id):
+                plan = block.simulation_plan()
+                if plan is not None:
+                    engine.set_plan(slave_id, block.block_name, plan)
+                    simulated.add(block.block_name)
+        return simulated
+
+
+def _cell(row, index):
+    if index is None or index >= len(row):
+        return ''
+    return row[index].strip()
+
+
+def _address(text):
+    if text[:2].lower() == '0x':
+        return int(text, 16)
+    return int(text)
+
+
+def load_register_map(path):
+    """
+    Reads and compiles a register map file.
+
+    :return: :class:`RegisterMap`
+    :raises ValueError: Missing address column, invalid or overlapping
+        entries
+    """
+    with _open(path) as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if not header:
+            raise ValueError("Register map '%s' is empty" % path)
+        names = [name.strip().lower() for name in header]
+        if 'address' not in names:
+            raise ValueError("Register map '%s' has no address column"
+                             % path)
+        (slave_column, address_column, type_column, formatter_column,
+         scale_column, value_column, profile_column, interval_column) = [
+            names.index(name) if name in names else None
+            for name in COLUMNS]
+        blocks = {}
+        profiles = {}
+        points = 0
+        for line, row in enumerate(reader, 2):
+            if not any(row):
+                continue
+            try:
+                address = _address(_cell(row, address_column))
+                kind = _cell(row, type_column).lower()
+                if kind:
+                    block_name = BLOCK_ALIASES.get(kind, kind)
+                    if block_name not in ADDRESS_BASE:
+                        raise ValueError("unknown type '%s'" % kind)
+                else:
+                    block_name = block_of(address)
+                base = ADDRESS_BASE[block_name]
+                offset = address - base if base and address >= base \
+                    else address
+                if not 0 <= offset <= 0xffff:
+                    raise ValueError("address %d out of range" % address)
+                scale = 1.0
+                formatter = None
+                if block_name in REGISTERS:
+                    formatter = _cell(row, formatter_column).lower() or \
+                        'uint16'
+                    if formatter not in FORMATTERS:
+                        raise ValueError("unknown formatter '%s'"
+                                         % formatter)
+                    scale = float(_cell(row, scale_column) or 1)
+                    if not scale:
+                        raise ValueError("scale can't be 0")
+                value = float(_cell(row, value_column) or 0)
+                interval = float(_cell(row, interval_column) or 0)
+                if interval < 0:
+                    raise ValueError("interval must be positive")
+                profile = None
+                text = _cell(row, profile_column)
+                if text:
+                    key = (text, scale)
+                    if key not in profiles:
+                        profiles[key] = scale_profile(parse_profile(text),
+                                                      scale)
+                    profile = profiles[key]
+                slave = _cell(row, slave_column)
+                slave_id = int(slave) if slave else None
+                if slave_id is not None and not 1 <= slave_id <= 247:
+                    raise ValueError("slave %d out of range" % slave_id)
+            except ValueError as e:
+                raise ValueError("Register map '%s' line %d: %s"
+                                 % (path, line, e))
+            block = blocks.get((slave_id, block_name))
+            if block is None:
+                block = blocks[(slave_id, block_name)] = BlockMap(block_name)
+            block.add(offset, formatter, scale, value, profile, interval)
+            points += 1
+
+    for (slave_id, block_name), block in blocks.items():
+        shared = blocks.get((None, block_name))
+        if slave_id is not None and shared is not None:
+            block.extend(shared)
+    for (slave_id, _), block in blocks.items():
+        try:
+            block.compile()
+        except ValueError as e:
+            raise ValueError("Register map '%s'%s: %s" % (
+                path, "" if slave_id is None else " slave %d" % slave_id, e))
+    log.debug("Register map '%s': %d entries in %d block(s)", path, points,
+              len(blocks))
+    return RegisterMap(blocks, path, points)
@@ -0,0 +1,281 @@
+"""
+Trace replay
+============
+
+Plays recorded field data back into a :class:`ModbusSimu`. A trace is a CSV
+file with the timestamp in the first column (seconds, or an ISO 8601 date
+and time) and one column per register::
+
+    timestamp,1:holding_registers:40001:float32,1:coils:1,2:h:40010
+    0.0,12.5,1,100
+    0.1,12.7,,101
+
+A register column header is ``slave:block:address[:formatter]``, with block
+names as in the state file or their shared image aliases (c, d, i, h). The
+formatter of registers defaults to uint16. An empty cell leaves the register
+as is.
+
+Rows are streamed from the file, so memory use doesn't depend on the trace
+length. Every ``tick`` seconds the rows due at the current trace time
+(``speed`` times faster than real time) are merged, with the last value of a
+register winning. The result is written with one ``set_values`` per
+contiguous register span.
+"""
+from __future__ import absolute_import
+
+import csv
+import io
+import logging
+import threading
+import time
+from datetime import datetime
+
+import six
+
+from modbus_simulator.utils.codec import (FORMATTERS, LIMITS, get_codec,
+                                          word_count)
+from modbus_simulator.utils.constants import ADDRESS_BASE, BLOCK_ALIASES
+from modbus_simulator.utils.scheduler import get_scheduler
+
+log = logging.getLogger(__name__)
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+REGISTERS = ('input_registers', 'holding_registers')
+
+
+class Column(object):
+    """
+    Register of a trace column.
+    """
+    __slots__ = ('slave_id', 'block_name', 'offset', 'formatter', 'words')
+
+    def __init__(self, slave_id, block_name, offset, formatter):
+        self.slave_id = slave_id
+        self.block_name = block_name
+        self.offset = offset
+        self.formatter = formatter
+        self.words = word_count(formatter) if formatter else 1
+
+    def parse(self, text):
+        value = float(text)
+        if self.formatter is None:
+            return 1 if value else 0
+        # out of range values can't be encoded, keep them in range
+        low, high = LIMITS[self.formatter]
+        if 'float' in self.formatter:
+            return min(max(value, low), high)
+        return min(max(int(round(value)), low), high)
+
+
+def parse_column(header, calc_offset):
+    """
+    :class:`Column` of a ``slave:block:address[:formatter]`` header.
+
+    :raises ValueError: Malformed header
+    """
+    parts = header.strip().split(':')
+    if len(parts) not in (3, 4):
+        raise ValueError("Trace column '%s' is not "
+                         "slave:block:address[:formatter]" % header)
+    block_name = BLOCK_ALIASES.get(parts[1], parts[1])
+    if block_name not in ADDRESS_BASE:
+        raise ValueError("Unknown block '%s' in trace column '%s'"
+                         % (parts[1], header))
+    formatter = None
+    if block_name in REGISTERS:
+        formatter = parts[3] if len(parts) == 4 else 'uint16'
+        if formatter not in FORMATTERS:
+            raise ValueError("Unknown formatter '%s' in trace column '%s'"
+                             % (formatter, header))
+    return Column(int(parts[0]), block_name,
+                  calc_offset(block_name, int(parts[2])), formatter)
+
+
+def parse_timestamp(text):
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S",
+                "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
+        try:
+            moment = datetime.strptime(text.strip(), fmt)
+        except ValueError:
+            continue
+        return (moment - datetime(1970, 1, 1)).total_seconds()
+    raise ValueError("Invalid trace timestamp '%s'" % text)
+
+
+def _open(path):
+    if six.PY3:
+        return io.open(path, 'r', newline='')
+    return open(path, 'rb')
+
+
+def trace_columns(path):
+    """
+    Register column headers of a trace file.
+    """
+    with _open(path) as f:
+        header = next(csv.reader(f), None)
+    if not header:
+        raise ValueError("Trace '%s' is empty" % path)
+    return header[1:]
+
+
+def read_trace(path):
+    """
+    Streams the rows of a trace file, (timestamp, cells) past the header.
+    """
+    with _open(path) as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for line, row in enumerate(reader, 2):
+            if not row:
+                continue
+            try:
+                timestamp = parse_timestamp(row[0])
+            except ValueError as e:
+                log.warning("Trace '%s' line %d skipped: %s", path, line, e)
+                continue
+            yield timestamp, row[1:]
+
+
+class TraceReplay(object):
+    """
+    Replays a trace into ``modbus_device`` from a job on the shared
+    scheduler, at ``speed`` times real time. The trace starts over at the
+    end with ``loop``.
+    """
+    def __init__(self, modbus_device, path, speed=1.0, loop=False,
+                 tick=0.05, scheduler=None):
+        if speed <= 0:
+            raise ValueError("Replay speed must be positive")
+        self.modbus_device = modbus_device
+        self.path = path
+        self.speed = float(speed)
+        self.loop = loop
+        self.scheduler = scheduler or get_scheduler()
+        self.columns = [parse_column(header, modbus_device._calc_offset)
+                        for header in trace_columns(path)]
+        self.rows = 0
+        self.passes = 0
+        self._rows = None
+        self._next_row = None
+        self._trace_start = None
+        self._wall_start = None
+        self._finished = threading.Event()
+        self._job = self.scheduler.job("replay", tick, self._step)
+
+    @property
+    def finished(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the end of the trace (never returns True with ``loop``).
+        """
+        return self._finished.wait(timeout)
+
+    def start(self):
+        self._finished.clear()
+        self._restart()
+        self._job.start()
+        log.info("Replaying trace '%s' (%d registers) at %gx", self.path,
+                 len(self.columns), self.speed)
+
+    def stop(self):
+        self._job.cancel()
+        self._job.join()
+        if self._rows is not None:
+            self._rows.close()
+            self._rows = None
+
+    def _restart(self):
+        if self._rows is not None:
+            self._rows.close()
+        self._rows = read_trace(self.path)
+        self._next_row = next(self._rows, None)
+        self._trace_start = self._next_row[0] if self._next_row else None
+        self._wall_start = _monotonic()
+
+    def _step(self):
+        if self._next_row is None:
+            return
+        due = self._trace_start + (_monotonic() - self._wall_start) * \
+            self.speed
+        pending = {}
+        while self._next_row is not None and self._next_row[0] <= due:
+            for index, text in enumerate(self._next_row[1]):
+                if text.strip():
+                    pending[index] = text
+            self.rows += 1
+            self._next_row = next(self._rows, None)
+        if pending:
+            self._write(pending)
+        if self._next_row is None:
+            self.passes += 1
+            if self.loop:
+                self._restart()
+            else:
+                log.info("Trace '%s' replayed (%d rows)", self.path,
+                         self.rows)
+                self._job.cancel()
+                self._finished.set()
+
+    def _write(self, pending):
+        """
+        Writes {column index: cell} grouped in contiguous register spans.
+        """
+        blocks = {}
+        for index, text in pending.items():
+            if index >= len(self.columns):
+                continue
+            column = self.columns[index]
+            try:
+                value = column.parse(text)
+            except ValueError:
+                log.debug("Invalid value '%s' for trace column %d", text,
+                          index)
+                continue
+            blocks.setdefault((column.slave_id, column.block_name),
+                              []).append((column, value))
+        for (slave_id, block_name), entries in blocks.items():
+            entries.sort(key=lambda entry: entry[0].offset)
+            spans = []
+            for column, value in entries:
+                if spans and spans[-1][1] == column.offset:
+                    span = spans[-1]
+                else:
+                    span = [column.offset, column.offset, []]
+                    spans.append(span)
+                span[2].append((column.formatter, value))
+                span[1] = column.offset + column.words
+            for start, _, values in spans:
+                self._write_span(slave_id, block_name, start, values)
+
+    def _write_span(self, slave_id, block_name, start, values):
+        registers = []
+        position = 0
+        while position < len(values):
+            formatter = values[position][0]
+            end = position
+            while end < len(values) and values[end][0] == formatter:
+                end += 1
+            run = [value for _, value in values[position:end]]
+            if formatter is None:
+                registers.extend(run)
+            else:
+                codec = get_codec(formatter, len(run),
+                                  self.modbus_device.byte_order,
+                                  self.modbus_device.word_order)
+                registers.extend(codec.encode(run))
+            position = end
+        try:
+            self.modbus_device.set_values(
+                slave_id, block_name, ADDRESS_BASE[block_name] + start,
+                registers)
+        except Exception as e:
+            log.debug("Replay write to %s %s@%d failed: %s", slave_id,
+                      block_name, start, e)
@@ -0,0 +1,147 @@
+"""
+Request timing
+==============
+
+Phase timings of the requests served by the pymodbus backend, handed to
+pluggable hooks. A request goes through three phases:
+
+- framing: from the bytes completing the request being read to the request
+  being decoded by the framer
+- datastore: executing the request against the slave context
+- write: building and sending the response
+
+A :class:`RequestTiming` attached to the server (``request_timing``
+argument of :class:`ModbusSimu`) calls every hook with a
+:class:`RequestSample`. The request handlers only check whether the
+:class:`RequestTiming` has a hook, so timing costs nothing until one is
+added. :class:`SlowRequestLog` is a hook that keeps the slowest requests.
+"""
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class RequestSample(object):
+    """
+    Phase timings of one request, seconds.
+    """
+    __slots__ = ('slave_id', 'function_code', 'address', 'count',
+                 'framing', 'datastore', 'write', 'timestamp')
+
+    def __init__(self, slave_id, function_code, address, count, framing,
+                 datastore, write):
+        self.slave_id = slave_id
+        self.function_code = function_code
+        self.address = address
+        self.count = count
+        self.framing = framing
+        self.datastore = datastore
+        self.write = write
+        self.timestamp = time.time()
+
+    @property
+    def duration(self):
+        return self.framing + self.datastore + self.write
+
+    @property
+    def exception(self):
+        return bool(self.function_code & 0x80)
+
+    def as_dict(self):
+        return dict(slave_id=self.slave_id,
+                    function_code=self.function_code & 0x7f,
+                    exception=self.exception, address=self.address,
+                    count=self.count, framing=self.framing,
+                    datastore=self.datastore, write=self.write,
+                    duration=self.duration, timestamp=self.timestamp)
+
+    def __repr__(self):
+        return ("<request slave %s fc %d @%s[%s] %.2f ms: framing %.2f, "
+                "datastore %.2f, write %.2f>" % (
+                    self.slave_id, self.function_code & 0x7f, self.address,
+                    self.count, self.duration * 1000, self.framing * 1000,
+                    self.datastore * 1000, self.write * 1000))
+
+
+class RequestTiming(object):
+    """
+    Hooks called with a :class:`RequestSample` for one request out of
+    ``sample_every``, from the thread serving the request.
+    """
+    def __init__(self, sample_every=1):
+        self.sample_every = max(int(sample_every), 1)
+        # replaced, not mutated, so handlers can iterate without a lock
+        self.hooks = ()
+        self._lock = threading.Lock()
+        self._seen = 0
+
+    def add_hook(self, hook):
+        with self._lock:
+            self.hooks = self.hooks + (hook,)
+        return hook
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self.hooks = tuple(h for h in self.hooks if h is not hook)
+
+    def record(self, slave_id, function_code, request, received, decoded,
+               executed, done):
+        """
+        Called by the request handlers with the timer values taken at the
+        end of every phase.
+        """
+        if self.sample_every > 1:
+            self._seen += 1
+            if self._seen % self.sample_every:
+                return
+        sample = RequestSample(
+            slave_id, function_code, getattr(request, 'address', None),
+            getattr(request, 'count', 1),
+            max(decoded - received, 0.0) if received else 0.0,
+            executed - decoded, done - executed)
+        for hook in self.hooks:
+            try:
+                hook(sample)
+            except Exception:
+                log.exception("Request timing hook %r failed", hook)
+
+
+class SlowRequestLog(object):
+    """
+    Hook keeping the last ``size`` requests that took ``threshold`` seconds
+    or more. Slow requests are logged too, at most once per ``log_interval``
+    seconds.
+    """
+    def __init__(self, threshold=0.1, size=100, log_interval=1.0):
+        self.threshold = threshold
+        self.entries = deque(maxlen=size)
+        self.count = 0
+        self.log_interval = log_interval
+        self._last_log = 0.0
+        self._suppressed = 0
+
+    def __call__(self, sample):
+        if sample.duration < self.threshold:
+            return
+        self.entries.append(sample)
+        self.count += 1
+        now = _monotonic()
+        if now - self._last_log < self.log_interval:
+            self._suppressed += 1
+            return
+        self._last_log = now
+        suppressed, self._suppressed = self._suppressed, 0
+        log.warning("Slow request %r%s", sample,
+                    " (%d more since last report)" % suppressed
+                    if suppressed else "")
+
+    def slowest(self, count=10):
+        return sorted(self.entries, key=lambda sample: sample.duration,
+                      reverse=True)[:count]
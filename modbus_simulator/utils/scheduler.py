@@ -0,0 +1,224 @@
+"""
+Periodic job scheduler
+======================
+
+Runs every periodic job of the simulator (simulation ticks, modbus sync,
+journal flush) on one worker thread instead of one thread per job.
+
+Jobs are kept in a heap ordered by their next deadline on the monotonic
+clock. A tick is due at ``previous deadline + interval`` whatever the run
+took, so the period doesn't drift by the duration of the work. A run that
+ends past one or more following deadlines skips them and counts them as
+overruns. Every job records its jitter (how late a run started past its
+deadline) and run times, see :meth:`PeriodicJob.stats`.
+"""
+from __future__ import absolute_import
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+import weakref
+
+log = logging.getLogger(__name__)
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class PeriodicJob(object):
+    """
+    ``function`` called every ``interval`` seconds by a :class:`Scheduler`
+    worker, first run on :meth:`start`. A cancelled job may be started
+    again.
+    """
+    def __init__(self, scheduler, name, interval, function):
+        self.scheduler = scheduler
+        self.name = name
+        self.function = function
+        self._interval = float(interval)
+        self._active = False
+        self._generation = 0
+        self._last_deadline = None
+        self._idle = threading.Event()
+        self._idle.set()
+        self.runs = 0
+        self.overruns = 0
+        self.last_jitter = 0.0
+        self.max_jitter = 0.0
+        self.total_jitter = 0.0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+
+    @property
+    def interval(self):
+        return self._interval
+
+    @interval.setter
+    def interval(self, value):
+        self._interval = float(value)
+        self.scheduler.reschedule(self)
+
+    def start(self):
+        self.scheduler.schedule(self)
+
+    def cancel(self):
+        self.scheduler.unschedule(self)
+
+    def join(self, timeout=None):
+        """
+        Waits for a run in progress to end (not when called from the job).
+        """
+        if threading.current_thread() is not self.scheduler.thread:
+            self._idle.wait(timeout)
+
+    def is_alive(self):
+        return self._active
+
+    def _record(self, deadline, started, finished):
+        jitter = max(started - deadline, 0.0)
+        duration = finished - started
+        self.runs += 1
+        self.last_jitter = jitter
+        self.max_jitter = max(self.max_jitter, jitter)
+        self.total_jitter += jitter
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+
+    def stats(self):
+        """
+        Run counters, times in seconds.
+        """
+        return dict(
+            name=self.name, interval=self._interval, runs=self.runs,
+            overruns=self.overruns, last_jitter=self.last_jitter,
+            max_jitter=self.max_jitter,
+            mean_jitter=self.total_jitter / self.runs if self.runs else 0.0,
+            last_duration=self.last_duration, max_duration=self.max_duration
+        )
+
+
+class Scheduler(object):
+    """
+    Deadline heap of :class:`PeriodicJob`, the worker thread starts with the
+    first scheduled job.
+    """
+    def __init__(self, name="scheduler"):
+        self.name = name
+        self.thread = None
+        # jobs dropped by their owner go away with them
+        self.jobs = weakref.WeakSet()
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    def job(self, name, interval, function):
+        """
+        New (not started) job run by this scheduler.
+        """
+        return self.add(PeriodicJob(self, name, interval, function))
+
+    def add(self, job):
+        with self._condition:
+            self.jobs.add(job)
+        return job
+
+    def _push(self, job, deadline):
+        # entries of an older generation are dropped when they surface
+        heapq.heappush(self._heap, (deadline, next(self._counter),
+                                    job._generation, job))
+        self._condition.notify()
+
+    def schedule(self, job):
+        with self._condition:
+            if job._active:
+                return
+            job._active = True
+            job._generation += 1
+            job._last_deadline = None
+            self._push(job, _monotonic())
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                                               name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def unschedule(self, job):
+        with self._condition:
+            job._active = False
+            job._generation += 1
+
+    def reschedule(self, job):
+        """
+        Moves the next run of ``job`` after an interval change.
+        """
+        with self._condition:
+            if not job._active or job._last_deadline is None:
+                return
+            job._generation += 1
+            self._push(job, job._last_deadline + job.interval)
+
+    def stats(self):
+        with self._condition:
+            return sorted((job.stats() for job in self.jobs),
+                          key=lambda stats: stats['name'])
+
+    def _next(self):
+        """
+        Waits for the first due job, (deadline, generation, job).
+        """
+        with self._condition:
+            while True:
+                while self._heap and \
+                        self._heap[0][2] != self._heap[0][3]._generation:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                deadline = self._heap[0][0]
+                now = _monotonic()
+                if deadline <= now:
+                    deadline, _, generation, job = heapq.heappop(self._heap)
+                    job._idle.clear()
+                    return deadline, generation, job
+                self._condition.wait(deadline - now)
+
+    def _run(self):
+        while True:
+            deadline, generation, job = self._next()
+            started = _monotonic()
+            try:
+                job.function()
+            except Exception:
+                log.exception("Periodic job %s failed", job.name)
+            finished = _monotonic()
+            with self._condition:
+                job._record(deadline, started, finished)
+                job._last_deadline = deadline
+                if job._active and job._generation == generation:
+                    next_deadline = deadline + job.interval
+                    if next_deadline <= finished:
+                        missed = int((finished - next_deadline) //
+                                     job.interval) + 1
+                        job.overruns += missed
+                        next_deadline += missed * job.interval
+                        log.debug("Periodic job %s overran %d tick(s) "
+                                  "(%.3f s run, %.3f s interval)", job.name,
+                                  missed, finished - started, job.interval)
+                    self._push(job, next_deadline)
+                job._idle.set()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """
+    The scheduler shared by every periodic job of the process.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
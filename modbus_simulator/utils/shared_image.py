@@ -0,0 +1,456 @@
+"""
+Shared register image
+=====================
+
+Holds the four tables of every slave in one ``multiprocessing``
+shared memory segment (or a memory mapped file), so several processes serve
+(and change) the same registers. Tables are preallocated for every slave id
+at creation time, pages are only backed by memory once touched.
+
+Other local processes can attach to a running simulator by name and read or
+write registers in place, ``ModbusSimu.get_values`` and every modbus client
+see the change right away::
+
+    from modbus_simulator.utils.shared_image import SharedImage
+
+    image = SharedImage.attach("modbus_simu")   # or a file path
+    hr = image.numpy_view(1, "holding_registers")
+    hr[0:1000] = range(1000)                    # offsets 0-999 of slave 1
+    image.mark_written(1, "holding_registers")  # let the GUI refresh
+    image.close()
+
+Names containing a path separator are memory mapped files, any other name is
+a shared memory segment (``/dev/shm/<name>`` on Linux). Writes going through
+:meth:`SharedImage.write` (or the simulator) bump the write generation of the
+table themselves, raw buffer writes need :meth:`SharedImage.mark_written`
+for the GUI to pick them up (modbus clients see them either way).
+
+Layout, all integers in host byte order::
+
+    0      header (64 bytes)
+             8s  magic b"MBSIMREG"
+             H   layout version
+             H   reserved
+             I   block size N, values per table
+             I   slave count (248, slave ids 0-247)
+             I   slave stride, bytes per slave area
+             I   data offset, start of the area of slave 0
+             I   slave directory generation
+    64     slave directory, one byte per slave id, 1 if the slave exists
+    320    slave areas, slave id * stride from the data offset
+             16 x I  write generation of coils, discrete inputs,
+                     input registers and holding registers (+ 12 spare)
+             64      coils, N bits packed lsb first
+             ...     discrete inputs, N bits packed lsb first
+             ...     input registers, N x uint16
+             ...     holding registers, N x uint16
+           each table starts on a 64 byte boundary
+
+Python 3.8+ only.
+"""
+from __future__ import absolute_import
+
+import mmap
+import multiprocessing
+import os
+import struct
+from multiprocessing import shared_memory
+
+from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
+from pymodbus.exceptions import NoSuchSlaveException
+
+from modbus_simulator.utils.datastore import (RegisterDataBlock,
+                                              BitDataBlock, DirtyTracker)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b"MBSIMREG"
+VERSION = 1
+HEADER = struct.Struct(str("<8sHHIIIII"))
+HEADER_SIZE = 64
+SLAVE_COUNT = 248
+DIRECTORY_OFFSET = HEADER_SIZE
+DIRECTORY_SIZE = 256
+DATA_OFFSET = DIRECTORY_OFFSET + DIRECTORY_SIZE
+ALIGN = 64
+
+# table order in the slave area and of the generation counters, pymodbus
+# store keys
+TABLES = ('c', 'd', 'i', 'h')
+BIT_TABLES = ('c', 'd')
+TABLE_NAMES = {
+    'coils': 'c',
+    'discrete_inputs': 'd',
+    'input_registers': 'i',
+    'holding_registers': 'h'
+}
+
+
+def _align(size):
+    return (size + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _table_layout(block_size):
+    """
+    {table: (offset in the slave area, size in bytes)} and the slave stride
+    """
+    layout = {}
+    offset = ALIGN
+    for table in TABLES:
+        if table in BIT_TABLES:
+            size = (block_size + 7) // 8
+        else:
+            size = block_size * 2
+        layout[table] = (offset, size)
+        offset += _align(size)
+    return layout, offset
+
+
+# segments created by this process
+_created = set()
+
+
+class MappedFile(object):
+    """
+    Memory mapped file with the parts of the ``SharedMemory`` interface used
+    by :class:`SharedImage`.
+    """
+    def __init__(self, path, create=False, size=0):
+        flags = os.O_RDWR
+        if create:
+            flags |= os.O_CREAT | os.O_TRUNC
+        fd = os.open(path, flags, 0o600)
+        try:
+            if create:
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.name = path
+        self.size = len(self._mmap)
+        self.buf = memoryview(self._mmap)
+
+    def close(self):
+        self.buf.release()
+        self._mmap.close()
+
+    def unlink(self):
+        os.remove(self.name)
+
+
+def _open(name=None, create=False, size=0):
+    if name and os.sep in name:
+        return MappedFile(name, create=create, size=size)
+    if create:
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        _created.add(shm.name)
+        return shm
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 registers every attached segment with the resource
+        # tracker, which would unlink it when this process exits. Processes
+        # started by multiprocessing share the tracker of their parent (the
+        # owner), which keeps its registration, as does the owner itself.
+        shm = shared_memory.SharedMemory(name=name)
+        if multiprocessing.parent_process() is None and \
+                shm.name not in _created:
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(shm._name, "shared_memory")
+            except Exception:
+                pass
+        return shm
+
+
+class SharedImage(object):
+    """
+    A shared register image, see the module documentation for the layout.
+    Use :meth:`create` in the owning process and :meth:`attach` everywhere
+    else.
+
+    Tables are given as pymodbus store keys ('c', 'd', 'i', 'h') or block
+    names ('holding_registers', ...), offsets start at 0 for the first
+    register of a table.
+    """
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.owner = owner
+        (magic, version, _, self.block_size, self.slave_count, self.stride,
+         self.data_offset, _) = HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("'%s' is not a modbus simulator register image"
+                             % shm.name)
+        if version != VERSION:
+            raise ValueError("Unsupported register image version %s"
+                             % version)
+        self.tables, _ = _table_layout(self.block_size)
+        # views handed out, released on close
+        self._views = []
+        self.directory = self._view(DIRECTORY_OFFSET, self.slave_count)
+        self._directory_generation = None
+        self._slaves = []
+        self._contexts = {}
+
+    @classmethod
+    def create(cls, block_size, name=None):
+        """
+        :param block_size: Values per table
+        :param name: Shared memory name or file path, a random shared memory
+            name if None
+        """
+        if not 0 < block_size <= 65536:
+            raise ValueError("Block size %s out of range (1-65536)"
+                             % block_size)
+        tables, stride = _table_layout(block_size)
+        size = DATA_OFFSET + stride * SLAVE_COUNT
+        try:
+            shm = _open(name, create=True, size=size)
+        except FileExistsError:
+            raise RuntimeError("Shared register image '%s' already exists, "
+                               "is another simulator running?" % name)
+        HEADER.pack_into(shm.buf, 0, MAGIC, VERSION, 0, block_size,
+                         SLAVE_COUNT, stride, DATA_OFFSET, 0)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(_open(name))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def _slave_offset(self, slave_id):
+        if not 0 <= slave_id < self.slave_count:
+            raise NoSuchSlaveException("slave index :{} out of "
+                                       "range".format(slave_id))
+        return self.data_offset + slave_id * self.stride
+
+    def table(self, slave_id, table):
+        """
+        Buffer of a table of a slave, bytes for coils and discrete inputs,
+        uint16 for registers.
+        """
+        table = TABLE_NAMES.get(table, table)
+        offset, size = self.tables[table]
+        start = self._slave_offset(slave_id) + offset
+        return self._view(start, size, None if table in BIT_TABLES else 'H')
+
+    def generations(self, slave_id):
+        """
+        Write generation counters of a slave, in :data:`TABLES` order.
+        """
+        start = self._slave_offset(slave_id)
+        return self._view(start, 16 * 4, 'I')
+
+    def _view(self, start, size, fmt=None):
+        view = self.shm.buf[start:start + size]
+        self._views.append(view)
+        if fmt is not None:
+            view = view.cast(str(fmt))
+            self._views.append(view)
+        return view
+
+    def numpy_view(self, slave_id, table):
+        """
+        numpy array over a table of a slave, no copy. uint16 for registers,
+        packed bits (lsb first, ``numpy.unpackbits(..., bitorder='little')``)
+        for coils and discrete inputs.
+        """
+        if numpy is None:
+            raise RuntimeError("numpy is not installed")
+        table = TABLE_NAMES.get(table, table)
+        dtype = numpy.uint8 if table in BIT_TABLES else numpy.uint16
+        return numpy.frombuffer(self.table(slave_id, table), dtype=dtype)
+
+    def mark_written(self, slave_id, table):
+        """
+        Bumps the write generation of a table, the simulator then treats the
+        whole table as changed.
+        """
+        table = TABLE_NAMES.get(table, table)
+        generations = self.generations(slave_id)
+        index = TABLES.index(table)
+        generations[index] = (generations[index] + 1) & 0xFFFFFFFF
+
+    def _block(self, slave_id, table, offset, count):
+        block = self.slave_context(slave_id).store[TABLE_NAMES.get(table,
+                                                                   table)]
+        if offset < 0 or not block.validate(offset + block.address, count):
+            raise ValueError("%d values at offset %d out of the %d values "
+                             "of the table" % (count, offset, len(block)))
+        return block
+
+    def read(self, slave_id, table, offset, count=1):
+        """
+        ``count`` values of a table starting at ``offset``.
+        """
+        block = self._block(slave_id, table, offset, count)
+        return block.getValues(offset + block.address, count)
+
+    def write(self, slave_id, table, offset, values):
+        """
+        Writes values (registers or bits) starting at ``offset``.
+        """
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        block = self._block(slave_id, table, offset, len(values))
+        block.setValues(offset + block.address, values)
+
+    def _bump_directory(self):
+        generation = HEADER.unpack_from(self.shm.buf, 0)[-1]
+        struct.pack_into(str("<I"), self.shm.buf, HEADER.size - 4,
+                         (generation + 1) & 0xFFFFFFFF)
+
+    def is_active(self, slave_id):
+        return 0 <= slave_id < self.slave_count and \
+            bool(self.directory[slave_id])
+
+    def activate(self, slave_id):
+        self._slave_offset(slave_id)
+        self.directory[slave_id] = 1
+        self._bump_directory()
+
+    def deactivate(self, slave_id):
+        self._slave_offset(slave_id)
+        self.directory[slave_id] = 0
+        self._bump_directory()
+
+    def active_slaves(self):
+        generation = HEADER.unpack_from(self.shm.buf, 0)[-1]
+        if generation != self._directory_generation:
+            self._directory_generation = generation
+            self._slaves = [slave_id for slave_id, active
+                            in enumerate(self.directory) if active]
+        return self._slaves
+
+    def slave_context(self, slave_id):
+        """
+        pymodbus slave context over the tables of a slave, cached per
+        process.
+        """
+        context = self._contexts.get(slave_id)
+        if context is None:
+            generations = self.generations(slave_id)
+            blocks = {}
+            for index, table in enumerate(TABLES):
+                dirty = SharedDirtyTracker(self.block_size, generations,
+                                           index)
+                block = BitDataBlock if table in BIT_TABLES \
+                    else RegisterDataBlock
+                # starts at 1 as the slave context shifts addresses by one,
+                # the table index is the register offset
+                blocks[table] = block(1, self.block_size,
+                                      buffer=self.table(slave_id, table),
+                                      dirty=dirty)
+            context = self._contexts[slave_id] = ModbusSlaveContext(
+                co=blocks['c'], di=blocks['d'],
+                ir=blocks['i'], hr=blocks['h'])
+        return context
+
+    def close(self):
+        """
+        Detaches from the image, views handed out (tables, blocks) can't be
+        used afterwards.
+        """
+        self._contexts = {}
+        for view in reversed(self._views):
+            try:
+                view.release()
+            except BufferError:
+                # still exported, e.g. to a numpy array
+                pass
+        self._views = []
+        try:
+            self.shm.close()
+        except BufferError:
+            # the mapping goes away with the process
+            pass
+
+    def unlink(self):
+        if self.owner:
+            self.shm.unlink()
+            _created.discard(self.shm.name)
+
+
+class SharedDirtyTracker(DirtyTracker):
+    """
+    Tracks local writes like :class:`DirtyTracker` and bumps the shared
+    write generation of the table, a generation changed by another process
+    reports the whole table as written.
+    """
+    def __init__(self, size, generations, index):
+        super(SharedDirtyTracker, self).__init__(size)
+        self.size = size
+        self.generations = generations
+        self.index = index
+        self._seen = generations[index]
+
+    def _bump(self):
+        generation = self.generations[self.index]
+        new = (generation + 1) & 0xFFFFFFFF
+        self.generations[self.index] = new
+        if generation == self._seen:
+            self._seen = new
+
+    def mark(self, start, count=1):
+        super(SharedDirtyTracker, self).mark(start, count)
+        self._bump()
+
+    def mark_all(self):
+        super(SharedDirtyTracker, self).mark_all()
+        self._bump()
+
+    def is_dirty(self):
+        return (self.generations[self.index] != self._seen or
+                super(SharedDirtyTracker, self).is_dirty())
+
+    def pop(self):
+        ranges = super(SharedDirtyTracker, self).pop()
+        generation = self.generations[self.index]
+        if generation != self._seen:
+            self._seen = generation
+            return [(0, self.size)]
+        return ranges
+
+
+class SharedServerContext(ModbusServerContext):
+    """
+    Server context over a :class:`SharedImage`, slaves added or removed in
+    any process are seen by all of them.
+    """
+    def __init__(self, image):
+        self.single = False
+        self.image = image
+
+    def __iter__(self):
+        return ((slave_id, self.image.slave_context(slave_id))
+                for slave_id in self.image.active_slaves())
+
+    def __contains__(self, slave):
+        return self.image.is_active(slave)
+
+    def __setitem__(self, slave, context=None):
+        """
+        Adds the slave with cleared tables, the context passed in is ignored
+        as the tables live in the shared image.
+        """
+        for block in self.image.slave_context(slave).store.values():
+            block.reset()
+        self.image.activate(slave)
+
+    def __delitem__(self, slave):
+        self.image.deactivate(slave)
+
+    def __getitem__(self, slave):
+        if self.image.is_active(slave):
+            return self.image.slave_context(slave)
+        raise NoSuchSlaveException("slave - {} does not exist, "
+                                   "or is out of range".format(slave))
+
+    def slaves(self):
+        return self.image.active_slaves()
@@ -0,0 +1,462 @@
+"""
+Simulation engine
+=================
+
+Computes one simulation tick for every register of a block type across all
+slaves in batch. The register map of each block is compiled once into runs
+of consecutive entries sharing a formatter; a tick draws the random values
+of a run in one call (numpy when available), encodes the run with a single
+:class:`~modbus_simulator.utils.codec.RegisterCodec` and writes contiguous
+register spans to the modbus device with one ``set_values`` per span.
+
+Registers with a waveform profile (see :mod:`modbus_simulator.utils.waveforms`)
+get the profile value instead of a random one, all the profiles of a block
+are evaluated together once per tick.
+
+Entries with an ``interval`` (seconds) in the data map are updated at that
+period instead of the simulation time interval. The runs of a block are
+grouped by interval and every interval in use gets its own job on the shared
+:class:`~modbus_simulator.utils.scheduler.Scheduler`, so a tick only touches
+the ranges that are due.
+"""
+from __future__ import absolute_import
+
+import logging
+import time
+from random import randint, uniform
+from threading import RLock
+
+from modbus_simulator.utils.codec import (get_codec, word_count, LIMITS,
+                                          FORMATTERS)
+from modbus_simulator.utils.scheduler import get_scheduler
+from modbus_simulator.utils.waveforms import ProfileBank, validate
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+REGISTERS = ('input_registers', 'holding_registers')
+
+# tick() of every range of a block, whatever its interval
+ALL = object()
+
+
+class Run(object):
+    """
+    Consecutive entries of one formatter and interval, ``count`` values
+    starting at register ``offset``, ``profiled`` of them with a waveform
+    profile. ``index`` is the position of the first entry in the keys of
+    the block.
+    """
+    __slots__ = ('formatter', 'interval', 'offset', 'index', 'count',
+                 'words', 'profiled')
+
+    def __init__(self, formatter, interval, offset, index, count):
+        self.formatter = formatter
+        self.interval = interval
+        self.offset = offset
+        self.index = index
+        self.count = count
+        self.words = count * word_count(formatter)
+        self.profiled = 0
+
+
+class RangeGroup(object):
+    """
+    Runs of a block sharing an update interval (None for the simulation
+    time interval).
+
+    :param runs: :class:`Run` list, in offset order
+    :param spans: (address, first run, last run + 1) of every contiguous
+        register span of the group
+    :param profiles: :class:`ProfileBank` of the entries of the group with
+        a waveform profile (indexed by position in the group) or None
+    """
+    __slots__ = ('interval', 'runs', 'spans', 'profiles')
+
+    def __init__(self, interval, runs, spans, profiles=None):
+        self.interval = interval
+        self.runs = runs
+        self.spans = spans
+        self.profiles = profiles
+
+
+class BlockPlan(object):
+    """
+    Compiled register map of a block of a slave.
+
+    :param keys: Keys of the data map (addresses), in offset order
+    :param groups: {interval: :class:`RangeGroup`}
+    """
+    __slots__ = ('keys', 'groups', 'values')
+
+    def __init__(self, keys, groups):
+        self.keys = keys
+        self.groups = groups
+        # last simulated value of every key, None until ticked
+        self.values = [None] * len(keys)
+
+
+def _interval(value):
+    interval = value.get('interval')
+    if interval in (None, ''):
+        return None
+    interval = float(interval)
+    if interval <= 0:
+        raise ValueError("interval must be positive")
+    return interval
+
+
+def compile_block(block_name, data, calc_offset):
+    """
+    Compiles the data map of a block (``{address: {'value', 'formatter',
+    'profile', 'interval'}}``) into a :class:`BlockPlan`.
+    """
+    entries = []
+    for key, value in data.items():
+        if block_name in REGISTERS:
+            formatter = value.get('formatter', 'uint16')
+            if formatter not in FORMATTERS:
+                formatter = 'uint16'
+        else:
+            formatter = None
+        try:
+            profile = validate(value.get('profile'))
+        except ValueError as e:
+            log.warning("%s %s simulated with random values: %s",
+                        block_name, key, e)
+            profile = None
+        try:
+            interval = _interval(value)
+        except (TypeError, ValueError) as e:
+            log.warning("%s %s simulated at the default interval: %s",
+                        block_name, key, e)
+            interval = None
+        entries.append((calc_offset(block_name, key), key, formatter,
+                        profile, interval))
+    entries.sort(key=lambda entry: entry[0])
+    return compile_entries(entries)
+
+
+def compile_entries(entries):
+    """
+    :class:`BlockPlan` of (offset, key, formatter, profile, interval)
+    entries sorted by offset, formatter None for coils and discrete inputs
+    and profiles as returned by :func:`validate`.
+    """
+    keys = []
+    runs = []
+    profiles = []
+    end = None
+    for index, (offset, key, formatter, profile, interval) in \
+            enumerate(entries):
+        keys.append(key)
+        words = word_count(formatter) if formatter else 1
+        if end == offset and runs[-1].formatter == formatter and \
+                runs[-1].interval == interval:
+            run = runs[-1]
+            run.count += 1
+            run.words += words
+        else:
+            runs.append(Run(formatter, interval, offset, index, 1))
+        if profile is not None:
+            profiles.append((index, profile))
+            runs[-1].profiled += 1
+        end = offset + words
+
+    groups = {}
+    group_runs = {}
+    for run in runs:
+        group_runs.setdefault(run.interval, []).append(run)
+    profiles = dict(profiles)
+    for interval, interval_runs in group_runs.items():
+        spans = []
+        group_profiles = []
+        position = 0
+        end = None
+        for number, run in enumerate(interval_runs):
+            if end != run.offset:
+                if spans:
+                    spans[-1][2] = number
+                spans.append([keys[run.index], number, None])
+            for index in range(run.index, run.index + run.count):
+                if index in profiles:
+                    group_profiles.append((position + index - run.index,
+                                           profiles[index]))
+            position += run.count
+            end = run.offset + run.words
+        spans[-1][2] = len(interval_runs)
+        groups[interval] = RangeGroup(
+            interval, interval_runs, [tuple(span) for span in spans],
+            ProfileBank(group_profiles) if group_profiles else None)
+    return BlockPlan(keys, groups)
+
+
+def _draw(formatter, count, minval, maxval):
+    """
+    ``count`` random values in [minval, maxval] for ``formatter`` (None for
+    coils and discrete inputs), same distribution as the per register
+    simulation: uniform rounded to 2 decimals for floats, integers otherwise.
+    """
+    if formatter and 'float' in formatter:
+        if numpy is not None:
+            return numpy.round(numpy.random.uniform(minval, maxval, count),
+                               2).tolist()
+        return [round(uniform(minval, maxval), 2) for _ in range(count)]
+    minval, maxval = int(minval), int(maxval)
+    if formatter:
+        low, high = LIMITS[formatter]
+        if 'uint' in formatter:
+            minval, maxval = abs(minval), abs(maxval)
+            minval, maxval = min(minval, maxval), max(minval, maxval)
+        # out of range values can't be encoded, keep them in range
+        minval, maxval = max(minval, low), min(maxval, high)
+    if numpy is not None and maxval < 2 ** 63 - 1:
+        return numpy.random.randint(minval, maxval + 1, count,
+                                    dtype=numpy.int64).tolist()
+    return [randint(minval, maxval) for _ in range(count)]
+
+
+def _fit(formatter, values):
+    """
+    Profile values made encodable for ``formatter``: 0/1 for coils and
+    discrete inputs, rounded and clamped for integers.
+    """
+    if formatter is None:
+        return [1 if value >= 0.5 else 0 for value in values]
+    low, high = LIMITS[formatter]
+    if numpy is not None and high < 2 ** 63 - 1:
+        values = numpy.clip(numpy.asarray(values, dtype=float), low, high)
+        if 'float' not in formatter:
+            values = numpy.rint(values).astype(numpy.int64)
+        return values.tolist()
+    if 'float' in formatter:
+        return [min(max(value, low), high) for value in values]
+    return [min(max(int(round(value)), low), high) for value in values]
+
+
+class SimulationEngine(object):
+    """
+    Batched random value simulation for a modbus device.
+    """
+    def __init__(self, modbus_device, byte_order='big', word_order='big',
+                 scheduler=None):
+        self.modbus_device = modbus_device
+        self.byte_order = byte_order
+        self.word_order = word_order
+        self.scheduler = scheduler or get_scheduler()
+        self._plans = {}
+        self._lock = RLock()
+        # waveform time origin, shared by all the blocks
+        self._started = _monotonic()
+        # {block_name: [interval, minval, maxval, callback]} while simulated
+        self._running = {}
+        # {(block_name, interval): job}
+        self._jobs = {}
+
+    def set_block(self, slave_id, block_name, data):
+        """
+        (Re)compiles the register map of a block, to be called whenever
+        entries, formatters, profiles or intervals of the block change.
+        """
+        self.set_plan(slave_id, block_name, compile_block(
+            block_name, data, self.modbus_device._calc_offset))
+
+    def set_plan(self, slave_id, block_name, plan):
+        """
+        Simulates a block of a slave from a compiled :class:`BlockPlan`.
+        """
+        with self._lock:
+            blocks = self._plans.setdefault(block_name, {})
+            if plan.keys:
+                blocks[int(slave_id)] = plan
+            else:
+                blocks.pop(int(slave_id), None)
+            self._sync_jobs(block_name)
+
+    def remove_slave(self, slave_id):
+        with self._lock:
+            for block_name, blocks in self._plans.items():
+                blocks.pop(int(slave_id), None)
+                self._sync_jobs(block_name)
+
+    def clear(self):
+        with self._lock:
+            self._plans = {}
+            for block_name in list(self._running):
+                self._sync_jobs(block_name)
+
+    def intervals(self, block_name):
+        """
+        Update intervals of the ranges of ``block_name`` (None for the
+        simulation time interval).
+        """
+        with self._lock:
+            return set(interval
+                       for plan in self._plans.get(block_name, {}).values()
+                       for interval in plan.groups)
+
+    def start(self, block_name, interval, minval, maxval, callback=None):
+        """
+        Simulates ``block_name`` on every slave: ranges with their own
+        interval are updated at it, the others every ``interval`` seconds.
+        ``callback(block_name, ticked)`` is called after every tick, from
+        the scheduler thread.
+        """
+        with self._lock:
+            self._running[block_name] = [float(interval), minval, maxval,
+                                         callback]
+            self._sync_jobs(block_name)
+
+    def configure(self, block_name, interval=None, minval=None, maxval=None):
+        """
+        Changes the time interval or value range of a simulated block.
+        """
+        with self._lock:
+            running = self._running.get(block_name)
+            if running is None:
+                return
+            if interval is not None:
+                running[0] = float(interval)
+                job = self._jobs.get((block_name, None))
+                if job is not None:
+                    job.interval = running[0]
+            if minval is not None:
+                running[1] = minval
+            if maxval is not None:
+                running[2] = maxval
+
+    def stop(self, block_name=None):
+        """
+        Stops simulating ``block_name``, every block if None.
+        """
+        with self._lock:
+            for name in [block_name] if block_name else list(self._running):
+                self._running.pop(name, None)
+                self._sync_jobs(name)
+
+    @property
+    def running(self):
+        return bool(self._running)
+
+    def _sync_jobs(self, block_name):
+        """
+        One job per interval in use while the block is simulated.
+        """
+        running = self._running.get(block_name)
+        wanted = self.intervals(block_name) if running else set()
+        for key in list(self._jobs):
+            if key[0] == block_name and key[1] not in wanted:
+                self._jobs.pop(key).cancel()
+        for interval in wanted:
+            if (block_name, interval) in self._jobs:
+                continue
+            name = "simulation %s" % block_name
+            if interval is not None:
+                name += " %gs" % interval
+            job = self.scheduler.job(
+                name, interval or running[0],
+                lambda interval=interval: self._run(block_name, interval))
+            self._jobs[(block_name, interval)] = job
+            job.start()
+
+    def _run(self, block_name, interval):
+        running = self._running.get(block_name)
+        if running is None:
+            return
+        _, minval, maxval, callback = running
+        ticked = self.tick(block_name, minval, maxval, interval)
+        if ticked and callback is not None:
+            callback(block_name, ticked)
+
+    def last_values(self, slave_id, block_name):
+        """
+        Keys and values written by the last ticks of the block or None.
+        """
+        plan = self._plans.get(block_name, {}).get(int(slave_id))
+        if plan is None:
+            return None
+        simulated = [(key, value) for key, value
+                     in zip(plan.keys, plan.values) if value is not None]
+        if not simulated:
+            return None
+        return [key for key, _ in simulated], [value for _, value
+                                               in simulated]
+
+    def tick(self, block_name, minval, maxval, interval=ALL):
+        """
+        Draws new values for the ranges of ``block_name`` updated every
+        ``interval`` (all of them by default) on every slave and writes them
+        to the modbus device.
+
+        :return: {slave_id: (keys, values)} of the updated entries
+        """
+        with self._lock:
+            plans = list(self._plans.get(block_name, {}).items())
+        now = _monotonic() - self._started
+        ticked = {}
+        for slave_id, plan in plans:
+            if interval is ALL:
+                groups = list(plan.groups.values())
+            elif interval in plan.groups:
+                groups = [plan.groups[interval]]
+            else:
+                continue
+            keys = []
+            values = []
+            for group in groups:
+                group_values = self._tick_group(slave_id, block_name, plan,
+                                                group, now, minval, maxval)
+                for run in group.runs:
+                    keys.extend(plan.keys[run.index:run.index + run.count])
+                values.extend(group_values)
+            ticked[slave_id] = (keys, values)
+        return ticked
+
+    def _tick_group(self, slave_id, block_name, plan, group, now, minval,
+                    maxval):
+        values = []
+        registers = []
+        profiles = group.profiles
+        if profiles is not None:
+            values = [0] * sum(run.count for run in group.runs)
+            profiles.evaluate(now, values)
+        position = 0
+        for run in group.runs:
+            end = position + run.count
+            if profiles is None:
+                run_values = _draw(run.formatter, run.count, minval, maxval)
+                values.extend(run_values)
+            elif not run.profiled:
+                run_values = _draw(run.formatter, run.count, minval, maxval)
+                values[position:end] = run_values
+            else:
+                run_values = _fit(run.formatter, values[position:end])
+                if run.profiled < run.count:
+                    # profiles mixed with random entries
+                    drawn = _draw(run.formatter, run.count, minval, maxval)
+                    run_values = [
+                        value if index in profiles.indexes
+                        else drawn[index - position]
+                        for index, value in enumerate(run_values, position)]
+                values[position:end] = run_values
+            plan.values[run.index:run.index + run.count] = run_values
+            position = end
+            if run.formatter:
+                codec = get_codec(run.formatter, run.count,
+                                  self.byte_order, self.word_order)
+                registers.append(codec.encode(run_values))
+            else:
+                registers.append(run_values)
+        for address, first, last in group.spans:
+            span = []
+            for run_registers in registers[first:last]:
+                span.extend(run_registers)
+            self.modbus_device.set_values(slave_id, block_name, address,
+                                          span)
+        return values
@@ -0,0 +1,340 @@
+"""
+Binary state snapshots
+======================
+
+Compact replacement for the ``slaves.json`` state file. Every block is
+stored as its raw register image (as sent on the wire, for the byte/word
+order of the snapshot) plus a table of its data map entries, so loading is
+one bulk ``set_values`` per block instead of encoding every register.
+
+Layout (little endian)::
+
+    header   8s magic b"MBSIMSNP", H version, H flags, I meta length
+    meta     json: active_server, port, slaves_list, byte_order,
+             word_order, formatters (formatter names, indexed by code),
+             profiles (slave id, block, key, waveform profile of every
+             entry with one), intervals (slave id, block, key, update
+             interval of every entry with one)
+    payload  block records, zlib compressed if flags & FLAG_ZLIB
+
+    block    B slave id, B block (index in BLOCKS), I entry count,
+             I offset of the first register, I image length (registers)
+             entry count x I    data map keys (addresses)
+             entry count x I    register offsets
+             entry count x B    formatter codes (NO_FORMATTER for bits)
+             image length x H   register image, from the first offset
+
+:func:`load_state` reads either format, JSON state files keep working.
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from contextlib import contextmanager
+
+from modbus_simulator.utils.codec import (get_codec, get_layout_codec,
+                                          word_count, FORMATTERS)
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"MBSIMSNP"
+VERSION = 1
+FLAG_ZLIB = 1
+HEADER = struct.Struct(str("<8sHHI"))
+BLOCK = struct.Struct(str("<BBIII"))
+BLOCKS = ('coils', 'discrete_inputs', 'input_registers', 'holding_registers')
+REGISTERS = ('input_registers', 'holding_registers')
+NO_FORMATTER = 255
+STATE_KEYS = ('active_server', 'port', 'slaves_list', 'slaves_memory')
+
+_SWAP = sys.byteorder == 'big'
+
+# os.replace is Python 3 only, rename replaces the file on POSIX
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _pack(typecode, values):
+    data = array(str(typecode), values)
+    if _SWAP:
+        data.byteswap()
+    return data.tobytes() if hasattr(data, 'tobytes') else data.tostring()
+
+
+def _unpack(typecode, payload, position, count):
+    data = array(str(typecode))
+    end = position + data.itemsize * count
+    chunk = payload[position:end]
+    if len(chunk) != end - position:
+        raise struct.error("truncated %s table" % typecode)
+    if hasattr(data, 'frombytes'):
+        data.frombytes(chunk)
+    else:
+        data.fromstring(chunk)
+    if _SWAP:
+        data.byteswap()
+    return data, end
+
+
+def is_snapshot(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _float32(value):
+    # shortest repr that survives the float32 round trip, 12.3 instead of
+    # 12.300000190734863
+    return float('%.7g' % value)
+
+
+def _encode_block(block_name, entries, first, words, byte_order,
+                  word_order):
+    """
+    Register image of the entries (offset, key, formatter, value), sorted by
+    offset.
+    """
+    image = array(str('H'), [0]) * words
+    if block_name not in REGISTERS:
+        for offset, _, _, value in entries:
+            image[offset - first] = 1 if value else 0
+        return image
+    try:
+        codec = get_layout_codec([(offset - first, formatter)
+                                  for offset, _, formatter, _ in entries],
+                                 byte_order, word_order)
+        for offset, registers in codec.encode([value for _, _, _, value
+                                               in entries]):
+            image[offset:offset + len(registers)] = array(str('H'),
+                                                          registers)
+    except (ValueError, struct.error):
+        # overlapping entries or values out of range, encode one at a time
+        # in offset order as the GUI writes them
+        for offset, key, formatter, value in entries:
+            codec = get_codec(formatter, 1, byte_order, word_order)
+            try:
+                registers = codec.encode([value])
+            except struct.error:
+                log.warning("Value %s of %s doesn't fit %s, saved as 0",
+                            value, key, formatter)
+                continue
+            start = offset - first
+            image[start:start + len(registers)] = array(str('H'), registers)
+    return image
+
+
+def _decode_block(block_name, offsets, formatters, first, image, byte_order,
+                  word_order):
+    """
+    Entry values from the register image.
+    """
+    if block_name not in REGISTERS:
+        return [image[offset - first] for offset in offsets]
+    try:
+        codec = get_layout_codec([(offset - first, formatter)
+                                  for offset, formatter
+                                  in zip(offsets, formatters)],
+                                 byte_order, word_order)
+        values = codec.decode(image[:codec.words])
+    except ValueError:
+        values = []
+        for offset, formatter in zip(offsets, formatters):
+            start = offset - first
+            codec = get_codec(formatter, 1, byte_order, word_order)
+            values.append(codec.decode(image[start:start + codec.words])[0])
+    return [_float32(value) if formatter == 'float32' else value
+            for value, formatter in zip(values, formatters)]
+
+
+def save_snapshot(path, state, calc_offset, byte_order='big',
+                  word_order='big', compress=True):
+    """
+    Writes a binary snapshot.
+
+    :param state: dict with the keys of the JSON state file (active_server,
+        port, slaves_list, slaves_memory)
+    :param calc_offset: Backend ``_calc_offset`` mapping addresses to
+        register offsets
+    :return: Number of bytes written
+    """
+    started = time.time()
+    formatters = sorted(FORMATTERS)
+    codes = dict((formatter, code) for code, formatter
+                 in enumerate(formatters))
+    records = []
+    profiles = []
+    intervals = []
+    for slave_id, block_name, data in state['slaves_memory']:
+        if not data:
+            continue
+        registers = block_name in REGISTERS
+        entries = []
+        for key, value in data.items():
+            if value.get('profile'):
+                profiles.append([str(slave_id), block_name, str(key),
+                                 value['profile']])
+            if value.get('interval'):
+                intervals.append([str(slave_id), block_name, str(key),
+                                  value['interval']])
+            if registers:
+                formatter = value.get('formatter', 'uint16')
+                if formatter not in FORMATTERS:
+                    formatter = 'uint16'
+                entry_value = float(value['value'])
+            else:
+                formatter = None
+                entry_value = int(value['value'])
+            entries.append((calc_offset(block_name, key), int(key),
+                            formatter, entry_value))
+        entries.sort(key=lambda entry: entry[0])
+        first = entries[0][0]
+        words = max(offset + (word_count(formatter) if formatter else 1)
+                    for offset, _, formatter, _ in entries) - first
+        image = _encode_block(block_name, entries, first, words,
+                              byte_order, word_order)
+        records.append(BLOCK.pack(int(slave_id), BLOCKS.index(block_name),
+                                  len(entries), first, words))
+        records.append(_pack('I', [key for _, key, _, _ in entries]))
+        records.append(_pack('I', [offset for offset, _, _, _ in entries]))
+        records.append(_pack('B', [NO_FORMATTER if formatter is None
+                                   else codes[formatter]
+                                   for _, _, formatter, _ in entries]))
+        records.append(_pack('H', image))
+    payload = b"".join(records)
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload, 1)
+        flags |= FLAG_ZLIB
+    meta = json.dumps(dict(
+        active_server=state['active_server'], port=state['port'],
+        slaves_list=state['slaves_list'], byte_order=byte_order,
+        word_order=word_order, formatters=formatters, profiles=profiles,
+        intervals=intervals
+    )).encode('utf-8')
+    with atomic_write(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, flags, len(meta)))
+        f.write(meta)
+        f.write(payload)
+    size = HEADER.size + len(meta) + len(payload)
+    log.info("Saved state snapshot '%s' (%d bytes) in %.3f s", path, size,
+             time.time() - started)
+    return size
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """
+    File replacing ``path`` once closed, a crash while writing leaves the
+    previous file in place.
+    """
+    temp = path + '.tmp'
+    try:
+        with open(temp, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        _replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def load_snapshot(path):
+    """
+    Reads a binary snapshot.
+
+    :return: dict with the keys of the JSON state file (the data maps in
+        slaves_memory have str keys as after a JSON round trip), byte_order,
+        word_order and images, a list of (slave_id, block_name,
+        first offset, registers) to bulk load each block.
+    """
+    started = time.time()
+    with open(path, 'rb') as f:
+        content = f.read()
+    try:
+        state = _parse_snapshot(path, content)
+    except (struct.error, zlib.error, IndexError, KeyError, TypeError,
+            UnicodeDecodeError) as e:
+        raise ValueError("Corrupt snapshot '%s': %s" % (path, e))
+    log.info("Loaded state snapshot '%s' in %.3f s", path,
+             time.time() - started)
+    return state
+
+
+def _parse_snapshot(path, content):
+    if len(content) < HEADER.size:
+        raise ValueError("Corrupt snapshot '%s': truncated header" % path)
+    magic, version, flags, meta_length = HEADER.unpack_from(content, 0)
+    if magic != MAGIC:
+        raise ValueError("'%s' is not a state snapshot" % path)
+    if version > VERSION:
+        raise ValueError("Unsupported state snapshot version %s" % version)
+    position = HEADER.size + meta_length
+    meta = json.loads(content[HEADER.size:position].decode('utf-8'))
+    payload = content[position:]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    formatters = meta['formatters']
+    byte_order, word_order = meta['byte_order'], meta['word_order']
+
+    slaves_memory = []
+    images = []
+    position = 0
+    while position < len(payload):
+        slave_id, block, count, first, words = BLOCK.unpack_from(payload,
+                                                                 position)
+        position += BLOCK.size
+        block_name = BLOCKS[block]
+        keys, position = _unpack('I', payload, position, count)
+        offsets, position = _unpack('I', payload, position, count)
+        codes, position = _unpack('B', payload, position, count)
+        image, position = _unpack('H', payload, position, words)
+        block_formatters = [None if code == NO_FORMATTER
+                            else formatters[code] for code in codes]
+        values = _decode_block(block_name, offsets, block_formatters, first,
+                               image, byte_order, word_order)
+        if block_name in REGISTERS:
+            data = dict((str(key), {'value': value, 'formatter': formatter})
+                        for key, value, formatter
+                        in zip(keys, values, block_formatters))
+        else:
+            data = dict((str(key), {'value': value})
+                        for key, value in zip(keys, values))
+        slaves_memory.append([str(slave_id), block_name, data])
+        images.append((slave_id, block_name, first, image.tolist()))
+    blocks = dict(((slave_id, block_name), data)
+                  for slave_id, block_name, data in slaves_memory)
+    for name in ('profile', 'interval'):
+        for slave_id, block_name, key, value in meta.get(name + 's', []):
+            entry = blocks.get((slave_id, block_name), {}).get(key)
+            if entry is not None:
+                entry[name] = value
+    state = dict(
+        active_server=meta['active_server'], port=meta['port'],
+        slaves_list=meta['slaves_list'], slaves_memory=slaves_memory,
+        byte_order=byte_order, word_order=word_order, images=images
+    )
+    return state
+
+
+def load_state(path):
+    """
+    Reads a state file, binary snapshot or JSON (:meth:`Gui.save_state`
+    before snapshots). JSON states have no images.
+    """
+    if is_snapshot(path):
+        return load_snapshot(path)
+    started = time.time()
+    with open(path, 'r') as f:
+        data = json.load(f)
+    for key in STATE_KEYS:
+        if key not in data:
+            raise ValueError("Failed to load simulation state '%s' : "
+                             "JSON Key Missing (%s)" % (path, key))
+    log.info("Loaded JSON state '%s' in %.3f s", path, time.time() - started)
+    return data
@@ -0,0 +1,84 @@
+"""
+View update queue
+=================
+
+Simulation ticks and the modbus sync run on background threads, views must
+only be refreshed from the main (Kivy) thread. Threads post a refresh keyed
+by what it refreshes (server, slave, block) to an :class:`UpdateQueue`; the
+queue is drained on the main thread at most ``max_rate`` times per second
+and a key posted several times before a drain is refreshed once.
+
+The queue doesn't depend on Kivy, it is given a ``schedule(callback,
+delay)`` function that runs ``callback`` on the main thread after ``delay``
+seconds (``Clock.schedule_once`` in the GUI).
+"""
+from __future__ import absolute_import
+
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class UpdateQueue(object):
+    """
+    Coalesces refreshes posted from any thread into one drain per frame.
+    """
+    def __init__(self, schedule, max_rate=10):
+        self._schedule = schedule
+        self.interval = None
+        self.max_rate = max_rate
+        self._pending = OrderedDict()
+        self._lock = Lock()
+        self._scheduled = False
+        self._last_drain = 0
+        # posted / drained refreshes, the difference was coalesced
+        self.posted = 0
+        self.drained = 0
+
+    @property
+    def max_rate(self):
+        return 1.0 / self.interval
+
+    @max_rate.setter
+    def max_rate(self, value):
+        self.interval = 1.0 / max(float(value), 1)
+
+    def post(self, key, callback, *args):
+        """
+        Queues ``callback(*args)``, replacing a refresh of ``key`` still
+        pending.
+        """
+        with self._lock:
+            self._pending.pop(key, None)
+            self._pending[key] = (callback, args)
+            self.posted += 1
+            if self._scheduled:
+                return
+            self._scheduled = True
+            delay = max(0, self._last_drain + self.interval - _monotonic())
+        self._schedule(self.drain, delay)
+
+    def drain(self, *args):
+        """
+        Runs the pending refreshes, on the main thread.
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = OrderedDict()
+            self._scheduled = False
+            self._last_drain = _monotonic()
+        for key, (callback, callback_args) in pending.items():
+            try:
+                callback(*callback_args)
+            except Exception:
+                log.exception("View update %s failed", key)
+        self.drained += len(pending)
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
@@ -0,0 +1,230 @@
+"""
+Waveform profiles
+=================
+
+Value generators for simulated registers, set per register in the data map
+(``{'value': .., 'formatter': .., 'profile': {...}}``)::
+
+    {'type': 'sine', 'offset': 50, 'amplitude': 10, 'period': 60}
+    {'type': 'ramp', 'low': 0, 'high': 100, 'period': 30}
+    {'type': 'square', 'low': 0, 'high': 1, 'period': 10, 'duty': 0.5}
+    {'type': 'random_walk', 'start': 50, 'step': 1, 'low': 0, 'high': 100}
+    {'type': 'steps', 'values': [0, 10, 20], 'dwell': 5}
+    {'type': 'noise', 'value': 230, 'noise': 2}
+
+Registers without a profile (or with ``{'type': 'random'}``) keep the
+uniform random values between the simulation min and max. Periods, dwell
+and ``phase`` (every periodic type) are in seconds of simulation time.
+
+A :class:`ProfileBank` holds the profiles of a block with their parameters
+in columns, one set per profile type, and evaluates every column in one
+pass per tick (numpy when available).
+"""
+from __future__ import absolute_import
+
+import math
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# profile type: ((parameter, default), ...), None for a required parameter
+PARAMETERS = {
+    'sine': (('offset', 0.0), ('amplitude', 1.0), ('period', 60.0),
+             ('phase', 0.0)),
+    'ramp': (('low', 0.0), ('high', 100.0), ('period', 60.0),
+             ('phase', 0.0)),
+    'square': (('low', 0.0), ('high', 1.0), ('period', 60.0),
+               ('duty', 0.5), ('phase', 0.0)),
+    'random_walk': (('start', 0.0), ('step', 1.0), ('low', None),
+                    ('high', None)),
+    'steps': (('values', None), ('dwell', 1.0), ('phase', 0.0)),
+    'noise': (('value', 0.0), ('noise', 1.0)),
+}
+RANDOM = 'random'
+PROFILE_TYPES = (RANDOM,) + tuple(sorted(PARAMETERS))
+
+_TWO_PI = 2 * math.pi
+
+
+def validate(profile):
+    """
+    Checks a profile and fills in the defaults.
+
+    :return: Profile dict, None for the default random values
+    :raises ValueError: Unknown type or invalid parameter
+    """
+    if profile is None:
+        return None
+    if not isinstance(profile, dict):
+        raise ValueError("Simulation profile must be a dict, got %r"
+                         % (profile,))
+    kind = profile.get('type', RANDOM)
+    if kind == RANDOM:
+        return None
+    if kind not in PARAMETERS:
+        raise ValueError("Unknown simulation profile '%s', one of %s"
+                         % (kind, ", ".join(PROFILE_TYPES)))
+    checked = {'type': kind}
+    for name, default in PARAMETERS[kind]:
+        value = profile.get(name, default)
+        if value is None:
+            if name in ('low', 'high'):
+                # random walk bounds are optional
+                checked[name] = float('-inf' if name == 'low' else 'inf')
+                continue
+            raise ValueError("Simulation profile '%s' needs '%s'"
+                             % (kind, name))
+        try:
+            if name == 'values':
+                value = [float(v) for v in value]
+                if not value:
+                    raise ValueError
+            else:
+                value = float(value)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid '%s' for simulation profile '%s': %r"
+                             % (name, kind, profile.get(name)))
+        checked[name] = value
+    for name in ('period', 'dwell'):
+        if checked.get(name, 1) <= 0:
+            raise ValueError("Simulation profile '%s' needs a positive "
+                             "'%s'" % (kind, name))
+    return checked
+
+
+def _column(entries, name):
+    values = [profile[name] for _, profile in entries]
+    if numpy is not None:
+        return numpy.array(values, dtype=float)
+    return values
+
+
+class ProfileBank(object):
+    """
+    Profiles of a block, evaluated in bulk.
+
+    :param entries: (value index, profile) pairs, profiles as returned by
+        :func:`validate`
+    """
+    def __init__(self, entries):
+        by_type = {}
+        for index, profile in entries:
+            by_type.setdefault(profile['type'], []).append((index, profile))
+        self.indexes = set()
+        self.columns = []
+        for kind, kind_entries in sorted(by_type.items()):
+            indexes = [index for index, _ in kind_entries]
+            self.indexes.update(indexes)
+            if kind == 'steps':
+                params = {
+                    'values': [profile['values']
+                               for _, profile in kind_entries],
+                    'dwell': [profile['dwell']
+                              for _, profile in kind_entries],
+                    'phase': [profile['phase']
+                              for _, profile in kind_entries]
+                }
+            else:
+                params = dict((name, _column(kind_entries, name))
+                              for name, _ in PARAMETERS[kind])
+                if kind == 'random_walk':
+                    # walk position, carried from tick to tick
+                    params['state'] = _column(kind_entries, 'start')
+            self.columns.append((kind, indexes, params))
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def evaluate(self, t, values):
+        """
+        Writes the profile values at simulation time ``t`` into ``values``
+        (the values of the block in key order).
+        """
+        for kind, indexes, params in self.columns:
+            generate = _NUMPY[kind] if numpy is not None else _PYTHON[kind]
+            results = generate(t, len(indexes), params)
+            if numpy is not None and kind != 'steps':
+                results = results.tolist()
+            for index, value in zip(indexes, results):
+                values[index] = value
+
+
+def _fraction(t, period, phase):
+    return ((t + phase) % period) / period
+
+
+def _sine(t, count, p):
+    return [offset + amplitude * math.sin(_TWO_PI * (t + phase) / period)
+            for offset, amplitude, period, phase
+            in zip(p['offset'], p['amplitude'], p['period'], p['phase'])]
+
+
+def _ramp(t, count, p):
+    return [low + (high - low) * _fraction(t, period, phase)
+            for low, high, period, phase
+            in zip(p['low'], p['high'], p['period'], p['phase'])]
+
+
+def _square(t, count, p):
+    return [high if _fraction(t, period, phase) < duty else low
+            for low, high, period, duty, phase
+            in zip(p['low'], p['high'], p['period'], p['duty'], p['phase'])]
+
+
+def _random_walk(t, count, p):
+    state = p['state']
+    for i, (step, low, high) in enumerate(zip(p['step'], p['low'],
+                                              p['high'])):
+        state[i] = min(max(state[i] + random.uniform(-step, step), low),
+                       high)
+    return list(state)
+
+
+def _steps(t, count, p):
+    return [values[int((t + phase) // dwell) % len(values)]
+            for values, dwell, phase
+            in zip(p['values'], p['dwell'], p['phase'])]
+
+
+def _noise(t, count, p):
+    return [value + random.uniform(-noise, noise)
+            for value, noise in zip(p['value'], p['noise'])]
+
+
+def _np_sine(t, count, p):
+    return p['offset'] + p['amplitude'] * numpy.sin(
+        _TWO_PI * (t + p['phase']) / p['period'])
+
+
+def _np_ramp(t, count, p):
+    fraction = numpy.mod(t + p['phase'], p['period']) / p['period']
+    return p['low'] + (p['high'] - p['low']) * fraction
+
+
+def _np_square(t, count, p):
+    fraction = numpy.mod(t + p['phase'], p['period']) / p['period']
+    return numpy.where(fraction < p['duty'], p['high'], p['low'])
+
+
+def _np_random_walk(t, count, p):
+    state = p['state']
+    state += numpy.random.uniform(-1, 1, count) * p['step']
+    numpy.clip(state, p['low'], p['high'], out=state)
+    return state.copy()
+
+
+def _np_noise(t, count, p):
+    return p['value'] + numpy.random.uniform(-1, 1, count) * p['noise']
+
+
+_PYTHON = {
+    'sine': _sine, 'ramp': _ramp, 'square': _square,
+    'random_walk': _random_walk, 'steps': _steps, 'noise': _noise
+}
+_NUMPY = {
+    'sine': _np_sine, 'ramp': _np_ramp, 'square': _np_square,
+    'random_walk': _np_random_walk, 'steps': _steps, 'noise': _np_noise
+}
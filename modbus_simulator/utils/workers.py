@@ -0,0 +1,129 @@
+"""
+Multi-process Modbus TCP server
+===============================
+
+Runs ``workers`` processes, each serving an :class:`AsyncModbusTcpServer`
+bound to the same port with ``SO_REUSEPORT``, so request handling scales
+past one core. Every worker attaches to the :class:`SharedImage` of the
+parent by name: a write through any worker (or the parent) is visible to
+all of them without copying.
+
+Workers are started with the ``spawn`` method and restarted if they die.
+Python 3.8+ on platforms with ``SO_REUSEPORT`` (Linux, BSD, macOS).
+"""
+from __future__ import absolute_import
+
+import logging
+import multiprocessing
+import signal
+import socket
+import sys
+import threading
+
+from modbus_simulator.utils.async_server import AsyncModbusTcpServer
+from modbus_simulator.utils.shared_image import (SharedImage,
+                                                 SharedServerContext)
+
+log = logging.getLogger(__name__)
+
+
+def _exit(signum, frame):
+    sys.exit(0)
+
+
+def _serve(image_name, address, identity, log_level):
+    """
+    Worker process entry point.
+    """
+    logging.basicConfig(level=log_level)
+    signal.signal(signal.SIGTERM, _exit)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    image = SharedImage.attach(image_name)
+    server = AsyncModbusTcpServer(SharedServerContext(image),
+                                  identity=identity, address=address,
+                                  reuse_port=True)
+    try:
+        server.serve_forever()
+    except SystemExit:
+        pass
+    finally:
+        image.close()
+
+
+class ModbusWorkerPool(object):
+    """
+    Server interface (``serve_forever``/``shutdown``) over a pool of worker
+    processes, driven by :class:`ThreadedModbusServer` like the single
+    process servers.
+    """
+    poll_interval = 1
+
+    def __init__(self, image, address, workers, identity=None):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError("Multiple workers need SO_REUSEPORT, not "
+                               "available on this platform")
+        self.image = image
+        self.address = address
+        self.workers = workers
+        self.identity = identity
+        self.processes = []
+        self.socket = None
+        self._context = multiprocessing.get_context('spawn')
+        self._stop = threading.Event()
+        self._stopped = threading.Event()
+        self._stopped.set()
+        self._check_address()
+
+    def _check_address(self):
+        # fail early (in the parent) if the port is taken, workers only
+        # bind once spawned
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(self.address)
+        finally:
+            sock.close()
+
+    def _spawn(self, index):
+        process = self._context.Process(
+            target=_serve, name="ModbusWorker-%d" % index,
+            args=(self.image.name, self.address, self.identity,
+                  logging.getLogger().getEffectiveLevel()))
+        process.daemon = True
+        process.start()
+        return process
+
+    def serve_forever(self):
+        self._stop.clear()
+        self._stopped.clear()
+        try:
+            self.processes = [self._spawn(index)
+                              for index in range(self.workers)]
+            log.debug("Started %d modbus workers on %s:%s", self.workers,
+                      *self.address)
+            while not self._stop.wait(self.poll_interval):
+                for index, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        log.error("Modbus worker %s exited (%s), restarting",
+                                  process.name, process.exitcode)
+                        self.processes[index] = self._spawn(index)
+        finally:
+            for process in self.processes:
+                if process.is_alive():
+                    process.terminate()
+            for process in self.processes:
+                process.join()
+            self.processes = []
+            self._stopped.set()
+
+    def shutdown(self):
+        """
+        Stops the workers and waits for them to exit.
+        """
+        self._stop.set()
+        self._stopped.wait()
+
+    def server_close(self):
+        log.debug("Modbus server stopped")
+        self.shutdown()
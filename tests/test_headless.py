@@ -0,0 +1,14 @@
+from modbus_simulator.headless import HeadlessSimu
+
+
+def test_rtu_kwargs_default_config():
+    simu = HeadlessSimu(use_pymodbus=True, server='rtu', port='/dev/ptyp0')
+    kwargs = simu._device_kwargs()
+    assert kwargs['baudrate'] == 9600
+    assert kwargs['bytesize'] == 8
+    assert kwargs['parity'] == 'N'
+    assert kwargs['stopbits'] == 1
+    assert kwargs['xonxoff'] is False
+    assert kwargs['writetimeout'] == 2
+    assert kwargs['timeout'] == 2
+    assert 'address' not in kwargs